@@ -1,14 +1,27 @@
 import { io } from 'socket.io-client'
 
-const socket = io('http://127.0.0.1:5000')
+// 再接続時に同じ会話を再開するため、サーバーが発行したsessionIdをブラウザに保存する
+// (サーバーが発行していないsessionIdは受け付けられず、新しい会話になる)
+const socket = io('http://127.0.0.1:5000', {
+  // 接続のたびに、最新のsessionIdを送る
+  auth: (cb) => cb({ sessionId: localStorage.getItem('sessionId') }),
+  // 複数workerの場合もsticky sessionなしで動くよう、websocketのみを使用する
+  transports: ['websocket']
+})
 
 export type ResponseMessage = {
   role: 'model' | 'user'
-  status: 'success' | 'progress' | 'error'
+  // cancelled: 停止した, busy: 処理待ちのメッセージが多く受け付けられなかった
+  status: 'success' | 'progress' | 'partial' | 'error' | 'cancelled' | 'busy'
   message: string
   images?: string[]
 }
 
+// 新しい会話を発行した場合に届く
+socket.on('session', ({ sessionId }: { sessionId: string }) => {
+  localStorage.setItem('sessionId', sessionId)
+})
+
 socket.on('connect', () => {
   console.log('connected GEMINI AI')
 })
@@ -20,6 +33,11 @@ export const sendMessage = (message: string, images: string[]) => {
   })
 }
 
+// 処理中・処理待ちのメッセージを停止する
+export const cancelMessage = () => {
+  socket.emit('cancel')
+}
+
 export const getResponse = (f: (m: ResponseMessage) => void) => {
   socket.on('message', (message: ResponseMessage) => {
     f(message)
@@ -0,0 +1,222 @@
+"""
+似た質問への回答を再利用するキャッシュ
+質問を文字n-gramのハッシュでベクトル化し、保存済みの質問とのコサイン類似度がしきい値以上で、期限内の回答を返す
+類似度が高くても、数字・漢字・カタカナ・英字など内容を表す文字が異なる質問(2023年と2024年、降順と昇順など)は別の質問とみなす
+時刻など、呼び出すたびに結果が変わるtool(ToolSpec.cacheable=False)を使用した回答は保存しない
+
+usage
+---
+>>> from answer_cache import answer_cache
+>>> answer_cache.put('本日のドル円レートを教えて', 'gemini-pro', '1ドル=150円です。')
+>>> answer_cache.get('本日の ドル円レートを教えて！', 'gemini-pro')
+'1ドル=150円です。'
+"""
+import difflib
+import re
+import threading
+import time
+import unicodedata
+import zlib
+
+from config import (
+    ANSWER_CACHE, ANSWER_CACHE_TTL, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_DIM
+)
+
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # numpyはキャッシュを使用する(ANSWER_CACHE=1の)場合のみ、最初に質問をベクトル化する時にimportする
+    import numpy as np
+
+
+# 空白と記号(句読点・疑問符など)は、質問の違いとみなさない
+_IGNORE_RE = re.compile(r'[\s!-/:-@\[-`{-~、。・「」『』（）！？]+')
+# 助詞・語尾(ひらがな)だけの違いは、言い回しの違いとみなす
+_PHRASING_RE = re.compile(r'[ぁ-ゖー]*')
+# ただし、否定の語尾は意味が変わる
+_NEGATION_RE = re.compile(r'な[いかく]|ません')
+# 類似度がしきい値以上の候補を、いくつまで確認するか
+_MAX_CANDIDATES = 5
+
+
+def same_content(a: str, b: str) -> bool:
+    """
+    正規化した二つの質問の違いが、言い回し(ひらがなの助詞・語尾)だけかどうか
+    数字・漢字・カタカナ・英字や否定の語尾が一文字でも異なる場合はFalse
+    """
+    if a == b:
+        return True
+    if _NEGATION_RE.findall(a) != _NEGATION_RE.findall(b):
+        return False
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            continue
+        for diff in (a[i1:i2], b[j1:j2]):
+            if not _PHRASING_RE.fullmatch(diff):
+                return False
+    return True
+
+
+class HashingVectorizer():
+    """
+    文字n-gramをハッシュで次元に割り当て、L2正規化したベクトルにする
+    分かち書きをしないため、日本語の質問もそのまま扱える
+    """
+
+    def __init__(self, dim: int = ANSWER_CACHE_DIM, ngram_range: tuple = (2, 3)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return _IGNORE_RE.sub('', unicodedata.normalize('NFKC', text)).lower()
+
+    def transform(self, text: str) -> 'np.ndarray':
+        import numpy as np
+
+        text = self.normalize(text)
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            for i in range(max(len(text) - n + 1, 1)):
+                # hash()はプロセスごとに値が変わるため、crc32を使用する
+                h = zlib.crc32(text[i:i + n].encode('utf-8'))
+                # 衝突による偏りを打ち消すため、符号もハッシュから決める
+                vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+
+
+class _AnswerIndex():
+    """
+    質問のベクトルを行列に保持し、一回の行列積で全件との類似度を求める
+    上限を超えた場合は、古いエントリから上書きする
+    """
+
+    def __init__(self, dim: int, max_entries: int):
+        import numpy as np
+
+        self.max_entries = max_entries
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.expires_at = np.zeros(0, dtype=np.float64)
+        # 正規化した質問(内容の違いの確認用)
+        self.questions: list[str] = []
+        self.answers: list[str] = []
+        self._next = 0
+
+    def add(self, vector: 'np.ndarray', question: str, answer: str, expires_at: float):
+        import numpy as np
+
+        if len(self.answers) < self.max_entries:
+            if len(self.answers) == len(self.vectors):
+                # 容量を倍に増やす
+                capacity = min(max(len(self.vectors) * 2, 16), self.max_entries)
+                self.vectors = np.resize(self.vectors, (capacity, self.vectors.shape[1]))
+                self.expires_at = np.resize(self.expires_at, capacity)
+            index = len(self.answers)
+            self.questions.append(question)
+            self.answers.append(answer)
+        else:
+            index = self._next
+            self._next = (self._next + 1) % self.max_entries
+            self.questions[index] = question
+            self.answers[index] = answer
+        self.vectors[index] = vector
+        self.expires_at[index] = expires_at
+
+    def search(self, vector: 'np.ndarray', now: float, threshold: float) -> list[tuple[str, str]]:
+        """
+        類似度がthreshold以上の期限内のエントリ(類似度の高い順に_MAX_CANDIDATES件まで)
+
+        Returns
+        ---
+        res: list[tuple[str, str]]
+            (正規化した質問, 回答)のリスト
+        """
+        import numpy as np
+
+        n = len(self.answers)
+        if n == 0:
+            return []
+        scores = self.vectors[:n] @ vector
+        # 期限切れのエントリは対象外にする
+        scores[self.expires_at[:n] <= now] = -1.0
+        candidates = np.flatnonzero(scores >= threshold)
+        candidates = candidates[np.argsort(-scores[candidates])][:_MAX_CANDIDATES]
+        return [(self.questions[i], self.answers[i]) for i in candidates]
+
+
+class AnswerCache():
+    def __init__(
+            self,
+            enabled: bool = ANSWER_CACHE,
+            ttl: float = ANSWER_CACHE_TTL,
+            threshold: float = ANSWER_CACHE_THRESHOLD,
+            max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+            dim: int = ANSWER_CACHE_DIM,
+    ):
+        """
+        Params
+        ---
+        enabled: bool
+            キャッシュを使用するかどうか
+        ttl: float
+            回答を再利用する期間(秒)
+        threshold: float
+            再利用する質問のコサイン類似度の下限
+        max_entries: int
+            モデルごとに保持する回答の数
+        dim: int
+            ベクトルの次元数
+        """
+        self.enabled = enabled
+        self.ttl = ttl
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.vectorizer = HashingVectorizer(dim=dim)
+        # モデルごとのインデックス
+        self._indexes: dict[str, _AnswerIndex] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, question: str, model_name: str) -> Optional[str]:
+        """
+        似た質問の期限内の回答(ない場合はNone)
+        """
+        if not self.enabled or not question.strip():
+            return None
+        vector = self.vectorizer.transform(question)
+        normalized = self.vectorizer.normalize(question)
+        with self._lock:
+            index = self._indexes.get(model_name)
+            candidates = index.search(vector, time.time(), self.threshold) if index else []
+            answer = next((a for q, a in candidates if same_content(q, normalized)), None)
+            hit = answer is not None
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return answer if hit else None
+
+    def put(self, question: str, model_name: str, answer: str):
+        if not self.enabled or not question.strip() or not answer:
+            return
+        vector = self.vectorizer.transform(question)
+        with self._lock:
+            index = self._indexes.get(model_name)
+            if index is None:
+                index = self._indexes[model_name] = _AnswerIndex(self.vectorizer.dim, self.max_entries)
+            index.add(vector, self.vectorizer.normalize(question), answer, time.time() + self.ttl)
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': sum(len(index.answers) for index in self._indexes.values()),
+        }
+
+
+# プロセス全体で共有する回答のキャッシュ
+answer_cache = AnswerCache()
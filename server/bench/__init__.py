@@ -0,0 +1,4 @@
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    index = min(int(len(values) * p / 100), len(values) - 1)
+    return values[index]
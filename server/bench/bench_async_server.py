@@ -0,0 +1,91 @@
+"""
+asyncサーバー(main_async.py)のベンチマーク
+スタブモデルに対して、N個のクライアントから同時にメッセージを送信し、
+回答が返るまでのレイテンシのp50/p99を計測する
+--toolsを指定した場合は、bench_scenariosと同じく google検索 → スクレイピング+Notion検索 → 回答 の順に応答し、
+toolは外部APIのスタンドイン(bench/fixture_server.py)に対して実行する
+
+usage
+---
+$ cd server
+$ python -m bench.bench_async_server --clients 200 --messages 3 --latency 0.5
+$ python -m bench.bench_async_server --clients 200 --messages 3 --latency 0.5 --tools --api-latency 0.2 --cold
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import socketio
+from aiohttp import web
+
+from bench import percentile
+from bench.bench_scenarios import setup
+
+
+async def run_client(url: str, messages: int, latencies: list[float]):
+    client = socketio.AsyncClient()
+    done = asyncio.Queue()
+
+    @client.on('message')
+    async def on_message(message: dict):
+        if message['status'] in ('success', 'error'):
+            await done.put(message)
+
+    await client.connect(url, transports=['websocket'])
+    try:
+        for i in range(messages):
+            start = time.perf_counter()
+            await client.emit('message', {'message': f'質問{i}'})
+            message = await done.get()
+            if message['status'] == 'error':
+                raise RuntimeError(message['message'])
+            latencies.append(time.perf_counter() - start)
+    finally:
+        await client.disconnect()
+
+
+async def main(args):
+    # スタンドインの起動・接続先の設定・スタブのインストール(--toolsを指定しない場合は回答のみ)
+    server = setup(args)
+    import main_async
+
+    runner = web.AppRunner(main_async.app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', args.port)
+    await site.start()
+
+    latencies: list[float] = []
+    url = f'http://127.0.0.1:{args.port}'
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[run_client(url, args.messages, latencies) for _ in range(args.clients)])
+    finally:
+        elapsed = time.perf_counter() - start
+        await runner.cleanup()
+        server.stop()
+
+    print(f'clients: {args.clients}, messages/client: {args.messages}, model latency: {args.latency}s, '
+          f'tools: {not args.no_tools}, api latency: {args.api_latency}s, cold: {args.cold}')
+    print(f'requests: {len(latencies)}, elapsed: {elapsed:.2f}s, throughput: {len(latencies) / elapsed:.1f} req/s')
+    print(f'p50: {percentile(latencies, 50) * 1000:.1f}ms')
+    print(f'p99: {percentile(latencies, 99) * 1000:.1f}ms')
+    print(f'mean: {statistics.mean(latencies) * 1000:.1f}ms')
+    if not args.no_tools:
+        print(f'upstream requests: {len(server.requests)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--tools', action='store_true', help='call google search, scraping and notion search per message')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='CSE / Notion / page latency (s)')
+    parser.add_argument('--cold', action='store_true', help='disable the scraping / search / answer caches')
+    parser.add_argument('--notion-rate', type=float, default=0,
+                        help='override NOTION_RATE_LIMIT (req/s, 0 keeps the configured limit)')
+    args = parser.parse_args()
+    args.no_tools = not args.tools
+    asyncio.run(main(args))
@@ -0,0 +1,200 @@
+"""
+オフラインのベンチマーク
+スタブモデルと外部APIのスタンドイン(bench/fixture_server.py)に対して、
+get_anything_chat・handle_message(main.py)・random_response(main_gradio.py)の
+スループット・レイテンシ・ピークメモリを計測する
+Vertex AI・Google CSE・Notionの認証情報は不要
+
+スタブモデルは、質問ごとに google検索 → スクレイピング+Notion検索 → 回答 の順に応答する(--no-toolsで回答のみ)
+シナリオごとに別のプロセスで実行し、ピークメモリを分けて計測する
+
+usage
+---
+$ cd server
+$ python -m bench.bench_scenarios --requests 100 --concurrency 10 --latency 0.2
+$ python -m bench.bench_scenarios --scenario chat --cold --api-latency 0.05
+$ python -m bench.bench_scenarios --notion-rate 1000  # Notionのレート制限(既定3req/s)を外す
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from bench import percentile
+from bench.fixture_server import FixtureServer
+
+SCENARIOS = ('chat', 'handle_message', 'random_response')
+
+
+def build_script(base_url: str) -> list:
+    """
+    一回の質問でスタブモデルが返すfunction_callの順番
+    """
+    return [
+        [{'name': 'get_default_serch', 'args': {'q': 'ドル円 レート'}}],
+        [
+            {'name': 'get_outer_html', 'args': {'q': f'{base_url}/pages/usdjpy'}},
+            {'name': 'notion_search', 'args': {'q': 'eメンテ'}},
+        ],
+    ]
+
+
+def setup(args) -> FixtureServer:
+    """
+    スタンドインのサーバーを起動し、configを読み込む前に接続先を環境変数に設定する
+    """
+    server = FixtureServer(latency=args.api_latency)
+    base_url = server.start()
+    os.environ.update({
+        'GOOGLE_CSE_ENDPOINT': f'{base_url}/cse',
+        'GOOGLE_CSE_ID': 'bench',
+        'GOOGLE_API_KEY': 'bench',
+        'NOTION_API_BASE': f'{base_url}/notion/v1',
+        'NOTION_API_KEY': 'bench',
+        'NOTION_MIRROR_PATH': '',
+        'SESSION_STORE': 'memory',
+    })
+    if args.notion_rate:
+        os.environ['NOTION_RATE_LIMIT'] = str(args.notion_rate)
+    if args.cold:
+        # 毎回外部へリクエストする(キャッシュを使用しない)
+        os.environ.update({'SCRAPING_CACHE_TTL': '0', 'GOOGLE_SEARCH_CACHE_TTL': '0', 'ANSWER_CACHE': '0'})
+    # stubはgemini・configを読み込むため、環境変数の設定後にimportする
+    from bench import stub
+    stub.install(latency=args.latency, script=[] if args.no_tools else build_script(base_url))
+    return server
+
+
+def make_request(scenario: str, history: int):
+    """
+    一回のリクエストを実行する関数を返す
+    """
+    if scenario == 'chat':
+        from gemini import GeminiAI
+
+        def _chat(i: int):
+            GeminiAI().get_anything_chat(f'本日のドル円レートを教えて({i})')
+        return _chat
+
+    if scenario == 'handle_message':
+        import main
+
+        # test_clientはスレッドごとに作成する(同じクライアントの受信キューを共有しない)
+        local = threading.local()
+
+        def _handle_message(i: int):
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = main.socketio.test_client(main.app)
+            client.emit('message', {'message': f'本日のドル円レートを教えて({i})'})
+            # メッセージはschedulerのスレッドで処理されるため、最後の応答が届くまで待つ
+            statuses = []
+            deadline = time.time() + 60
+            while not set(statuses) & {'success', 'error', 'busy', 'cancelled'} and time.time() < deadline:
+                statuses += [r['args']['status'] for r in client.get_received() if r['name'] == 'message']
+                time.sleep(0.001)
+            if 'success' not in statuses:
+                raise RuntimeError(f'handle_message failed: {statuses}')
+        return _handle_message
+
+    if scenario == 'random_response':
+        import main_gradio
+
+        past = [[f'質問{n}', f'回答{n}です。' * 20] for n in range(history)]
+
+        def _random_response(i: int):
+            res = main_gradio.random_response(f'本日のドル円レートを教えて({i})', past)
+            if res.startswith('エラーが発生しました。'):
+                raise RuntimeError(res)
+        return _random_response
+
+    raise ValueError(f'unknown scenario: {scenario}')
+
+
+def run_scenario(args) -> dict:
+    server = setup(args)
+    if args.tracemalloc:
+        tracemalloc.start()
+    request = make_request(args.scenario, args.history)
+    # 初回のimport・接続の確立は計測に含めない
+    request(-1)
+
+    latencies: list[float] = []
+
+    def _timed(i: int):
+        start = time.perf_counter()
+        request(i)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(_timed, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    server.stop()
+
+    return {
+        'scenario': args.scenario,
+        'requests': len(latencies),
+        'elapsed_s': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_traced_kb': tracemalloc.get_traced_memory()[1] // 1024 if args.tracemalloc else 0,
+        'upstream_requests': len(server.requests),
+    }
+
+
+def main(args):
+    scenarios = SCENARIOS if args.scenario == 'all' else (args.scenario,)
+    print(f'requests: {args.requests}, concurrency: {args.concurrency}, model latency: {args.latency}s, '
+          f'api latency: {args.api_latency}s, tools: {not args.no_tools}, cold: {args.cold}, '
+          f'notion rate: {args.notion_rate or "config"}')
+    print(f'{"scenario":<16}{"req/s":>8}{"p50(ms)":>10}{"p90(ms)":>10}{"p99(ms)":>10}{"mean(ms)":>10}'
+          f'{"peak RSS(MB)":>14}{"upstream":>10}')
+    for scenario in scenarios:
+        command = [
+            sys.executable, '-m', 'bench.bench_scenarios', '--run', '--scenario', scenario,
+            '--requests', str(args.requests), '--concurrency', str(args.concurrency),
+            '--latency', str(args.latency), '--api-latency', str(args.api_latency), '--history', str(args.history),
+            '--notion-rate', str(args.notion_rate),
+        ]
+        command += [flag for flag, on in (('--no-tools', args.no_tools), ('--cold', args.cold),
+                                          ('--tracemalloc', args.tracemalloc)) if on]
+        res = subprocess.run(command, check=True, capture_output=True, text=True)
+        r = json.loads(res.stdout.strip().splitlines()[-1])
+        print(f'{r["scenario"]:<16}{r["throughput"]:>8.1f}{r["p50_ms"]:>10.1f}{r["p90_ms"]:>10.1f}'
+              f'{r["p99_ms"]:>10.1f}{r["mean_ms"]:>10.1f}{r["peak_rss_kb"] / 1024:>14.1f}{r["upstream_requests"]:>10}')
+        if args.tracemalloc:
+            print(f'{"":<16}peak traced: {r["peak_traced_kb"] / 1024:.1f}MB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', choices=SCENARIOS + ('all',), default='all')
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.2, help='model latency per round (s)')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='CSE / Notion / page latency (s)')
+    parser.add_argument('--history', type=int, default=10, help='past turns sent to random_response')
+    parser.add_argument('--notion-rate', type=float, default=0,
+                        help='override NOTION_RATE_LIMIT (req/s, 0 keeps the configured limit)')
+    parser.add_argument('--no-tools', action='store_true', help='answer without function calls')
+    parser.add_argument('--cold', action='store_true', help='disable the scraping / search / answer caches')
+    parser.add_argument('--tracemalloc', action='store_true', help='also report the peak of Python allocations')
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_scenario(args)))
+    else:
+        main(args)
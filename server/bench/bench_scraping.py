@@ -0,0 +1,119 @@
+"""
+get_outer_htmlの整形処理のベンチマーク
+保存済みのページ(コーパス)に対して、BeautifulSoupによる整形(soup)と
+逐次的な整形(stream)の処理時間とピークRSSを比較する
+ピークRSSを正しく計測するため、実装ごとに別プロセスで実行する
+
+usage
+---
+$ cd server
+# ページをコーパスに保存する
+$ python -m bench.bench_scraping --corpus bench/corpus --save https://example.com/a https://example.com/b
+# ベンチマークを実行する
+$ python -m bench.bench_scraping --corpus bench/corpus
+"""
+import argparse
+import hashlib
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+IMPLS = ['soup', 'stream']
+CHUNK_SIZE = 16 * 1024
+
+
+def load_corpus(corpus: str) -> list[str]:
+    paths = [
+        os.path.join(corpus, name) for name in sorted(os.listdir(corpus))
+        if name.endswith(('.html', '.htm'))
+    ]
+    if not paths:
+        raise SystemExit(f'{corpus}にページがありません。--saveで保存してください。')
+    return paths
+
+
+def save_pages(corpus: str, urls: list[str]):
+    import requests
+
+    os.makedirs(corpus, exist_ok=True)
+    for url in urls:
+        response = requests.get(url, timeout=30)
+        response.raise_for_status()
+        path = os.path.join(corpus, hashlib.sha256(url.encode('utf-8')).hexdigest()[:16] + '.html')
+        with open(path, 'wb') as file:
+            file.write(response.content)
+        print(f'{url} -> {path} ({len(response.content)} bytes)')
+
+
+def run_impl(impl: str, paths: list[str], repeat: int) -> dict:
+    """
+    一つの実装でコーパス全体を整形する(子プロセスで実行される)
+    """
+    from utils.scraping import _clean_html, _clean_html_stream
+
+    def read_chunks(path: str):
+        with open(path, 'rb') as file:
+            while True:
+                chunk = file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    times = []
+    output_chars = 0
+    for _ in range(repeat):
+        for path in paths:
+            start = time.perf_counter()
+            if impl == 'soup':
+                with open(path, 'rb') as file:
+                    outer_html = _clean_html(file.read())
+            else:
+                outer_html = _clean_html_stream(read_chunks(path))
+            times.append(time.perf_counter() - start)
+            output_chars += len(outer_html)
+
+    return {
+        'impl': impl,
+        'total_s': sum(times),
+        'median_ms': statistics.median(times) * 1000,
+        'max_ms': max(times) * 1000,
+        # linuxではKB単位
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'output_chars': output_chars // repeat,
+    }
+
+
+def main(corpus: str, repeat: int):
+    paths = load_corpus(corpus)
+    corpus_bytes = sum(os.path.getsize(path) for path in paths)
+    print(f'pages: {len(paths)}, corpus: {corpus_bytes / 1024 / 1024:.1f}MB, repeat: {repeat}')
+    print(f'{"impl":<8}{"total(s)":>10}{"median(ms)":>12}{"max(ms)":>10}{"peak RSS(MB)":>14}{"output chars":>14}')
+    for impl in IMPLS:
+        res = subprocess.run(
+            [sys.executable, '-m', 'bench.bench_scraping', '--corpus', corpus,
+             '--repeat', str(repeat), '--impl', impl],
+            check=True, capture_output=True, text=True
+        )
+        r = json.loads(res.stdout.strip().splitlines()[-1])
+        print(f'{r["impl"]:<8}{r["total_s"]:>10.2f}{r["median_ms"]:>12.1f}{r["max_ms"]:>10.1f}'
+              f'{r["peak_rss_kb"] / 1024:>14.1f}{r["output_chars"]:>14}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', default='bench/corpus')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--impl', choices=IMPLS)
+    parser.add_argument('--save', nargs='+', metavar='URL')
+    args = parser.parse_args()
+
+    if args.save:
+        save_pages(args.corpus, args.save)
+    elif args.impl:
+        print(json.dumps(run_impl(args.impl, load_corpus(args.corpus), args.repeat)))
+    else:
+        main(args.corpus, args.repeat)
@@ -0,0 +1,102 @@
+"""
+起動時間のベンチマーク
+モジュールごとのimport時間と、workerがソケットを受け付けられるまで・/readyが200を返すまでの時間を、
+毎回新しいプロセスで計測する(中央値)
+/readyまでの時間は、スタブモデルを使用する(Vertex AIの認証情報は不要)
+
+usage
+---
+$ cd server
+$ python -m bench.bench_startup --repeat 5
+$ python -m bench.bench_startup --importtime main --top 15
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+MODULES = ('config', 'utils', 'tools', 'gemini', 'main', 'main_async')
+
+# 子プロセスで実行する計測
+_IMPORT = '''
+import json, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - start}}))
+'''
+
+_READY = '''
+import json, os, time
+os.environ['WARMUP_ON_START'] = '0'
+os.environ['SESSION_STORE'] = 'memory'
+start = time.perf_counter()
+import main
+accept = time.perf_counter() - start
+# stubがgeminiを読み込むため、ウォームアップの内訳のgeminiはほぼ0になる(合計には含まれる)
+from bench import stub
+stub.install(latency=0)
+ready = main.warmup.wait(timeout=120)
+print(json.dumps({'accept': accept, 'ready': time.perf_counter() - start if ready else -1,
+                  'steps': main.warmup.seconds, 'error': main.warmup.error}))
+'''
+
+
+def run_python(code: str, *flags: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *flags, '-c', code], check=True, capture_output=True, text=True)
+
+
+def last_json(res: subprocess.CompletedProcess) -> dict:
+    return json.loads(res.stdout.strip().splitlines()[-1])
+
+
+def print_importtime(module: str, top: int):
+    """
+    python -X importtimeの結果から、累積時間の長いモジュールを表示する
+    """
+    res = run_python(f'import {module}', '-X', 'importtime')
+    rows = []
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, self_us, cumulative_us, name = [col.strip() for col in line.replace('import time:', '|').split('|')]
+        rows.append((int(cumulative_us), int(self_us), name))
+    rows.sort(reverse=True)
+    print(f'{"cumulative(ms)":>15}{"self(ms)":>10}  module')
+    for cumulative_us, self_us, name in rows[:top]:
+        print(f'{cumulative_us / 1000:>15.1f}{self_us / 1000:>10.1f}  {name}')
+
+
+def main(args):
+    print(f'repeat: {args.repeat}')
+    print(f'{"import":<24}{"median(ms)":>12}{"min(ms)":>10}')
+    for module in args.modules:
+        seconds = [last_json(run_python(_IMPORT.format(module=module)))['seconds'] for _ in range(args.repeat)]
+        print(f'{module:<24}{statistics.median(seconds) * 1000:>12.1f}{min(seconds) * 1000:>10.1f}')
+
+    results = [last_json(run_python(_READY)) for _ in range(args.repeat)]
+    errors = [r['error'] for r in results if r['error']]
+    if errors:
+        print(f'warmup failed: {errors[0]}')
+        return
+    print(f'{"main: accept sockets":<24}{statistics.median(r["accept"] for r in results) * 1000:>12.1f}'
+          f'{min(r["accept"] for r in results) * 1000:>10.1f}')
+    print(f'{"main: /ready":<24}{statistics.median(r["ready"] for r in results) * 1000:>12.1f}'
+          f'{min(r["ready"] for r in results) * 1000:>10.1f}')
+    for step in results[0]['steps']:
+        seconds = [r['steps'][step] for r in results]
+        print(f'{"  warmup: " + step:<24}{statistics.median(seconds) * 1000:>12.1f}{min(seconds) * 1000:>10.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--modules', nargs='+', default=list(MODULES))
+    parser.add_argument('--importtime', metavar='MODULE', help='show the slowest imports of MODULE instead')
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.importtime:
+        print_importtime(args.importtime, args.top)
+    else:
+        main(args)
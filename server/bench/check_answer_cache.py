@@ -0,0 +1,51 @@
+"""
+AnswerCacheの動作確認
+言い回しだけが異なる質問は回答を再利用し、類似度がしきい値以上でも内容が異なる質問(年・昇順と降順・否定など)は再利用しないことを確認する
+
+usage
+---
+$ cd server
+$ python -m bench.check_answer_cache
+"""
+from answer_cache import AnswerCache
+from bench.check_notion_mirror import check
+
+MODEL_NAME = 'gemini-pro'
+
+# (保存する質問, 再利用する質問)
+SAME_PAIRS = [
+    ('本日のドル円レートを教えて', '本日の ドル円レートを教えて！'),
+    ('本日のドル円の為替レートと前日からの変化を教えて', '本日のドル円の為替レートと前日からの変化を教えてください'),
+]
+
+# (保存する質問, 再利用しない質問) 類似度はしきい値以上
+DIFFERENT_PAIRS = [
+    ('2023年の日本の名目GDPと実質GDPの成長率を教えてください', '2024年の日本の名目GDPと実質GDPの成長率を教えてください'),
+    ('先月の店舗ごとの売上を集計して、金額の降順で一覧にしてください', '先月の店舗ごとの売上を集計して、金額の昇順で一覧にしてください'),
+    ('eメンテの管理画面に社外のネットワークからログインできますか', 'eメンテの管理画面に社外のネットワークからログインできませんか'),
+]
+
+
+def main():
+    for cached, query in SAME_PAIRS:
+        cache = AnswerCache(enabled=True)
+        cache.put(cached, MODEL_NAME, 'answer')
+        check(cache.get(query, MODEL_NAME) == 'answer', f'言い回しの違いは再利用する: {query}')
+
+    for cached, query in DIFFERENT_PAIRS:
+        cache = AnswerCache(enabled=True)
+        score = float(cache.vectorizer.transform(cached) @ cache.vectorizer.transform(query))
+        check(score >= cache.threshold, f'類似度がしきい値以上({score:.3f})')
+        cache.put(cached, MODEL_NAME, 'answer')
+        check(cache.get(query, MODEL_NAME) is None, f'内容の違いは再利用しない: {query}')
+
+    cache = AnswerCache(enabled=True)
+    cached, query = DIFFERENT_PAIRS[0]
+    cache.put(cached, MODEL_NAME, 'answer 2023')
+    cache.put(query, MODEL_NAME, 'answer 2024')
+    check(cache.get(query, MODEL_NAME) == 'answer 2024', '類似した候補が複数ある場合は、内容が同じ質問の回答を返す')
+    check(cache.get(cached, MODEL_NAME) == 'answer 2023', '類似した候補が複数ある場合は、内容が同じ質問の回答を返す(逆)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+NotionMirrorの動作確認
+記録したNotion APIのレスポンス(bench/fixtures/notion_api.json)を返すローカルサーバーに対して、
+同期・差分同期・全文検索・ページング・削除されたページの突き合わせを確認する
+
+usage
+---
+$ cd server
+$ python -m bench.check_notion_mirror
+"""
+import os
+import tempfile
+
+from bench.fixture_server import FixtureServer
+
+
+def check(condition: bool, message: str):
+    if not condition:
+        raise SystemExit(f'NG: {message}')
+    print(f'OK: {message}')
+
+
+def main():
+    server = FixtureServer()
+    base_url = server.start()
+    # configは読み込み時に環境変数を参照するため、utilsより先に設定する
+    os.environ['NOTION_API_BASE'] = f'{base_url}/notion/v1'
+    os.environ['NOTION_API_KEY'] = 'fixture'
+    from utils.notion import NotionMirror, NotionSearch
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            mirror = NotionMirror(os.path.join(tmp, 'notion_mirror.db'))
+            check(not mirror.is_ready(), '同期前はis_ready()がFalse')
+
+            updated = mirror.sync()
+            full_sync_requests = len(server.requests)
+            check(updated == len(server.notion_pages), f'初回の同期で全ページを取得する({updated}件)')
+            check(mirror.is_ready(), '同期後はis_ready()がTrue')
+
+            res = mirror.search('eメンテ')
+            check(isinstance(res, NotionSearch), 'NotionSearchを返す')
+            check(set(res.to_dict().keys()) == {'result', 'has_more', 'next_cursor'}, 'to_dict()の形式が同じ')
+            check(res.result and res.result[0].title == 'eメンテ 管理画面ログイン手順', 'タイトルに一致したページが先頭になる')
+            check('社内VPN' in res.result[0].content, '本文を含む')
+            check('Slackで申請' in res.result[0].content, 'トグルの中の子ブロックも本文に含む')
+            check(len(res.result) == 2, '本文のみに一致したページも返す')
+
+            res = mirror.search('SEAMO')
+            check(res.result and res.result[0].url == 'https://seamo.example.com/', 'URLを持つ行を返す')
+
+            res = mirror.search('省エ')
+            check(res.result and res.result[0].title == '省エネ診断サービス 概要', '2文字のクエリでも検索できる')
+
+            page1 = mirror.search('eメンテ', page_size=1)
+            check(page1.has_more and page1.next_cursor == '1', '次のページがある場合はnext_cursorを返す')
+            page2 = mirror.search('eメンテ', start_cursor=page1.next_cursor, page_size=1)
+            check(
+                not page2.has_more and page2.result[0].pageId != page1.result[0].pageId,
+                'next_cursorで次のページを取得する'
+            )
+
+            requests_before = len(server.requests)
+            server.edit_notion_page(
+                '1a2b3c4d-0002-4000-8000-000000000002', '2024-02-01T00:00:00.000Z', title='Pureha リリースノート v2.4'
+            )
+            updated = mirror.sync()
+            check(updated <= 2, f'差分同期では編集されたページのみ取得する({updated}件)')
+            check(len(server.requests) - requests_before < full_sync_requests, '差分同期のリクエスト数が少ない')
+            check(mirror.search('v2.4').result[0].title == 'Pureha リリースノート v2.4', '編集が反映される')
+
+            server.edit_notion_page('1a2b3c4d-0005-4000-8000-000000000005', '2024-02-02T00:00:00.000Z', archived=True)
+            mirror.sync()
+            check(not mirror.search('議事録').result, 'アーカイブされたページは削除される')
+
+            server.remove_notion_page('1a2b3c4d-0003-4000-8000-000000000003')
+            mirror.sync()
+            check(mirror.search('省エネ').result, '差分同期では、消えたページに気付かない')
+            requests_before = len(server.requests)
+            mirror.sync(reconcile=True)
+            check(not mirror.search('省エネ').result, 'reconcileで、一覧から消えたページは削除される')
+            check(mirror.search('eメンテ').result, 'reconcileで、一覧にあるページは残る')
+            check(
+                not any('/blocks/' in request for request in server.requests[requests_before:]),
+                'reconcileでは、同期済みのページの本文を取得し直さない'
+            )
+            check(not mirror.reconcile_due(3600), 'reconcileの直後はreconcile_due()がFalse')
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
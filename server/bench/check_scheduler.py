@@ -0,0 +1,68 @@
+"""
+Schedulerの動作確認
+会話ごとの順番・同時実行数の上限・ラウンドロビン・処理待ちの上限・cancelを確認する
+
+usage
+---
+$ cd server
+$ python -m bench.check_scheduler
+"""
+import threading
+import time
+from concurrent.futures import CancelledError
+
+from bench.check_notion_mirror import check
+from scheduler import Scheduler, QueueFullError
+
+
+def blocking_job(started: list, release: threading.Event, name: str):
+    def _job(cancel: threading.Event):
+        started.append(name)
+        # releaseかcancelまで待つ
+        while not release.is_set() and not cancel.is_set():
+            time.sleep(0.001)
+        return 'cancelled' if cancel.is_set() else name
+    return _job
+
+
+def main():
+    release = threading.Event()
+    started: list[str] = []
+    scheduler = Scheduler(max_concurrency=2, max_queue_per_session=2, max_queue=10)
+
+    a1 = scheduler.submit('A', blocking_job(started, release, 'a1'))
+    a2 = scheduler.submit('A', blocking_job(started, release, 'a2'))
+    b1 = scheduler.submit('B', blocking_job(started, release, 'b1'))
+    c1 = scheduler.submit('C', blocking_job(started, release, 'c1'))
+    time.sleep(0.05)
+    check(sorted(started) == ['a1', 'b1'], f'同じ会話は一件ずつ、全体はmax_concurrencyまで処理する({started})')
+
+    scheduler.submit('A', blocking_job(started, release, 'a3'))
+    try:
+        scheduler.submit('A', blocking_job(started, release, 'a4'))
+        check(False, '処理待ちの上限を超えたメッセージは受け付けない')
+    except QueueFullError:
+        check(True, '処理待ちの上限を超えたメッセージは受け付けない')
+
+    # 処理中(a1)と処理待ち(a2, a3)がある会話のcancel
+    count = scheduler.cancel('A')
+    check(count == 3, f'処理中と処理待ちのメッセージを全て取り消す({count}件)')
+    check(a1.future.result(timeout=1) == 'cancelled', '処理中のメッセージにcancelが通知される')
+    try:
+        a2.future.result(timeout=1)
+        check(False, '処理待ちのメッセージのfutureは取り消される')
+    except CancelledError:
+        check(True, '処理待ちのメッセージのfutureは取り消される')
+
+    time.sleep(0.05)
+    check('c1' in started and 'a2' not in started, f'空いた枠で他の会話の順番が来る({started})')
+    release.set()
+    check(b1.future.result(timeout=1) == 'b1' and c1.future.result(timeout=1) == 'c1', '残りのメッセージは完了する')
+    time.sleep(0.05)
+    stats = scheduler.stats()
+    check(stats['queued'] == 0 and stats['running'] == 0 and stats['waiting_sessions'] == 0,
+          f'取り消し後に処理待ちが残らない({stats})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+ストリーミングの動作確認
+スタブモデルでtoolを一回呼び出す質問を送り、toolを渡したラウンドでも回答の最初のチャンクがラウンドの完了前に届くこと、
+function_callと同じ応答のテキスト(途中経過)はyieldしないことを確認する
+
+usage
+---
+$ cd server
+$ python -m bench.check_streaming
+"""
+import asyncio
+import functools
+import time
+
+from bench import stub
+from bench.check_notion_mirror import check
+
+LATENCY = 1.0
+SCRIPT = [[{'name': 'get_now_date_at_ISO', 'args': {}}]]
+THOUGHT = '途中経過'
+
+
+def timed(chunks) -> tuple[list[str], float, float]:
+    """
+    Returns
+    ---
+    chunks: list[str]
+    first: float
+        最初のチャンクが届くまでの秒数
+    total: float
+        全てのチャンクが届くまでの秒数
+    """
+    start = time.perf_counter()
+    res = []
+    first = 0.0
+    for chunk in chunks:
+        if not res:
+            first = time.perf_counter() - start
+        res.append(chunk)
+    return res, first, time.perf_counter() - start
+
+
+async def timed_async(chunks) -> tuple[list[str], float, float]:
+    start = time.perf_counter()
+    res = []
+    first = 0.0
+    async for chunk in chunks:
+        if not res:
+            first = time.perf_counter() - start
+        res.append(chunk)
+    return res, first, time.perf_counter() - start
+
+
+def check_result(name: str, chunks: list[str], first: float, total: float):
+    # toolのラウンド(LATENCY秒)の後、回答のラウンドのチャンクはLATENCY秒かけて届く
+    check(len(chunks) > 1, f'{name}: 回答を複数のチャンクでyieldする({len(chunks)}件)')
+    check(first < total - LATENCY / 2, f'{name}: 最初のチャンクが回答のラウンドの完了前に届く({first:.2f}s / {total:.2f}s)')
+    check(THOUGHT not in ''.join(chunks), f'{name}: function_callと同じ応答のテキストはyieldしない')
+
+
+def main():
+    # function_callの前にテキストを含む応答を返す
+    stub.function_call_response = functools.partial(stub.function_call_response, text=THOUGHT)
+    stub.install(latency=LATENCY, script=SCRIPT)
+    from gemini import GeminiAI
+
+    check_result('get_anything_chat_stream', *timed(GeminiAI().get_anything_chat_stream('いま何時？')))
+    check_result(
+        'get_anything_chat_stream_async',
+        *asyncio.run(timed_async(GeminiAI().get_anything_chat_stream_async('いま何時？')))
+    )
+
+
+if __name__ == '__main__':
+    main()
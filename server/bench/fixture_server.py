@@ -0,0 +1,168 @@
+"""
+外部APIのローカルのスタンドイン
+bench/fixturesに記録したレスポンスを返す
+
+- GET  /cse: Google Custom Search(google_cse.json、linkは/pages/*)
+- GET  /pages/{name}: スクレイピング対象のページ(pages/article.html)
+- POST /notion/v1/search, GET /notion/v1/blocks/{id}/children: Notion API(notion_api.json)
+
+usage
+---
+>>> server = FixtureServer(latency=0.05)
+>>> base_url = server.start()
+>>> # GOOGLE_CSE_ENDPOINT = f'{base_url}/cse'
+>>> # NOTION_API_BASE = f'{base_url}/notion/v1'
+>>> server.stop()
+"""
+import copy
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class FixtureServer():
+    def __init__(self, fixtures_dir: str = FIXTURES_DIR, latency: float = 0.0):
+        """
+        Params
+        ---
+        latency: float
+            レスポンスを返すまでの待ち時間(秒)
+        """
+        self.latency = latency
+        with open(os.path.join(fixtures_dir, 'google_cse.json'), 'r', encoding='utf-8') as file:
+            self.google_cse = file.read()
+        with open(os.path.join(fixtures_dir, 'pages', 'article.html'), 'r', encoding='utf-8') as file:
+            self.page_html = file.read()
+        with open(os.path.join(fixtures_dir, 'notion_api.json'), 'r', encoding='utf-8') as file:
+            notion = json.load(file)
+        self.notion_pages: list[dict] = notion['pages']
+        self.notion_blocks: dict[str, list[dict]] = notion['blocks']
+        self.requests: list[str] = []
+        self._lock = threading.Lock()
+        self._server = None
+        self.base_url = ''
+
+    def start(self) -> str:
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, data: bytes, content_type: str):
+                if fixture.latency:
+                    time.sleep(fixture.latency)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_json(self, status: int, body: dict):
+                self._send(status, json.dumps(body, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8')
+
+            def do_GET(self):
+                fixture._record(f'GET {self.path}')
+                url = urlparse(self.path)
+                if url.path == '/cse':
+                    self._send(200, fixture.google_cse.replace('{base_url}', fixture.base_url).encode('utf-8'),
+                               'application/json; charset=UTF-8')
+                    return
+                if url.path.startswith('/pages/'):
+                    html = fixture.page_html.replace('{title}', url.path[len('/pages/'):])
+                    self._send(200, html.encode('utf-8'), 'text/html; charset=utf-8')
+                    return
+                status, body = fixture.handle_get(self.path)
+                self._send_json(status, body)
+
+            def do_POST(self):
+                fixture._record(f'POST {self.path}')
+                length = int(self.headers.get('Content-Length', '0'))
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                status, body = fixture.handle_post(self.path, payload)
+                self._send_json(status, body)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f'http://127.0.0.1:{self._server.server_address[1]}'
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _record(self, request: str):
+        with self._lock:
+            self.requests.append(request)
+
+    @staticmethod
+    def _paginate(items: list, start_cursor: str, page_size: int) -> dict:
+        start = int(start_cursor) if start_cursor else 0
+        end = start + page_size
+        return {
+            'object': 'list',
+            'results': items[start:end],
+            'has_more': end < len(items),
+            'next_cursor': str(end) if end < len(items) else None,
+        }
+
+    @staticmethod
+    def _title(page: dict) -> str:
+        for prop in page['properties'].values():
+            if prop['type'] == 'title':
+                return ''.join(t['plain_text'] for t in prop['title'])
+        return ''
+
+    def handle_post(self, path: str, payload: dict) -> tuple[int, dict]:
+        if urlparse(path).path == '/notion/v1/search':
+            query = payload.get('query', '')
+            with self._lock:
+                pages = [copy.deepcopy(page) for page in self.notion_pages if query in self._title(page)]
+            pages.sort(key=lambda page: page['last_edited_time'], reverse=True)
+            return 200, self._paginate(pages, payload.get('start_cursor', ''), payload.get('page_size', 100))
+        return 404, {'object': 'error', 'status': 404}
+
+    def handle_get(self, path: str) -> tuple[int, dict]:
+        url = urlparse(path)
+        match = re.fullmatch(r'/notion/v1/blocks/([\w-]+)/children', url.path)
+        if match:
+            params = parse_qs(url.query)
+            with self._lock:
+                blocks = copy.deepcopy(self.notion_blocks.get(match.group(1)))
+            if blocks is None:
+                return 404, {'object': 'error', 'status': 404, 'code': 'object_not_found'}
+            return 200, self._paginate(
+                blocks,
+                params.get('start_cursor', [''])[0],
+                int(params.get('page_size', ['100'])[0])
+            )
+        return 404, {'object': 'error', 'status': 404}
+
+    def edit_notion_page(self, page_id: str, last_edited_time: str, title: str = '', archived: bool = False):
+        """
+        ページの編集・アーカイブを再現する(差分同期の確認用)
+        """
+        with self._lock:
+            for page in self.notion_pages:
+                if page['id'] != page_id:
+                    continue
+                page['last_edited_time'] = last_edited_time
+                page['archived'] = archived
+                if title:
+                    for prop in page['properties'].values():
+                        if prop['type'] == 'title':
+                            prop['title'] = [{'type': 'text', 'plain_text': title}]
+
+    def remove_notion_page(self, page_id: str):
+        """
+        ページの削除・共有解除を再現する(アーカイブされず、検索結果に現れなくなる)
+        """
+        with self._lock:
+            self.notion_pages = [page for page in self.notion_pages if page['id'] != page_id]
@@ -0,0 +1,184 @@
+"""
+複数workerでの動作確認
+スタブモデルのworkerを複数起動し、一つの会話のメッセージを毎回別のworkerへ送信して、
+会話の履歴が引き継がれているか(どのworkerでも同じ会話を処理できるか)を確認する
+sessionIdは最初の接続でworkerが発行したものを使用し、発行していないsessionIdでは他の会話に参加できないことも確認する
+workerは同じSQLiteファイルで会話を共有し、Socket.IOのイベントはメッセージキューで中継する
+(既定ではkombuのfilesystem transportをローカルのブローカーの代わりに使用する)
+
+usage
+---
+$ cd server
+$ python -m bench.multi_worker --workers 3 --conversations 20 --messages 4
+$ python -m bench.multi_worker --message-queue redis://localhost:6379/0
+"""
+import argparse
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import socketio
+
+
+def start_workers(workers: int, base_port: int, env: dict) -> list[subprocess.Popen]:
+    return [
+        subprocess.Popen(
+            [sys.executable, '-m', 'bench.worker', '--port', str(base_port + i)],
+            env=env
+        )
+        for i in range(workers)
+    ]
+
+
+def wait_ready(port: int, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/', timeout=1).ok:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f'worker(port={port})が起動しませんでした')
+
+
+def send(port: int, token: str, message: str, timeout=30.0) -> tuple[dict, str]:
+    """
+    Returns
+    ---
+    res: dict
+        最後の応答(success or error)
+    token: str
+        会話のsessionId(workerが新しい会話を発行した場合は、発行したsessionId)
+    """
+    client = socketio.Client()
+    answers = queue.Queue()
+    issued = []
+
+    @client.on('message')
+    def on_message(res: dict):
+        if res['status'] in ('success', 'error'):
+            answers.put(res)
+
+    @client.on('session')
+    def on_session(res: dict):
+        issued.append(res['sessionId'])
+
+    client.connect(f'http://127.0.0.1:{port}', auth={'sessionId': token}, transports=['websocket'])
+    try:
+        client.emit('message', {'message': message})
+        res = answers.get(timeout=timeout)
+        return res, issued[-1] if issued else token
+    finally:
+        client.disconnect()
+
+
+def run_conversation(index: int, ports: list[int], messages: int) -> list[str]:
+    """
+    i番目のメッセージを(index + i)番目のworkerへ送信する
+    スタブモデルは回答に履歴の件数を含めるため、2 * i件になっていれば会話が引き継がれている
+    """
+    # 最初のメッセージで、workerが発行したsessionIdを受け取る
+    token = ''
+    errors = []
+    for i in range(messages):
+        port = ports[(index + i) % len(ports)]
+        res, token = send(port, token, f'質問{i}')
+        expected = f'履歴: {2 * i}件'
+        if res['status'] != 'success' or expected not in res['message']:
+            errors.append(f'会話{index} メッセージ{i} (port={port}): {expected}を期待 → {res}')
+    return errors
+
+
+def check_forged_session(ports: list[int]) -> list[str]:
+    """
+    他の会話のsession_id(署名なし)・発行していないsessionIdでは、その会話に参加できず新しい会話になるか確認する
+    """
+    res, token = send(ports[0], '', '質問0')
+    session_id = token.partition('.')[0]
+    errors = []
+    for forged in (session_id, f'{session_id}.{"0" * 64}', str(uuid.uuid4())):
+        res, issued = send(ports[-1], forged, '質問1')
+        if issued == forged or '履歴: 0件' not in res['message']:
+            errors.append(f'発行していないsessionId({forged})で、会話に参加できました → {res}')
+    return errors
+
+
+def check_message_queue(ports: list[int]) -> list[str]:
+    """
+    worker0に接続したクライアントへ、worker1からemitしたメッセージが届くか確認する
+    """
+    if len(ports) < 2:
+        return []
+    listener = socketio.Client()
+    received = queue.Queue()
+    listener.on('message', received.put)
+    listener.connect(f'http://127.0.0.1:{ports[0]}', transports=['websocket'])
+    try:
+        requests.get(
+            f'http://127.0.0.1:{ports[1]}/bench/emit',
+            params={'sid': listener.get_sid(), 'message': 'message-queue'},
+            timeout=10
+        ).raise_for_status()
+        try:
+            received.get(timeout=10)
+        except queue.Empty:
+            return ['メッセージキュー経由のemitが、他のworkerのクライアントに届きませんでした']
+        return []
+    finally:
+        listener.disconnect()
+
+
+def main(workers: int, conversations: int, messages: int, base_port: int, message_queue: str):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            SESSION_STORE='sqlite',
+            SESSION_DB_PATH=os.path.join(tmp, 'sessions.db'),
+            SOCKETIO_MESSAGE_QUEUE=message_queue,
+            SOCKETIO_MESSAGE_QUEUE_DIR=os.path.join(tmp, 'queue'),
+            # 他のworkerが発行したsessionIdを検証できるよう、全workerで同じ鍵を使用する
+            SECRET_KEY=uuid.uuid4().hex,
+        )
+        ports = [base_port + i for i in range(workers)]
+        processes = start_workers(workers, base_port, env)
+        try:
+            for port in ports:
+                wait_ready(port)
+
+            start = time.perf_counter()
+            errors = check_message_queue(ports) + check_forged_session(ports)
+            with ThreadPoolExecutor(max_workers=conversations) as executor:
+                for res in executor.map(lambda i: run_conversation(i, ports, messages), range(conversations)):
+                    errors.extend(res)
+            elapsed = time.perf_counter() - start
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+
+    print(f'workers: {workers}, conversations: {conversations}, messages/conversation: {messages}, '
+          f'elapsed: {elapsed:.2f}s')
+    for error in errors:
+        print(error)
+    if errors:
+        raise SystemExit(f'NG: {len(errors)}件の不整合')
+    print('OK: 全ての会話がworkerをまたいで引き継がれました')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--conversations', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=4)
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--message-queue', default='filesystem://')
+    args = parser.parse_args()
+    main(args.workers, args.conversations, args.messages, args.port, args.message_queue)
@@ -0,0 +1,203 @@
+"""
+ベンチマーク用のスタブモデル
+Vertex AIへ接続せずに、GeminiAIの処理を計測するために使用する
+
+scriptを指定した場合は、toolを渡されたラウンドごとにscriptのfunction_callを順に返し、
+scriptを使い切った後(もしくはtoolなしのラウンド)で回答を返す
+
+usage
+---
+>>> from bench import stub
+>>> stub.install(latency=0.5, script=[
+...     [{'name': 'get_default_serch', 'args': {'q': 'ドル円'}}],
+...     [{'name': 'get_outer_html', 'args': {'q': 'https://example.com/'}}],
+... ])
+>>> from gemini import GeminiAI
+>>> GeminiAI().get_anything_chat('こんにちは')
+"""
+import asyncio
+import time
+from typing import Optional
+
+from vertexai.preview.generative_models import Content, GenerationResponse, Part
+
+import gemini
+import model_registry
+
+
+def text_response(text: str, prompt_token_count=10, total_token_count=20) -> GenerationResponse:
+    return GenerationResponse.from_dict({
+        "candidates": [
+            {
+                "content": {"role": "model", "parts": [{"text": text}]},
+                "finish_reason": "STOP",
+            }
+        ],
+        "usage_metadata": {
+            "prompt_token_count": prompt_token_count,
+            "total_token_count": total_token_count,
+        },
+    })
+
+
+def function_call_response(
+        function_calls: list[dict], prompt_token_count=10, total_token_count=20, text: str = ''
+) -> GenerationResponse:
+    """
+    Params
+    ---
+    function_calls: list[dict]
+        ex: [{'name': 'get_default_serch', 'args': {'q': 'ドル円'}}]
+    text: str
+        function_callの前に含めるテキスト(途中経過)
+    """
+    return GenerationResponse.from_dict({
+        "candidates": [
+            {
+                "content": {
+                    "role": "model",
+                    "parts": ([{"text": text}] if text else []) + [
+                        {"function_call": function_call} for function_call in function_calls
+                    ]
+                },
+                "finish_reason": "STOP",
+            }
+        ],
+        "usage_metadata": {
+            "prompt_token_count": prompt_token_count,
+            "total_token_count": total_token_count,
+        },
+    })
+
+
+def _is_function_response(content) -> bool:
+    return isinstance(content, list) and len(content) > 0 and all(
+        'function_response' in part.to_dict() for part in content
+    )
+
+
+class StubChatSession:
+    """
+    ChatSessionと同じインターフェースで、一定の待ち時間の後に固定の回答を返す
+    """
+
+    def __init__(self, history: Optional[list] = None, latency=0.5, chunk_num=5, script: Optional[list] = None):
+        self._history: list[Content] = list(history or [])
+        self.latency = latency
+        self.chunk_num = chunk_num
+        self.script = script or []
+        # 今回の質問で、scriptの何番目まで返したか
+        self._step = 0
+
+    @property
+    def history(self) -> list[Content]:
+        return self._history
+
+    def _answer(self) -> str:
+        return f'スタブの回答です。(履歴: {len(self._history)}件)'
+
+    def _chunks(self, answer: str) -> list[GenerationResponse]:
+        size = max(len(answer) // self.chunk_num, 1)
+        return [text_response(answer[i:i + size]) for i in range(0, len(answer), size)]
+
+    def _add_history(self, content, answer: str):
+        if isinstance(content, str):
+            content = [Part.from_text(content)]
+        self._history.append(Content(role='user', parts=content))
+        self._history.append(Content(role='model', parts=[Part.from_text(answer)]))
+
+    def _next_function_calls(self, content, tools) -> Optional[GenerationResponse]:
+        """
+        scriptの次のfunction_call(ない場合はNone)
+        """
+        if not _is_function_response(content):
+            self._step = 0
+        if not tools or self._step >= len(self.script):
+            return None
+        function_calls = self.script[self._step]
+        self._step += 1
+        response = function_call_response(function_calls)
+        if isinstance(content, str):
+            content = [Part.from_text(content)]
+        self._history.append(Content(role='user', parts=content))
+        self._history.append(response.candidates[0].content)
+        return response
+
+    def send_message(self, content, tools=None, stream=False, **kwargs):
+        response = self._next_function_calls(content, tools)
+        if response is not None:
+            time.sleep(self.latency)
+            return iter([response]) if stream else response
+
+        answer = self._answer()
+        self._add_history(content, answer)
+        if not stream:
+            time.sleep(self.latency)
+            return text_response(answer)
+
+        chunks = self._chunks(answer)
+
+        def _iter():
+            for chunk in chunks:
+                time.sleep(self.latency / len(chunks))
+                yield chunk
+        return _iter()
+
+    async def send_message_async(self, content, tools=None, stream=False, **kwargs):
+        response = self._next_function_calls(content, tools)
+        if response is not None:
+            await asyncio.sleep(self.latency)
+            if not stream:
+                return response
+
+            async def _function_calls():
+                yield response
+            return _function_calls()
+
+        answer = self._answer()
+        self._add_history(content, answer)
+        if not stream:
+            await asyncio.sleep(self.latency)
+            return text_response(answer)
+
+        chunks = self._chunks(answer)
+
+        async def _aiter():
+            for chunk in chunks:
+                await asyncio.sleep(self.latency / len(chunks))
+                yield chunk
+        return _aiter()
+
+
+class StubGenerativeModel:
+    latency = 0.5
+    script: list = []
+
+    def __init__(self, model_name: str, generation_config=None, safety_settings=None):
+        self.model_name = model_name
+
+    def start_chat(self, history: Optional[list] = None) -> StubChatSession:
+        return StubChatSession(history=history, latency=self.latency, script=self.script)
+
+    def generate_content(self, contents, **kwargs) -> GenerationResponse:
+        time.sleep(self.latency)
+        return text_response(f'スタブの要約です。({len(str(contents))}文字)')
+
+
+def install(latency=0.5, script: Optional[list] = None):
+    """
+    GenerativeModelをスタブに差し替え、Vertex AIの初期化を行わないようにする
+
+    Params
+    ---
+    latency: float
+        一回のメッセージの待ち時間(秒)
+    script: Optional[list]
+        ラウンドごとに返すfunction_callのリスト
+        ex: [[{'name': 'get_default_serch', 'args': {'q': 'ドル円'}}], [{'name': 'get_now_date_at_ISO', 'args': {}}]]
+    """
+    StubGenerativeModel.latency = latency
+    StubGenerativeModel.script = script or []
+    model_registry.GenerativeModel = StubGenerativeModel
+    model_registry.registry.clear()
+    gemini.init_vertexai = lambda: None
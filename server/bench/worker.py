@@ -0,0 +1,40 @@
+"""
+bench.multi_workerから起動されるworker
+スタブモデルに差し替えた上で、main.pyのサーバーを起動する
+
+usage
+---
+$ python -m bench.worker --port 5001
+"""
+import argparse
+
+from bench import stub
+
+
+def run(port: int, latency: float):
+    stub.install(latency=latency)
+    import main
+    from flask import request
+
+    # ベンチマークのクライアントはブラウザではないため、Originを制限しない
+    main.socketio.server.eio.cors_allowed_origins = '*'
+
+    @main.app.route('/bench/emit')
+    def bench_emit():
+        # 他のworkerに接続しているsidへ、メッセージキュー経由で届くかの確認に使用する
+        main.socketio.emit('message', {
+            'status': 'progress',
+            'role': 'model',
+            'message': request.args['message']
+        }, to=request.args['sid'])
+        return 'ok'
+
+    main.socketio.run(main.app, host='127.0.0.1', port=port, allow_unsafe_werkzeug=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parser.parse_args()
+    run(args.port, args.latency)
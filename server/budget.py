@@ -0,0 +1,91 @@
+"""
+一回の質問のfunction callingのループの予算
+toolを使用できるラウンド数・トークン数(usage_metadataのtotal_token_countの合計)・制限時間を管理し、
+どれかを使い切った場合は、toolを渡さずに回答させる
+同じtool・引数の呼び出しは、今回の質問で実行済み(実行中)の結果を再利用する
+
+usage
+---
+>>> budget = LoopBudget(max_rounds=5, max_tokens=40000, deadline=60)
+>>> budget.exhausted()
+''
+>>> budget.add_round(usage_metadata.total_token_count)
+>>> budget.remember(key, future)
+>>> budget.reuse(key)
+<Future at 0x... state=finished returned Part>
+"""
+import math
+import time
+from concurrent.futures import Future
+
+from config import LOOP_TOKEN_BUDGET, LOOP_DEADLINE
+
+from typing import Optional
+
+
+class LoopBudget():
+    def __init__(self, max_rounds: int, max_tokens: Optional[int] = None, deadline: Optional[float] = None):
+        """
+        Params
+        ---
+        max_rounds: int
+            toolを渡すラウンドの数
+        max_tokens: Optional[int]
+            使用するトークン数(0の場合は制限しない、省略した場合はLOOP_TOKEN_BUDGET)
+        deadline: Optional[float]
+            制限時間(秒、0の場合は制限しない、省略した場合はLOOP_DEADLINE)
+        """
+        self.max_rounds = max_rounds
+        self.max_tokens = LOOP_TOKEN_BUDGET if max_tokens is None else max_tokens
+        self.deadline = LOOP_DEADLINE if deadline is None else deadline
+        self.started_at = time.monotonic()
+        self.rounds = 0
+        self.tokens = 0
+        # 空の応答に対して、考え直させたかどうか(一度だけ)
+        self.retried = False
+        # toolを渡さずに回答させた理由(rounds, tokens, deadline)
+        self.forced = ''
+        # 再利用したtoolの呼び出しの数
+        self.reused = 0
+        # tool・引数のキー → 実行結果のFuture
+        self._results: dict[str, Future] = {}
+
+    def add_round(self, tokens: int):
+        self.rounds += 1
+        self.tokens += tokens
+
+    def remaining(self) -> float:
+        """
+        制限時間までの秒数(制限しない場合はinf)
+        """
+        if not self.deadline:
+            return math.inf
+        return max(self.started_at + self.deadline - time.monotonic(), 0.0)
+
+    def exhausted(self) -> str:
+        """
+        使い切った予算(rounds, tokens, deadline)、残っている場合は空文字
+        """
+        if self.rounds >= self.max_rounds:
+            return 'rounds'
+        if self.max_tokens and self.tokens >= self.max_tokens:
+            return 'tokens'
+        if self.remaining() <= 0:
+            return 'deadline'
+        return ''
+
+    def reuse(self, key: str) -> Optional[Future]:
+        future = self._results.get(key)
+        if future is not None:
+            self.reused += 1
+        return future
+
+    def remember(self, key: str, future: Future):
+        self._results[key] = future
+
+    def forget(self, key: str, future: Future):
+        """
+        タイムアウトで取り消した実行は再利用しない(次の同じ呼び出しは、改めて実行する)
+        """
+        if self._results.get(key) is future:
+            del self._results[key]
@@ -1,11 +1,17 @@
 import os
-from vertexai.preview import generative_models
+from urllib.parse import urlparse
 
 
 # google custom search engine id
 GOOGLE_CSE_ID = os.getenv("GOOGLE_CSE_ID", "")
 # google custom search engine api key
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "")
+# google custom search json api endpoint
+GOOGLE_CSE_ENDPOINT = os.getenv("GOOGLE_CSE_ENDPOINT", "https://www.googleapis.com/customsearch/v1")
+# google検索の結果をキャッシュする時間(秒、0の場合はキャッシュしない)
+GOOGLE_SEARCH_CACHE_TTL = float(os.getenv("GOOGLE_SEARCH_CACHE_TTL", "3600"))
+# google検索の結果のキャッシュの最大バイト数
+GOOGLE_SEARCH_CACHE_MAX_BYTES = int(os.getenv("GOOGLE_SEARCH_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
 
 # google cloud platform project id
 PROJECT_ID = os.getenv("PROJECT_ID", "")
@@ -14,12 +20,176 @@ REGION = os.getenv("REGION", "")
 
 # notino api key
 NOTION_API_KEY = os.getenv("NOTION_API_KEY", "")
+# notion api endpoint
+NOTION_API_BASE = os.getenv("NOTION_API_BASE", "https://api.notion.com/v1")
+# Notion APIへの一秒あたりのリクエスト数(Notionの制限は平均3回/秒)
+NOTION_RATE_LIMIT = float(os.getenv("NOTION_RATE_LIMIT", "3"))
+# ページの本文を同時に取得する数
+NOTION_MAX_CONCURRENCY = int(os.getenv("NOTION_MAX_CONCURRENCY", "3"))
+# 本文を取得する検索結果の件数(0の場合は全件)
+NOTION_CONTENT_TOP_K = int(os.getenv("NOTION_CONTENT_TOP_K", "0"))
+# ページの子ブロックを同時に取得する数
+NOTION_BLOCK_MAX_CONCURRENCY = int(os.getenv("NOTION_BLOCK_MAX_CONCURRENCY", "3"))
+# ページの本文の最大文字数(0の場合は制限なし)
+NOTION_PAGE_MAX_CHARS = int(os.getenv("NOTION_PAGE_MAX_CHARS", "20000"))
+# ページの本文の最大トークン数(0の場合は制限なし)
+NOTION_PAGE_MAX_TOKENS = int(os.getenv("NOTION_PAGE_MAX_TOKENS", "0"))
+# Notionのページを同期するローカルのミラーのパス(空の場合はNotion APIで検索する)
+NOTION_MIRROR_PATH = os.getenv("NOTION_MIRROR_PATH", "")
+# ミラーを同期する間隔(秒)
+NOTION_MIRROR_SYNC_INTERVAL = float(os.getenv("NOTION_MIRROR_SYNC_INTERVAL", "300"))
+# 全ページの一覧と突き合わせ、削除・共有解除されたページをミラーから取り除く間隔(秒、0の場合は行わない)
+NOTION_MIRROR_RECONCILE_INTERVAL = float(os.getenv("NOTION_MIRROR_RECONCILE_INTERVAL", "3600"))
+
+# 会話の履歴の最大トークン数、超える場合は古いturnを要約する(0の場合は要約しない)
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "8000"))
+# 要約せずに残す直近のturnの最大数
+CONTEXT_RECENT_TURNS = int(os.getenv("CONTEXT_RECENT_TURNS", "6"))
+# 要約に使用するモデル
+CONTEXT_SUMMARY_MODEL = os.getenv("CONTEXT_SUMMARY_MODEL", "gemini-pro")
+# 要約の最大トークン数
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "512"))
+# 要約のキャッシュの最大バイト数
+CONTEXT_SUMMARY_CACHE_MAX_BYTES = int(os.getenv("CONTEXT_SUMMARY_CACHE_MAX_BYTES", str(4 * 1024 * 1024)))
+
+# 似た質問への回答を再利用するかどうか
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "0") == "1"
+# 回答を再利用する期間(秒)
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "600"))
+# 回答を再利用する質問の類似度(コサイン類似度)の下限
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.9"))
+# モデルごとに保持する回答の数
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "10000"))
+# 質問のベクトルの次元数
+ANSWER_CACHE_DIM = int(os.getenv("ANSWER_CACHE_DIM", "2048"))
+
+# トークン数のメトリクスにユーザー(session_id)ごとのラベルを付けるかどうか
+# session_idはクライアントが決めるため、ラベルの種類が際限なく増える(信頼できるクライアントのみの環境で使用する)
+METRICS_USER_LABEL = os.getenv("METRICS_USER_LABEL", "0") == "1"
+# /metricsにホストごとのHTTPの統計を出すホスト(カンマ区切り)
+# スクレイピング先のホストはモデルが決めるため、全てのホストを出すとラベルの種類が際限なく増える
+METRICS_HTTP_HOSTS = [
+    host for host in os.getenv(
+        "METRICS_HTTP_HOSTS", f"{urlparse(NOTION_API_BASE).netloc},{urlparse(GOOGLE_CSE_ENDPOINT).netloc}"
+    ).split(",") if host
+]
+
+# 外部へのHTTPリクエストのコネクションプールを保持するホストの数
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "32"))
+# ホストごとに保持するコネクションの数
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "10"))
+# 接続エラー・429・5xxの場合のリトライ回数
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+# リトライの待ち時間の係数(秒)
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", "0.5"))
+# HTTPリクエストのタイムアウト(秒)
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+# 全体の同時HTTPリクエスト数
+HTTP_MAX_CONCURRENCY = int(os.getenv("HTTP_MAX_CONCURRENCY", "64"))
+# ホストごとの同時HTTPリクエスト数
+HTTP_MAX_PER_HOST = int(os.getenv("HTTP_MAX_PER_HOST", "8"))
+# 同時実行数の制限・統計を保持するホストの数(超えた場合は、リクエスト中でない古いホストから破棄する)
+HTTP_MAX_HOSTS = int(os.getenv("HTTP_MAX_HOSTS", "256"))
+
+# 一回のターンで並列に実行するtoolの最大数
+TOOL_MAX_WORKERS = int(os.getenv("TOOL_MAX_WORKERS", "8"))
+# asyncサーバーでtoolを実行するスレッドの数
+# 一つのプロセスで多数の会話のtoolを同時に待つため、TOOL_MAX_WORKERSとは別に大きくする(外部への同時リクエスト数はHTTP_MAX_CONCURRENCYで制限する)
+TOOL_ASYNC_MAX_WORKERS = int(os.getenv("TOOL_ASYNC_MAX_WORKERS", "256"))
+# toolごとのタイムアウト(秒)
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "30"))
+# 外部へのリクエストを行うtoolの結果を、セッションをまたいで再利用する期間(秒、0の場合は実行中の呼び出しの共有のみ)
+TOOL_MEMO_TTL = float(os.getenv("TOOL_MEMO_TTL", "0"))
+# 再利用するtoolの結果の最大数
+TOOL_MEMO_MAX_ENTRIES = int(os.getenv("TOOL_MEMO_MAX_ENTRIES", "256"))
+
+# toolの結果一つあたりの最大トークン数(0以下の場合は削減しない)
+TOOL_RESULT_TOKEN_BUDGET = int(os.getenv("TOOL_RESULT_TOKEN_BUDGET", "4000"))
+# toolの結果を削減する際のチャンクのトークン数
+TOOL_RESULT_CHUNK_TOKENS = int(os.getenv("TOOL_RESULT_CHUNK_TOKENS", "300"))
+
+# 一回の質問のfunction callingのループで使用するトークン数(usage_metadataのtotal_token_countの合計、0の場合は制限しない)
+# 超えた場合は、toolを渡さずに回答させる
+LOOP_TOKEN_BUDGET = int(os.getenv("LOOP_TOKEN_BUDGET", "40000"))
+# 一回の質問のfunction callingのループの制限時間(秒、0の場合は制限しない)
+# 過ぎた場合は、実行中のtoolを待たずに回答させる
+LOOP_DEADLINE = float(os.getenv("LOOP_DEADLINE", "60"))
+
+# 会話の保存先(memory, sqlite, redis)
+SESSION_STORE = os.getenv("SESSION_STORE", "sqlite")
+# SESSION_STORE=sqliteの場合のデータベースのパス
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "./sessions.db")
+# SESSION_STORE=redisの場合の接続先
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+# 最後のメッセージから、会話を破棄するまでの秒数
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))
+# メモリに保持する会話の最大数(超えた分は保存先から復元する)
+SESSION_MAX_LIVE = int(os.getenv("SESSION_MAX_LIVE", "256"))
+# サーバーが発行するsessionIdの署名・Flaskのセッションに使用する鍵
+# 複数のworkerで動かす場合は全workerで同じ値にする(空の場合はプロセスごとに生成し、再起動すると会話を再開できない)
+SECRET_KEY = os.getenv("SECRET_KEY", "")
+
+# 複数のworkerでSocket.IOのイベントを中継するメッセージキュー(空の場合は使用しない)
+# ex: redis://localhost:6379/0, filesystem://
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE", "")
+# SOCKETIO_MESSAGE_QUEUE=filesystem://の場合に、メッセージを受け渡すディレクトリ
+SOCKETIO_MESSAGE_QUEUE_DIR = os.getenv("SOCKETIO_MESSAGE_QUEUE_DIR", "./socketio_queue")
+
+# 同時に処理するメッセージ(モデルの呼び出し)の数の上限(worker内の全ユーザーの合計)
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "8"))
+# 一つの会話で、処理中のメッセージの後ろに待たせておけるメッセージの数(超えた場合は受け付けない)
+SCHEDULER_MAX_QUEUE_PER_SESSION = int(os.getenv("SCHEDULER_MAX_QUEUE_PER_SESSION", "2"))
+# worker全体で待たせておけるメッセージの数(超えた場合は受け付けない)
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "256"))
+
+# 起動時に、vertexai・認証情報・toolの宣言などをバックグラウンドで読み込むかどうか(完了は/readyで確認する)
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "1") == "1"
+
+# スクレイピング結果のキャッシュの有効期限(秒)
+SCRAPING_CACHE_TTL = float(os.getenv("SCRAPING_CACHE_TTL", "600"))
+# スクレイピング結果のインメモリキャッシュの上限(バイト)
+SCRAPING_CACHE_MAX_BYTES = int(os.getenv("SCRAPING_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# スクレイピング結果をディスクにも保存する場合のディレクトリ(空の場合は保存しない)
+SCRAPING_CACHE_DIR = os.getenv("SCRAPING_CACHE_DIR", "")
+# レスポンスを逐次的に読み込んで整形するかどうか
+SCRAPING_STREAMING = os.getenv("SCRAPING_STREAMING", "1") == "1"
+# スクレイピング時に読み込む最大バイト数
+SCRAPING_MAX_BYTES = int(os.getenv("SCRAPING_MAX_BYTES", str(5 * 1024 * 1024)))
+# スクレイピング結果の最大文字数
+SCRAPING_MAX_OUTPUT_CHARS = int(os.getenv("SCRAPING_MAX_OUTPUT_CHARS", "200000"))
+# 添付する画像の最大バイト数(0の場合は制限なし)
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+# 画像を同時に読み込む数
+IMAGE_MAX_WORKERS = int(os.getenv("IMAGE_MAX_WORKERS", "4"))
+# 画像の長辺の最大ピクセル数、超える場合は縮小する(0の場合は縮小しない、Pillowが必要)
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "3072"))
+# 縮小した画像をJPEGで保存する場合の品質
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+# 縮小した画像のキャッシュの最大バイト数
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# google検索の結果の上位のURLを先読みする件数(0の場合は先読みしない)
+SCRAPING_PREFETCH_TOP_N = int(os.getenv("SCRAPING_PREFETCH_TOP_N", "0"))
+# 先読みを同時に実行する数
+SCRAPING_PREFETCH_MAX_WORKERS = int(os.getenv("SCRAPING_PREFETCH_MAX_WORKERS", "4"))
+
 
 # geminiAI safety config
 # see https://cloud.google.com/vertex-ai/docs/generative-ai/multimodal/configure-safety-attributes
-SAFETY_CONFIG = {
-    generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
-}
+# vertexaiのimportには時間がかかるため、SAFETY_CONFIGは最初に参照した時に生成する
+def _safety_config() -> dict:
+    from vertexai.preview import generative_models
+
+    return {
+        generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
+    }
+
+
+def __getattr__(name: str):
+    if name == 'SAFETY_CONFIG':
+        globals()['SAFETY_CONFIG'] = _safety_config()
+        return globals()['SAFETY_CONFIG']
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
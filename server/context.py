@@ -0,0 +1,206 @@
+"""
+長い会話の履歴をトークン数の上限内に収める
+直近のturnはそのまま残し、それより前のturnは安価なモデルで要約して、履歴の先頭にまとめる
+要約は会話の先頭からの内容(prefix)ごとにキャッシュし、会話が伸びた場合は前回の要約に新しいturnだけを加えて要約する
+
+usage
+---
+>>> from context import context_manager
+>>> history = context_manager.compact(chat.history)
+>>> chat = model.start_chat(history=history)
+"""
+import hashlib
+import json
+
+from vertexai.preview.generative_models import Content, Part
+
+import utils
+from model_registry import get_model
+from config import (
+    CONTEXT_MAX_TOKENS, CONTEXT_RECENT_TURNS, CONTEXT_SUMMARY_MODEL, CONTEXT_SUMMARY_MAX_TOKENS,
+    CONTEXT_SUMMARY_CACHE_MAX_BYTES
+)
+
+from typing import Optional
+
+
+SUMMARY_PROMPT = """以下はユーザーとAIの会話です。
+今後の会話に必要な事実・ユーザーの要望・決定事項を漏らさずに、箇条書きで簡潔に要約してください。
+{previous}
+# 会話
+{transcript}"""
+
+SUMMARY_PREFIX = 'これまでの会話の要約です。\n'
+SUMMARY_REPLY = '承知しました。要約を踏まえて回答します。'
+
+
+def _part_tokens(part: Part) -> int:
+    return utils.estimate_tokens(json.dumps(part.to_dict(), ensure_ascii=False))
+
+
+def _part_text(part: Part) -> str:
+    return part.to_dict().get('text', '')
+
+
+def content_tokens(content: Content) -> int:
+    """
+    Contentのトークン数の概算(function_call/function_responseも含む)
+    """
+    return sum(_part_tokens(part) for part in content.parts)
+
+
+def _is_turn_start(content: Content) -> bool:
+    # function_responseのみのuserのContentは、同じturnの続き
+    return content.role == 'user' and any(_part_text(part) for part in content.parts)
+
+
+def split_turns(history: list[Content]) -> list[list[Content]]:
+    """
+    userの発言から次のuserの発言の前までを一つのturnとして分割する
+    """
+    turns: list[list[Content]] = []
+    for content in history:
+        if not turns or _is_turn_start(content):
+            turns.append([])
+        turns[-1].append(content)
+    return turns
+
+
+def _transcript(turns: list[list[Content]]) -> str:
+    lines = []
+    for turn in turns:
+        for content in turn:
+            text = ''.join(_part_text(part) for part in content.parts)
+            if text:
+                lines.append(f'{content.role}: {text}')
+    return '\n'.join(lines)
+
+
+class ContextManager():
+    def __init__(
+            self,
+            max_tokens: int = CONTEXT_MAX_TOKENS,
+            recent_turns: int = CONTEXT_RECENT_TURNS,
+            summary_model: str = CONTEXT_SUMMARY_MODEL,
+            summary_max_tokens: int = CONTEXT_SUMMARY_MAX_TOKENS,
+    ):
+        """
+        Params
+        ---
+        max_tokens: int
+            履歴の最大トークン数(0の場合は圧縮しない)
+        recent_turns: int
+            そのまま残す直近のturnの最大数
+        summary_model: str
+            要約に使用するモデル
+        summary_max_tokens: int
+            要約の最大トークン数
+        """
+        self.max_tokens = max_tokens
+        self.recent_turns = recent_turns
+        self.summary_model = summary_model
+        self.summary_max_tokens = summary_max_tokens
+        # prefixのハッシュごとの要約
+        self.summary_cache = utils.LRUCache(max_bytes=CONTEXT_SUMMARY_CACHE_MAX_BYTES)
+        self.summarized = 0
+
+    def exceeds(self, history: list[Content]) -> bool:
+        """
+        履歴がmax_tokensを超えているかどうか
+        """
+        return bool(self.max_tokens) and sum(content_tokens(content) for content in history) > self.max_tokens
+
+    def compact(self, history: list[Content]) -> list[Content]:
+        """
+        履歴がmax_tokensを超える場合は、古いturnを要約した履歴を返す
+        超えない場合は、historyをそのまま返す
+        """
+        if not self.max_tokens:
+            return history
+        tokens = [content_tokens(content) for content in history]
+        if sum(tokens) <= self.max_tokens:
+            return history
+
+        turns = split_turns(history)
+        # 要約の分を残して、直近のturnから上限まで残す
+        budget = self.max_tokens - self.summary_max_tokens
+        keep = 0
+        used = 0
+        index = len(history)
+        for turn in reversed(turns):
+            turn_tokens = sum(tokens[index - len(turn):index])
+            if keep >= self.recent_turns or (keep > 0 and used + turn_tokens > budget):
+                break
+            keep += 1
+            used += turn_tokens
+            index -= len(turn)
+
+        old_turns = turns[:len(turns) - keep]
+        recent = [content for turn in turns[len(turns) - keep:] for content in turn]
+        if not old_turns:
+            return recent
+
+        summary = self._summary(old_turns)
+        if not summary:
+            # 要約できない場合は、古いturnを削除する
+            return recent
+        return [
+            Content(role='user', parts=[Part.from_text(SUMMARY_PREFIX + summary)]),
+            Content(role='model', parts=[Part.from_text(SUMMARY_REPLY)]),
+        ] + recent
+
+    @staticmethod
+    def _prefix_keys(turns: list[list[Content]]) -> list[str]:
+        """
+        先頭からi+1番目のturnまでのprefixのハッシュ
+        """
+        keys = []
+        digest = b''
+        for turn in turns:
+            digest = hashlib.sha256(digest + _transcript([turn]).encode('utf-8')).digest()
+            keys.append(digest.hex())
+        return keys
+
+    def _summary(self, turns: list[list[Content]]) -> Optional[str]:
+        """
+        turnsの要約
+        キャッシュ済みの最も長いprefixの要約に、残りのturnを加えて要約する
+        """
+        keys = self._prefix_keys(turns)
+        entry = self.summary_cache.get(keys[-1])
+        if entry is not None:
+            return entry.value
+
+        previous = ''
+        start = 0
+        for i in range(len(keys) - 2, -1, -1):
+            cached = self.summary_cache.get(keys[i])
+            if cached is not None:
+                previous = cached.value
+                start = i + 1
+                break
+
+        prompt = SUMMARY_PROMPT.format(
+            previous=f'\n# これまでの要約\n{previous}\n' if previous else '',
+            transcript=_transcript(turns[start:])
+        )
+        try:
+            model = get_model(
+                self.summary_model,
+                {"max_output_tokens": self.summary_max_tokens, "temperature": 0}
+            )
+            summary = model.generate_content(prompt).text
+        except Exception as e:
+            utils.red_log(f'会話の要約に失敗しました: {e}')
+            return None
+
+        self.summarized += 1
+        self.summary_cache.set(keys[-1], utils.CacheEntry(value=summary, expires_at=float('inf')))
+        return summary
+
+    def stats(self) -> dict:
+        return {'summarized': self.summarized, 'cache': self.summary_cache.stats()}
+
+
+# プロセス全体で共有するContextManager
+context_manager = ContextManager()
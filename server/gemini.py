@@ -2,29 +2,99 @@
 Documentaion
 https://cloud.google.com/vertex-ai/docs/generative-ai/model-reference/gemini?hl=ja#gemini-pro
 """
-import json
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import inspect
+import threading
+import time
 from google.oauth2 import service_account
 import vertexai
-from vertexai.preview.generative_models import GenerativeModel, Part, Content
+from vertexai.preview.generative_models import Part, Content, ChatSession, GenerationResponse, Tool
 from vertexai.preview import generative_models
 from vertexai.generative_models._generative_models import ResponseBlockedError
 
 import utils
-from tools import gen_tool_list
-from config import PROJECT_ID, REGION, SAFETY_CONFIG
+from answer_cache import answer_cache
+from budget import LoopBudget
+from context import context_manager
+from model_registry import get_model, registry
+from tools import gen_tool_list, tool_registry, async_tool_executor
+from config import PROJECT_ID, REGION, METRICS_USER_LABEL, METRICS_HTTP_HOSTS
 
-from typing import Tuple, Optional, Callable
+from typing import Tuple, Optional, Callable, Iterable, Iterator, AsyncIterator
 
 
-credentials = service_account.Credentials.from_service_account_file('./google_key.json')
-vertexai.init(project=PROJECT_ID, location=REGION, credentials=credentials)
+tokens_total = utils.metrics.counter(
+    'gemini_tokens_total', 'Tokens used by model calls', ('user', 'model', 'kind')
+)
+tool_calls_total = utils.metrics.counter(
+    'gemini_tool_calls_total', 'Tool calls by result (ok, error, timeout, reused)', ('tool', 'result')
+)
+tool_loop_stops_total = utils.metrics.counter(
+    'gemini_tool_loop_stops_total', 'How function-calling loops ended (answer, empty, rounds, tokens, deadline)', ('reason',)
+)
+first_chunk_seconds = utils.metrics.histogram(
+    'gemini_model_first_chunk_seconds', 'Time from sending a message to the first response chunk', ('model',)
+)
 
+BLOCKED_MESSAGE = '安全な応答が生成されませんでした。'
 
-tools = gen_tool_list()
+
+class RequestCancelledError(Exception):
+    """
+    cancelがsetされたため、function callingのループを途中で終了した
+    """
+
+
+_vertexai_lock = threading.Lock()
+_vertexai_initialized = False
+
+
+def init_vertexai():
+    """
+    認証情報の読み込みとvertexai.initを、最初のGeminiAI生成時に一度だけ行う
+    """
+    global _vertexai_initialized
+    with _vertexai_lock:
+        if _vertexai_initialized:
+            return
+        credentials = service_account.Credentials.from_service_account_file('./google_key.json')
+        vertexai.init(project=PROJECT_ID, location=REGION, credentials=credentials)
+        _vertexai_initialized = True
+
+
+_tools: Optional[Tool] = None
+
+
+def get_tools() -> Tool:
+    """
+    Geminiに渡すtoolの宣言を、最初に使用する時に一度だけ生成する
+    """
+    global _tools
+    if _tools is None:
+        _tools = gen_tool_list()
+    return _tools
+
+
+# /metricsで公開する、キャッシュ・コネクションプール・レジストリの統計
+utils.add_stats_collector('model_registry', registry.stats)
+utils.add_stats_collector('context', context_manager.stats)
+utils.add_stats_collector('answer_cache', answer_cache.stats)
+utils.add_stats_collector('tool_registry', tool_registry.stats)
+# ホストごとの統計は、固定のホスト(METRICS_HTTP_HOSTS)のみ
+utils.add_stats_collector('http_client', lambda: utils.http_client.stats(hosts=METRICS_HTTP_HOSTS))
+utils.add_stats_collector('scraping_cache', utils.scraping_cache.stats)
+utils.add_stats_collector('google_search_cache', utils.google_search_cache.stats)
+utils.add_stats_collector('image_cache', utils.image_cache.stats)
+
+
+async def _as_async_iterable(response: GenerationResponse) -> AsyncIterator[GenerationResponse]:
+    yield response
 
 
 class GeminiAI():
     def __init__(self, model_name="gemini-pro", max_output_tokens=2048):
+        init_vertexai()
         model_name = self._check_model_name(model_name)
         self.model_name = model_name  # gemini-pro, gemini-pro-vision
 
@@ -35,12 +105,11 @@ class GeminiAI():
             "max_output_tokens": max_output_tokens,
 
         }
-        _model = GenerativeModel(
-            model_name="gemini-pro",
-            generation_config=self.config,
-            safety_settings=SAFETY_CONFIG,
-        )
-        self.model = _model.start_chat()
+        self.model = get_model(self.model_name, self.config).start_chat()
+        # メトリクスのラベルに使用するユーザー(session_id)
+        self.user = ''
+        # 今回の回答をanswer_cacheに保存してよいかどうか
+        self._answer_cacheable = False
         self.token = {
             "prompt_token_count": 0,
             "total_token_count": 0
@@ -54,6 +123,29 @@ class GeminiAI():
             return model_name
         raise ValueError("model_name is gemini-pro or gemini-pro-vision")
 
+    def to_dict(self) -> dict:
+        """
+        会話の状態をjsonに変換できる形式で返す
+        """
+        return {
+            'model_name': self.model_name,
+            'max_output_tokens': self.config['max_output_tokens'],
+            'token': dict(self.token),
+            'history': [content.to_dict() for content in self.model.history],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "GeminiAI":
+        """
+        to_dictの結果から会話を復元する
+        """
+        instance = cls(model_name=data['model_name'], max_output_tokens=data['max_output_tokens'])
+        instance.token.update(data['token'])
+        instance.model = get_model(instance.model_name, instance.config).start_chat(
+            history=[Content.from_dict(content) for content in data['history']]
+        )
+        return instance
+
     def close(self):
         print(self.token)
         pass
@@ -82,47 +174,550 @@ class GeminiAI():
                 'data': bytes
             }
         """
-        import mimetypes
-        import requests
-        import base64
+        return utils.load_image(image, mime_type)
 
-        res = {'mime_type': '', 'data': b''}
+    def _prepare_chat(
+            self,
+            q: Tuple[str, list],
+            images: list,
+            model_name: str
+    ) -> Tuple[ChatSession, list, bool]:
+        """
+        モデルの切り替え・履歴の復元・画像の添付を行い、送信するchatとcontentを返す
 
-        if image.startswith(('http://', 'https://')):
-            response = requests.get(image)
-            response.raise_for_status()
-            res['data'] = response.content
+        Returns
+        ---
+        chat: ChatSession
+        content: list[Part]
+        is_tool: bool
+        """
+        model_name = self._check_model_name(model_name)
+        chat = self.model
+        if len(images) > 0:
+            """
+            現在: 2025-01-15
+            画像を添付する場合は、gemini-pro-visionを使用し、toolを使用しない
+            """
+
+            self.model_name = 'gemini-pro-vision'
+            chat = get_model(self.model_name, self.config).start_chat()
+            self.model = chat
+
+        elif self.model_name != model_name:
+            self.model_name = model_name
+            chat = get_model(self.model_name, self.config).start_chat()
+            self.model = chat
 
-        elif image.startswith(('data:image/', 'data:application/')):
-            _, data = image.split(',', 1)
-            res['data'] = base64.b64decode(data)
-            mime_type = image.split(';', 1)[0][5:]
         else:
+            # 履歴が長い場合は、古いturnを要約した履歴で始め直す
+            history = context_manager.compact(chat.history)
+            if history is not chat.history:
+                chat = get_model(self.model_name, self.config).start_chat(history=history)
+                self.model = chat
+
+        is_tool = self.model_name == 'gemini-pro'
+
+        content = []
+        if isinstance(q, list):
+            add_history: list["Content"] = []
+            for _q in q[:-1]:
+                add_history.append(
+                    Content(parts=[Part.from_text(_q.get('message'))], role=_q.get('role'))
+                )
+            chat = get_model(self.model_name, self.config).start_chat(
+                history=context_manager.compact(add_history)
+            )
+            content = [Part.from_text(q[-1].get('message'))]
+        else:
+            content = [Part.from_text(q)]
+
+        # 複数の画像は並列に取得する
+        for res_image in utils.load_images(images):
+            content.append(Part.from_data(data=res_image['data'], mime_type=res_image['mime_type']))
+
+        return chat, content, is_tool
+
+    @staticmethod
+    def _query_text(q: Tuple[str, list]) -> str:
+        """
+        今回の質問のテキスト
+        """
+        if isinstance(q, list):
+            return q[-1].get('message', '')
+        return q
+
+    def _add_token(self, response: GenerationResponse) -> int:
+        """
+        Returns
+        ---
+        total_token_count: int
+            このレスポンスで使用したトークン数
+        """
+        usage_metadata = response._raw_response.usage_metadata
+        self.token['prompt_token_count'] += usage_metadata.prompt_token_count
+        self.token['total_token_count'] += usage_metadata.total_token_count
+        user = self.user if METRICS_USER_LABEL else ''
+        tokens_total.inc(usage_metadata.prompt_token_count, user=user, model=self.model_name, kind='prompt')
+        tokens_total.inc(
+            usage_metadata.total_token_count - usage_metadata.prompt_token_count,
+            user=user, model=self.model_name, kind='completion'
+        )
+        return usage_metadata.total_token_count
+
+    @staticmethod
+    def _send_message(chat: ChatSession, content, tools, stream: bool) -> Iterable[GenerationResponse]:
+        """
+        stream=Falseの場合も、レスポンスのイテレータとして扱えるようにする
+        """
+        if stream:
+            return chat.send_message(content=content, tools=tools, stream=True)
+        return [chat.send_message(content=content, tools=tools)]
+
+    def _mark_tools(self, function_calls: list):
+        """
+        cacheableでないtoolを使用した回答は、answer_cacheに保存しない
+        """
+        for function_call in function_calls:
+            spec = tool_registry.get(function_call.name)
+            if spec is None or not spec.cacheable:
+                self._answer_cacheable = False
+
+    def _call_functions(
+            self,
+            function_calls: list,
+            query: str,
+            f: Optional[Callable] = None,
+            budget: Optional[LoopBudget] = None
+    ) -> list[Part]:
+        """
+        function_callを並列に実行し、元の順番でfunction_responseを返す
+        toolごとのタイムアウト(ToolSpec.timeout)、もしくはbudgetの制限時間までに終わらなかったtoolは、失敗として返す
+        今回の質問で同じtool・引数を呼び出していた場合は、その結果を再利用する
+        """
+        self._mark_tools(function_calls)
+        futures = []
+        reused = []
+        for function_call in function_calls:
+            future = self._reuse_function(function_call, budget)
+            reused.append(future is not None)
+            if future is None:
+                # fはリクエストのコンテキストで実行する必要があるため、呼び出し元のスレッドで通知する
+                spec = tool_registry.get(function_call.name)
+                if f and spec and spec.progress_message:
+                    f(spec.progress_message)
+                future = self._submit_function(function_call, query, budget)
+            futures.append(future)
+
+        start = time.monotonic()
+        func_res = []
+        for function_call, future, _reused in zip(function_calls, futures, reused):
+            deadline = start + self._function_timeout(function_call, budget)
             try:
-                with open(image, 'rb') as file:
-                    res['data'] = file.read()
-            except FileNotFoundError:
-                # If the file is not found, assuming it is a base64 encoded image
-                res['data'] = base64.b64decode(image)
-
-        if not mime_type:
-            mime_type, _ = mimetypes.guess_type(image)
-            if not mime_type:
-                raise ValueError(
-                    f"Could not determine mime type for image: {image}")
-
-        res['mime_type'] = mime_type
+                res = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except FutureTimeoutError:
+                res = self._timeout_response(function_call, future, budget)
+            except Exception as e:
+                res = self._error_response(function_call, e)
+            else:
+                res = self._function_response(function_call, res, _reused)
+            func_res.append(res)
+        return func_res
+
+    @staticmethod
+    def _reuse_function(function_call, budget: Optional[LoopBudget]) -> Optional[Future]:
+        if budget is None:
+            return None
+        future = budget.reuse(tool_registry.key(function_call))
+        if future is not None:
+            utils.gray_log(f'{function_call.name}の結果を再利用')
+        return future
+
+    @staticmethod
+    def _submit_function(
+            function_call,
+            query: str,
+            budget: Optional[LoopBudget],
+            executor: Optional[ThreadPoolExecutor] = None
+    ) -> Future:
+        future = tool_registry.submit(function_call, query, executor)
+        if budget is not None:
+            budget.remember(tool_registry.key(function_call), future)
+        return future
+
+    @staticmethod
+    def _function_timeout(function_call, budget: Optional[LoopBudget]) -> float:
+        timeout = tool_registry.timeout(function_call.name)
+        return min(timeout, budget.remaining()) if budget is not None else timeout
+
+    @staticmethod
+    def _timeout_response(function_call, future: Future, budget: Optional[LoopBudget]) -> Part:
+        """
+        タイムアウトしたtoolの実行を取り消し、budgetからも取り除いて失敗として返す
+        """
+        future.cancel()
+        if budget is not None:
+            budget.forget(tool_registry.key(function_call), future)
+        tool_calls_total.inc(tool=function_call.name, result='timeout')
+        utils.red_log(f'{function_call.name}がタイムアウトしました')
+        return Part.from_function_response(
+            name=function_call.name,
+            response={"result": False, 'message': 'タイムアウトしました'}
+        )
+
+    @staticmethod
+    def _error_response(function_call, e: BaseException) -> Part:
+        tool_calls_total.inc(tool=function_call.name, result='error')
+        utils.red_log(e)
+        return Part.from_function_response(
+            name=function_call.name,
+            response={"result": False, 'message': str(e)}
+        )
+
+    @staticmethod
+    def _function_response(function_call, res: Optional[Part], reused: bool) -> Part:
+        if res is None:
+            # 登録されていないtool
+            return GeminiAI._error_response(function_call, ValueError(f'{function_call.name}は使用できません'))
+        tool_calls_total.inc(tool=function_call.name, result='reused' if reused else 'ok')
         return res
 
+    @staticmethod
+    def _parse_response(response: GenerationResponse) -> Tuple[bool, list, list[str]]:
+        """
+        Returns
+        ---
+        is_blocked: bool
+            安全でない応答としてブロックされたかどうか
+        function_calls: list
+        texts: list[str]
+        """
+        candidate = response.candidates[0]
+        if candidate.finish_reason == generative_models.FinishReason.SAFETY:
+            return True, [], []
+
+        function_calls = []
+        texts = []
+        for part in candidate.content.parts:
+            # partの種類はSDKの公開されたアクセサで判定する(str(part)でシリアライズしない)
+            # function_callはfunction_callのpart以外ではNone、textはtextのpart以外ではAttributeError
+            function_call = part.function_call
+            if function_call is not None:
+                function_calls.append(function_call)
+                continue
+            try:
+                texts.append(part.text)
+            except AttributeError:
+                pass
+        return False, function_calls, texts
+
+    def _round_tools(self, is_tool: bool, budget: LoopBudget) -> Optional[list]:
+        """
+        このラウンドでモデルに渡すtool
+        予算を使い切った場合はNone(toolを渡さずに、ここまでの結果で回答させる)
+        """
+        if not is_tool:
+            return None
+        reason = budget.exhausted()
+        if reason:
+            if not budget.forced and reason != 'rounds':
+                utils.gray_log(f'予算({reason})を使い切ったため、toolを使用せずに回答させます')
+            budget.forced = reason
+            return None
+        return [get_tools()]
+
+    @staticmethod
+    def _next_step(function_calls: list, has_text: bool, last_response, tools: Optional[list], budget: LoopBudget) -> str:
+        """
+        ラウンドの結果から、次に行うことを決める
+
+        Returns
+        ---
+        step: str
+            call: toolを実行して結果を送信する
+            retry: 考え直させる
+            stop: ループを終了する
+        """
+        if function_calls and tools is not None:
+            return 'call'
+        if has_text or last_response is None or function_calls or budget.forced or budget.retried:
+            tool_loop_stops_total.inc(reason=budget.forced or ('answer' if has_text else 'empty'))
+            return 'stop'
+        # 空の応答の場合は、一度だけ考え直させる
+        budget.retried = True
+        return 'retry'
+
+    def _chat_rounds(
+            self,
+            chat: ChatSession,
+            content: list,
+            query: str,
+            is_tool: bool,
+            budget: LoopBudget,
+            f: Optional[Callable],
+            stream: bool,
+            cancel: Optional[threading.Event] = None
+    ) -> Iterator[str]:
+        """
+        function callingのループを回し、最終的な回答のテキストを順にyieldする
+        toolの呼び出しは全て解決してから、回答をyieldする
+        テキストは届いた順にyieldし、function_callを含むチャンク以降のテキストはyieldしない
+        """
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise RequestCancelledError()
+            tools = self._round_tools(is_tool, budget)
+            function_calls = []
+            has_text = False
+            last_response = None
+            start = time.perf_counter()
+            try:
+                with utils.span('model_call', self.model_name):
+                    for response in self._send_message(
+                            chat,
+                            content,
+                            tools=tools,
+                            stream=stream):
+                        if last_response is None:
+                            first_chunk_seconds.observe(time.perf_counter() - start, model=self.model_name)
+                        last_response = response
+                        is_blocked, _function_calls, texts = self._parse_response(response)
+                        if is_blocked:
+                            self._answer_cacheable = False
+                            yield BLOCKED_MESSAGE
+                            return
+                        function_calls.extend(_function_calls)
+                        for text in texts:
+                            has_text = True
+                            # function_callを含むチャンク以降のテキストは途中経過のため、クライアントには送らない(履歴には残る)
+                            if not function_calls:
+                                yield text
+            except ResponseBlockedError as e:
+                print(e.responses)
+                self._answer_cacheable = False
+                yield BLOCKED_MESSAGE
+                return
+            finally:
+                # streamの場合、usage_metadataは最後のチャンクに集計される
+                budget.add_round(self._add_token(last_response) if last_response is not None else 0)
+
+            step = self._next_step(function_calls, has_text, last_response, tools, budget)
+            if step == 'call':
+                content = self._call_functions(function_calls, query, f, budget)
+            elif step == 'retry':
+                content = 'もう一度考えてください。'
+            else:
+                return
+
+    async def _call_functions_async(
+            self,
+            function_calls: list,
+            query: str,
+            f: Optional[Callable] = None,
+            budget: Optional[LoopBudget] = None
+    ) -> list[Part]:
+        """
+        _call_functionsの非同期版
+        toolはasync用のスレッドプール(TOOL_ASYNC_MAX_WORKERS)で実行し、イベントループはブロックしない
+        fはコルーチン関数でもよい
+        """
+        self._mark_tools(function_calls)
+        futures = []
+        reused = []
+        for function_call in function_calls:
+            future = self._reuse_function(function_call, budget)
+            reused.append(future is not None)
+            if future is None:
+                spec = tool_registry.get(function_call.name)
+                if f and spec and spec.progress_message:
+                    res = f(spec.progress_message)
+                    if inspect.isawaitable(res):
+                        await res
+                future = self._submit_function(function_call, query, budget, async_tool_executor)
+            futures.append(future)
+
+        results = await asyncio.gather(
+            *[
+                # タイムアウト時の取り消しは_timeout_responseでまとめて行うため、wait_forからはcancelさせない
+                asyncio.wait_for(
+                    asyncio.shield(asyncio.wrap_future(future)),
+                    timeout=self._function_timeout(function_call, budget)
+                )
+                for function_call, future in zip(function_calls, futures)
+            ],
+            return_exceptions=True
+        )
+
+        func_res = []
+        for function_call, future, _reused, res in zip(function_calls, futures, reused, results):
+            if isinstance(res, asyncio.TimeoutError):
+                res = self._timeout_response(function_call, future, budget)
+            elif isinstance(res, BaseException):
+                # 同じラウンドの同じ呼び出しが先にタイムアウトして取り消された場合は、CancelledError
+                res = self._error_response(function_call, res)
+            else:
+                res = self._function_response(function_call, res, _reused)
+            func_res.append(res)
+        return func_res
+
+    async def _chat_rounds_async(
+            self,
+            chat: ChatSession,
+            content: list,
+            query: str,
+            is_tool: bool,
+            budget: LoopBudget,
+            f: Optional[Callable],
+            stream: bool,
+            cancel: Optional[threading.Event] = None
+    ) -> AsyncIterator[str]:
+        """
+        _chat_roundsの非同期版
+        send_message_asyncを使用する
+        """
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise RequestCancelledError()
+            tools = self._round_tools(is_tool, budget)
+            function_calls = []
+            has_text = False
+            last_response = None
+            start = time.perf_counter()
+            try:
+                with utils.span('model_call', self.model_name):
+                    responses = await chat.send_message_async(
+                        content=content,
+                        tools=tools,
+                        stream=stream
+                    )
+                    if not stream:
+                        responses = _as_async_iterable(responses)
+                    async for response in responses:
+                        if last_response is None:
+                            first_chunk_seconds.observe(time.perf_counter() - start, model=self.model_name)
+                        last_response = response
+                        is_blocked, _function_calls, texts = self._parse_response(response)
+                        if is_blocked:
+                            self._answer_cacheable = False
+                            yield BLOCKED_MESSAGE
+                            return
+                        function_calls.extend(_function_calls)
+                        for text in texts:
+                            has_text = True
+                            # function_callを含むチャンク以降のテキストは途中経過のため、クライアントには送らない(履歴には残る)
+                            if not function_calls:
+                                yield text
+            except ResponseBlockedError as e:
+                print(e.responses)
+                self._answer_cacheable = False
+                yield BLOCKED_MESSAGE
+                return
+            finally:
+                budget.add_round(self._add_token(last_response) if last_response is not None else 0)
+
+            step = self._next_step(function_calls, has_text, last_response, tools, budget)
+            if step == 'call':
+                content = await self._call_functions_async(function_calls, query, f, budget)
+            elif step == 'retry':
+                content = 'もう一度考えてください。'
+            else:
+                return
+
+    def _lookup_answer(self, chat: ChatSession, query: str, images: list) -> Tuple[bool, Optional[str]]:
+        """
+        履歴・画像のない質問の場合は、answer_cacheから似た質問の回答を探す
+        見つかった場合は、質問と回答を履歴に追加する
+
+        Returns
+        ---
+        use_cache: bool
+            今回の質問がanswer_cacheの対象かどうか
+        answer: Optional[str]
+        """
+        use_cache = answer_cache.enabled and not images and len(chat.history) == 0
+        if not use_cache:
+            return False, None
+        answer = answer_cache.get(query, self.model_name)
+        if answer is not None:
+            utils.gray_log('似た質問の回答をキャッシュから取得')
+            chat.history.append(Content(role='user', parts=[Part.from_text(query)]))
+            chat.history.append(Content(role='model', parts=[Part.from_text(answer)]))
+        return True, answer
+
+    def _cached_rounds(
+            self,
+            chat: ChatSession,
+            content: list,
+            query: str,
+            images: list,
+            is_tool: bool,
+            budget: LoopBudget,
+            f: Optional[Callable],
+            stream: bool,
+            cancel: Optional[threading.Event] = None
+    ) -> Iterator[str]:
+        """
+        answer_cacheにある場合はその回答を、ない場合は_chat_roundsの回答をyieldし、回答を保存する
+        """
+        use_cache, answer = self._lookup_answer(chat, query, images)
+        if answer is not None:
+            yield answer
+            return
+        self._answer_cacheable = use_cache
+        history_len = len(chat.history)
+        chunks = []
+        try:
+            for text in self._chat_rounds(chat, content, query, is_tool, budget, f, stream, cancel):
+                chunks.append(text)
+                yield text
+        except RequestCancelledError:
+            # 応答のないfunction_callが履歴に残ると次の質問を送信できないため、今回の質問ごと取り除く
+            del chat.history[history_len:]
+            raise
+        if self._answer_cacheable:
+            answer_cache.put(query, self.model_name, ''.join(chunks))
+
+    async def _cached_rounds_async(
+            self,
+            chat: ChatSession,
+            content: list,
+            query: str,
+            images: list,
+            is_tool: bool,
+            budget: LoopBudget,
+            f: Optional[Callable],
+            stream: bool,
+            cancel: Optional[threading.Event] = None
+    ) -> AsyncIterator[str]:
+        """
+        _cached_roundsの非同期版
+        """
+        use_cache, answer = self._lookup_answer(chat, query, images)
+        if answer is not None:
+            yield answer
+            return
+        self._answer_cacheable = use_cache
+        history_len = len(chat.history)
+        chunks = []
+        try:
+            async for text in self._chat_rounds_async(chat, content, query, is_tool, budget, f, stream, cancel):
+                chunks.append(text)
+                yield text
+        except RequestCancelledError:
+            del chat.history[history_len:]
+            raise
+        if self._answer_cacheable:
+            answer_cache.put(query, self.model_name, ''.join(chunks))
+
     def get_anything_chat(
             self,
             q: Tuple[str, list],
             images: list = [],
             is_tool=True,
             model_name="",
-            max_tokens: int = 100,
+            max_tokens: Optional[int] = None,
             max_func_num=5,
-            f: Optional[Callable] = None
+            f: Optional[Callable] = None,
+            cancel: Optional[threading.Event] = None
     ) -> str:
         """
         usage
@@ -143,171 +738,123 @@ class GeminiAI():
             toolを使用するかどうか
         model_name: str
             ex: gemini-pro, gemini-pro-vision
-        max_tokens: int
-            一回のリクエストで使用するトークン数
+        max_tokens: Optional[int]
+            一回のリクエストで使用するトークン数(usage_metadataのtotal_token_countの合計)
+            超えた場合は、toolを渡さずに回答させる(省略した場合はLOOP_TOKEN_BUDGET、0の場合は制限しない)
         max_func_num: int
-            一回のリクエストで使用するfunctionの数
+            一回のリクエストでtoolを使用できるラウンドの数
             ex: 5
         f: Optional[functools]
             ツールを使用する場合は、実行される
+        cancel: Optional[threading.Event]
+            setされると、次のラウンドを送信せずにRequestCancelledErrorを送出する
+            (今回の質問と途中のfunction_callは履歴に残さない)
 
         Returns
         ---
         res: str
             ex: 本日のドル円レートは、1ドル=110円です。
         """
-        model_name = self._check_model_name(model_name)
-        chat = self.model
-        if len(images) > 0:
-            """
-            現在: 2025-01-15
-            画像を添付する場合は、gemini-pro-visionを使用し、toolを使用しない
-            """
+        chat, content, is_tool = self._prepare_chat(q, images, model_name)
+        return ''.join(self._cached_rounds(chat, content, self._query_text(q), images, is_tool, LoopBudget(max_func_num, max_tokens), f, stream=False, cancel=cancel))
 
-            self.model_name = 'gemini-pro-vision'
-            _model = GenerativeModel(
-                model_name=self.model_name,
-                generation_config=self.config,
-                safety_settings=SAFETY_CONFIG,
-            )
-            chat = _model.start_chat()
-            self.model = chat
-
-        elif self.model_name != model_name:
-            self.model_name = model_name
-            _model = GenerativeModel(
-                model_name=self.model_name,
-                generation_config=self.config,
-                safety_settings=SAFETY_CONFIG,
-            )
-            chat = _model.start_chat()
-            self.model = chat
-
-        is_tool = self.model_name == 'gemini-pro'
+    def get_anything_chat_stream(
+            self,
+            q: Tuple[str, list],
+            images: list = [],
+            is_tool=True,
+            model_name="",
+            max_tokens: Optional[int] = None,
+            max_func_num=5,
+            f: Optional[Callable] = None,
+            cancel: Optional[threading.Event] = None
+    ) -> Iterator[str]:
+        """
+        get_anything_chatのストリーミング版
+        toolの呼び出しを全て解決した後、最終的な回答をチャンクごとにyieldする
 
-        history = []
-        if isinstance(q, list):
-            _model = GenerativeModel(
-                model_name=self.model_name,
-                generation_config=self.config,
-                safety_settings=SAFETY_CONFIG,
-            )
-            add_history: list["Content"] = []
-            for _q in q[:-1]:
-                add_history.append(
-                    Content(parts=[Part.from_text(_q.get('message'))], role=_q.get('role'))
-                )
-            chat = _model.start_chat(
-                history=add_history
-            )
-            history = [Part.from_text(q[-1].get('message'))]
-        else:
-            history = [Part.from_text(q)]
+        usage
+        ---
+        >>> gemini = GeminiAI()
+        >>> for chunk in gemini.get_anything_chat_stream('本日のドル円レートを教えて'):
+        ...     print(chunk, end='')
 
-        for image in images:
-            res_image = self.attached_image(image)
-            history.append(Part.from_data(data=res_image['data'], mime_type=res_image['mime_type']))
+        Params
+        ---
+        get_anything_chatと同じ
 
-        response = chat.send_message(
-            content=history,
-            tools=[tools] if is_tool else None
-        )
+        Yields
+        ---
+        chunk: str
+            ex: 本日のドル円レートは、
+        """
+        chat, content, is_tool = self._prepare_chat(q, images, model_name)
+        yield from self._cached_rounds(chat, content, self._query_text(q), images, is_tool, LoopBudget(max_func_num, max_tokens), f, stream=True, cancel=cancel)
 
-        if (response.candidates[0].finish_reason == generative_models.FinishReason.SAFETY):
-            return '安全な応答が生成されませんでした。'
+    async def _prepare_chat_async(
+            self,
+            q: Tuple[str, list],
+            images: list,
+            model_name: str
+    ) -> Tuple[ChatSession, list, bool]:
+        if len(images) > 0 or isinstance(q, list) or context_manager.exceeds(self.model.history):
+            # 画像の取得・履歴の要約はブロッキングのため、スレッドで実行する
+            return await asyncio.to_thread(self._prepare_chat, q, images, model_name)
+        return self._prepare_chat(q, images, model_name)
+
+    async def get_anything_chat_async(
+            self,
+            q: Tuple[str, list],
+            images: list = [],
+            is_tool=True,
+            model_name="",
+            max_tokens: Optional[int] = None,
+            max_func_num=5,
+            f: Optional[Callable] = None,
+            cancel: Optional[threading.Event] = None
+    ) -> str:
+        """
+        get_anything_chatの非同期版
 
-        usage_metadata = response._raw_response.usage_metadata
-        self.token['prompt_token_count'] += usage_metadata.prompt_token_count
-        self.token['total_token_count'] += usage_metadata.total_token_count
+        usage
+        ---
+        >>> gemini = GeminiAI()
+        >>> res = await gemini.get_anything_chat_async('本日のドル円レートを教えて')
 
-        parts = response.candidates[0].content.parts
-
-        func_num = 0
-        while parts:
-            func_res = []
-            func_num += 1
-            for part in parts:
-                if 'text' in str(part):
-                    return part.text
-
-                if 'function_call' in str(part):
-                    function_name: str = part.function_call.name
-
-                    if function_name == "get_default_serch":
-                        if f:
-                            f('goole検索を開始')
-                        q: str = part.function_call.args['q']
-                        search_res = utils.get_default_serch(q)
-                        func_res.append(
-                            Part.from_function_response(
-                                name=function_name,
-                                response={"result": True, 'message': search_res}
-                            )
-                        )
-
-                    if function_name == "get_outer_html":
-                        if f:
-                            f('スクレイピングを開始')
-                        q: str = part.function_call.args['q']
-                        html = utils.get_outer_html(url=q)
-                        func_res.append(
-                            Part.from_function_response(
-                                name=function_name,
-                                response={
-                                    "result": bool(html),
-                                    'message': html if html else 'URLが不正 or 取得できませんでした'
-                                }
-                            )
-                        )
-
-                    if function_name == "get_now_date_at_ISO":
-                        date = utils.get_now_date_at_ISO()
-                        func_res.append(
-                            Part.from_function_response(
-                                name=function_name,
-                                response={"result": True, 'message': date}
-                            )
-                        )
-
-                    if function_name == "notion_search":
-                        if f:
-                            f('Notion検索を開始')
-                        q: str = part.function_call.args['q']
-                        start_cursor: str = part.function_call.args.get('start_cursor', '')
-                        n = utils.Notion()
-                        search_res = n.search(query=q, start_cursor=start_cursor)
-                        search_res_str = json.dumps(search_res.to_dict(), ensure_ascii=False)
-                        func_res.append(
-                            Part.from_function_response(
-                                name=function_name,
-                                response={
-                                    "result": bool(len(search_res.result)),
-                                    'message': search_res_str if len(search_res.result) else 'Notionの検索に失敗しました。queryを確認してください。'
-                                }
-                            )
-                        )
-            if not len(func_res):
-                res = chat.send_message(
-                    'もう一度考えてください。',
-                    tools=[tools] if func_num < max_func_num and is_tool else None
-                )
-                usage_metadata = res._raw_response.usage_metadata
-                self.token['prompt_token_count'] += usage_metadata.prompt_token_count
-                self.token['total_token_count'] += usage_metadata.total_token_count
-            else:
-                try:
-                    res = chat.send_message(
-                        func_res,
-                        tools=[tools] if func_num < max_func_num and is_tool else None
-                    )
-                    usage_metadata = res._raw_response.usage_metadata
-                    self.token['prompt_token_count'] += usage_metadata.prompt_token_count
-                    self.token['total_token_count'] += usage_metadata.total_token_count
-                except ResponseBlockedError as e:
-                    print(e.responses)
-                    break
+        Params
+        ---
+        get_anything_chatと同じ
+        f: Optional[Callable]
+            コルーチン関数でもよい
+        """
+        chat, content, is_tool = await self._prepare_chat_async(q, images, model_name)
+        return ''.join([
+            text async for text in self._cached_rounds_async(
+                chat, content, self._query_text(q), images, is_tool, LoopBudget(max_func_num, max_tokens), f, stream=False, cancel=cancel
+            )
+        ])
 
-            if res.candidates[0].finish_reason == generative_models.FinishReason.SAFETY:
-                return '安全な応答が生成されませんでした。'
+    async def get_anything_chat_stream_async(
+            self,
+            q: Tuple[str, list],
+            images: list = [],
+            is_tool=True,
+            model_name="",
+            max_tokens: Optional[int] = None,
+            max_func_num=5,
+            f: Optional[Callable] = None,
+            cancel: Optional[threading.Event] = None
+    ) -> AsyncIterator[str]:
+        """
+        get_anything_chat_streamの非同期版
 
-            parts = res.candidates[0].content.parts
+        usage
+        ---
+        >>> gemini = GeminiAI()
+        >>> async for chunk in gemini.get_anything_chat_stream_async('本日のドル円レートを教えて'):
+        ...     print(chunk, end='')
+        """
+        chat, content, is_tool = await self._prepare_chat_async(q, images, model_name)
+        async for text in self._cached_rounds_async(
+                chat, content, self._query_text(q), images, is_tool, LoopBudget(max_func_num, max_tokens), f, stream=True, cancel=cancel):
+            yield text
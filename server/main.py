@@ -5,46 +5,68 @@ except ModuleNotFoundError:
     pass
 
 # noqa
-from gemini import GeminiAI
-from flask_socketio import SocketIO, emit, join_room, leave_room
-from flask import Flask, request
+from session_store import SessionManager, SessionIdSigner, create_session_store
+from flask_socketio import SocketIO, join_room, leave_room
+from flask import Flask, Response, request
 import time
 import os
 import threading
 import utils
+from scheduler import Scheduler, QueueFullError
+from warmup import warmup
+from config import SOCKETIO_MESSAGE_QUEUE, SOCKETIO_MESSAGE_QUEUE_DIR, WARMUP_ON_START, SECRET_KEY
+from typing import Optional
 # import markdown
 
 
+def create_message_queue_options() -> dict:
+    """
+    複数のworkerで動かす場合の、Socket.IOのメッセージキューの設定
+    filesystem://の場合は、同じノード上のworker間でディレクトリを介して中継する(ローカル検証用)
+    """
+    if not SOCKETIO_MESSAGE_QUEUE:
+        return {}
+    if SOCKETIO_MESSAGE_QUEUE.startswith('filesystem://'):
+        import socketio as python_socketio
+
+        os.makedirs(SOCKETIO_MESSAGE_QUEUE_DIR, exist_ok=True)
+        return {'client_manager': python_socketio.KombuManager(
+            SOCKETIO_MESSAGE_QUEUE,
+            connection_options={'transport_options': {
+                'data_folder_in': SOCKETIO_MESSAGE_QUEUE_DIR,
+                'data_folder_out': SOCKETIO_MESSAGE_QUEUE_DIR,
+                # fanoutの配信先も同じディレクトリにまとめる
+                'control_folder': os.path.join(SOCKETIO_MESSAGE_QUEUE_DIR, 'control'),
+            }}
+        )}
+    return {'message_queue': SOCKETIO_MESSAGE_QUEUE}
+
+
 app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(50)
+app.config['SECRET_KEY'] = SECRET_KEY or os.urandom(50)
 socketio = SocketIO(app,
-                    cors_allowed_origins=['http://localhost:5173']
+                    cors_allowed_origins=['http://localhost:5173'],
+                    **create_message_queue_options()
                     )
 
 
-user_instances = {}
-
+sessions = SessionManager(create_session_store())
+session_signer = SessionIdSigner(app.config['SECRET_KEY'])
+utils.add_stats_collector('sessions', sessions.stats)
+# メッセージは会話ごとに届いた順に処理し、全体の同時実行数を制限する
+scheduler = Scheduler()
+utils.add_stats_collector('scheduler', scheduler.stats)
+# Socket.IOのsid → 会話のsession_id
+session_ids: dict[str, str] = {}
 
-def create_user_instance(sid: str):
-    user_instances[sid] = {'instance': GeminiAI(), 'last_active': time.time()}
 
-
-def get_user_instance(sid: str) -> GeminiAI:
-    current_time = time.time()
-    if sid not in user_instances:
-        user_instances[sid] = {'instance': GeminiAI(), 'last_active': current_time}
-    else:
-        user_instances[sid]['last_active'] = current_time
-    return user_instances[sid]['instance']
+def get_session_id(sid: str) -> str:
+    return session_ids.get(sid, sid)
 
 
 def remove_inactive_users():
     while True:
-        current_time = time.time()
-        inactive_users = [sid for sid, data in user_instances.items(
-        ) if current_time - data['last_active'] > 300]
-        for sid in inactive_users:
-            del user_instances[sid]
+        sessions.expire()
         time.sleep(60)  # 1分ごとにチェック
 
 
@@ -52,64 +74,132 @@ def remove_inactive_users():
 cleanup_thread = threading.Thread(target=remove_inactive_users, daemon=True)
 cleanup_thread.start()
 
+if WARMUP_ON_START:
+    # vertexaiなどの読み込みは、ソケットの受け付けと並行して行う
+    warmup.start()
+
 
 @app.route('/')
 def index():
     return 'Hello World'
 
 
+@app.route('/metrics')
+def metrics():
+    """
+    Prometheusのテキスト形式のメトリクス
+    """
+    return Response(utils.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/ready')
+def ready():
+    """
+    ウォームアップが完了していれば200、それ以外は503
+    """
+    status = warmup.status()
+    return status, 200 if status['ready'] else 503
+
+
 @socketio.on('disconnect')
 def on_disconnect():
     sid = request.sid
-    if sid in user_instances:
-        leave_room(sid)
-        del user_instances[sid]
+    leave_room(sid)
+    session_id = session_ids.pop(sid, sid)
+    if session_id not in session_ids.values():
+        # 回答を受け取るクライアントがいないため、処理を取り消す
+        scheduler.cancel(session_id)
+    # 会話は保存先に残し、再接続時に再開できるようにする
+    sessions.release(session_id)
 
 
 @socketio.on('connect')
-def on_connect():
+def on_connect(auth: Optional[dict] = None):
     sid = request.sid
     join_room(sid)
-    create_user_instance(sid)
+    # サーバーが発行したsessionIdを指定した場合は、その会話を再開する
+    session_id = session_signer.verify((auth or {}).get('sessionId'))
+    if session_id is None:
+        # 指定がない・発行していないsessionIdは受け付けず、新しい会話を発行してクライアントに保存させる
+        session_id, token = session_signer.issue()
+        socketio.emit('session', {'sessionId': token}, to=sid)
+    session_ids[sid] = session_id
+    sessions.get(session_id)
+
+
+def emit_message(sid: str, status: str, message: str):
+    """
+    リクエストのコンテキストの外(schedulerのスレッド)からも送信できるよう、socketio.emitを使用する
+    """
+    socketio.emit('message', {
+        'status': status,
+        'role': 'model',
+        'message': message
+    }, to=sid)
 
 
 @socketio.on('message')
 def handle_message(message: dict):
     sid = request.sid
-    user_instance = get_user_instance(sid)
-
-    def status_emit(message: str):
-        emit('message',
-             {
-                 'status': 'progress',
-                 'role': 'model',
-                 'message': message
-             },
-             broadcast=True,
-             room=sid)
-
+    session_id = get_session_id(sid)
     try:
-        res = user_instance.get_anything_chat(
-            q=message['message'],
-            images=message.get('images', []),
-            f=status_emit)
-        res = res.replace('•', '  *')
-        emit('message', {
-            'status': 'success',
-            'role': 'model',
-            'message': res
-        }, broadcast=True, room=sid)
-    except Exception as e:
-        current_time = time.time()
-        user_instances[sid] = {'instance': GeminiAI(), 'last_active': current_time}
+        job = scheduler.submit(session_id, lambda cancel: _handle_message(sid, session_id, message, cancel))
+    except QueueFullError as e:
         utils.red_log(e)
-
-        emit('message', {
-            'status': 'error',
-            'role': 'model',
-            'message': str(e)
-        }, broadcast=True, room=sid)
+        emit_message(sid, 'busy', '処理中のメッセージが多いため、受け付けられませんでした。しばらくしてから送信してください。')
+        return
+    if job.started_at is None:
+        emit_message(sid, 'progress', '順番待ち中...')
+
+    def _on_done(future):
+        # 処理の開始前に取り消された場合
+        if future.cancelled():
+            emit_message(sid, 'cancelled', 'キャンセルしました。')
+    job.future.add_done_callback(_on_done)
+
+
+@socketio.on('cancel')
+def on_cancel():
+    """
+    待っているメッセージを取り消し、処理中のメッセージは次のtoolの呼び出しの前に終了する
+    """
+    scheduler.cancel(get_session_id(request.sid))
+
+
+def _handle_message(sid: str, session_id: str, message: dict, cancel: threading.Event):
+    # geminiは最初のセッションの作成時に読み込まれる
+    from gemini import RequestCancelledError
+
+    with utils.span('request', 'message'):
+        user_instance = sessions.get(session_id)
+
+        def status_emit(message: str):
+            emit_message(sid, 'progress', message)
+
+        try:
+            chunks = []
+            for chunk in user_instance.get_anything_chat_stream(
+                    q=message['message'],
+                    images=message.get('images', []),
+                    f=status_emit,
+                    cancel=cancel):
+                chunk = chunk.replace('•', '  *')
+                chunks.append(chunk)
+                emit_message(sid, 'partial', chunk)
+                # チャンクごとにクライアントへ送信されるよう、制御を戻す
+                socketio.sleep(0)
+            res = ''.join(chunks)
+            sessions.save(session_id, user_instance)
+            emit_message(sid, 'success', res)
+        except RequestCancelledError:
+            # 今回の質問は履歴から取り除かれている
+            sessions.save(session_id, user_instance)
+            emit_message(sid, 'cancelled', 'キャンセルしました。')
+        except Exception as e:
+            sessions.reset(session_id)
+            utils.red_log(e)
+            emit_message(sid, 'error', str(e))
 
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True, host='127.0.0.1', port=5000)
+    socketio.run(app, debug=True, host='127.0.0.1', port=int(os.getenv('PORT', '5000')))
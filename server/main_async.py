@@ -0,0 +1,172 @@
+"""
+asyncioベースのサーバー
+main.pyと同じSocket.IOのイベントを、python-socketioのAsyncServerとaiohttpで処理する
+
+usage
+---
+$ python main_async.py
+"""
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ModuleNotFoundError:
+    pass
+
+# noqa
+from aiohttp import web
+import socketio
+import asyncio
+import time
+import utils
+from warmup import warmup
+from config import WARMUP_ON_START
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # geminiはvertexaiを読み込むため、ウォームアップ(もしくは最初の接続)でimportする
+    from gemini import GeminiAI
+
+
+sio = socketio.AsyncServer(async_mode='aiohttp',
+                           cors_allowed_origins=['http://localhost:5173']
+                           )
+app = web.Application()
+sio.attach(app)
+
+
+user_instances = {}
+
+
+async def create_user_instance(sid: str):
+    """
+    GeminiAIの生成(モデルの生成・vertexaiの初期化など)はブロックするため、スレッドで行う
+    """
+    from gemini import GeminiAI
+
+    instance = await asyncio.to_thread(GeminiAI)
+    instance.user = sid
+    user_instances[sid] = {'instance': instance, 'last_active': time.time()}
+
+
+async def get_user_instance(sid: str) -> 'GeminiAI':
+    if sid not in user_instances:
+        await create_user_instance(sid)
+    else:
+        user_instances[sid]['last_active'] = time.time()
+    return user_instances[sid]['instance']
+
+
+async def remove_inactive_users():
+    while True:
+        current_time = time.time()
+        inactive_users = [sid for sid, data in user_instances.items(
+        ) if current_time - data['last_active'] > 300]
+        for sid in inactive_users:
+            del user_instances[sid]
+        await asyncio.sleep(60)  # 1分ごとにチェック
+
+
+async def wait_warmup():
+    """
+    ウォームアップが終わるまで、イベントループを止めずに待つ
+    """
+    if not warmup.ready:
+        await asyncio.get_running_loop().run_in_executor(None, warmup.wait)
+
+
+async def start_background_tasks(app: web.Application):
+    if WARMUP_ON_START:
+        # vertexaiなどの読み込みは、ソケットの受け付けと並行して行う
+        warmup.start()
+    # 不活動ユーザー削除タスクの開始
+    app['cleanup_task'] = asyncio.create_task(remove_inactive_users())
+
+
+async def index(request: web.Request):
+    return web.Response(text='Hello World')
+
+
+async def metrics(request: web.Request):
+    """
+    Prometheusのテキスト形式のメトリクス
+    """
+    return web.Response(text=utils.metrics.render(), content_type='text/plain')
+
+
+async def ready(request: web.Request):
+    """
+    ウォームアップが完了していれば200、それ以外は503
+    """
+    status = warmup.status()
+    return web.json_response(status, status=200 if status['ready'] else 503)
+
+
+app.router.add_get('/', index)
+app.router.add_get('/metrics', metrics)
+app.router.add_get('/ready', ready)
+app.on_startup.append(start_background_tasks)
+
+
+@sio.on('disconnect')
+async def on_disconnect(sid: str):
+    if sid in user_instances:
+        del user_instances[sid]
+
+
+@sio.on('connect')
+async def on_connect(sid: str, environ: dict):
+    await wait_warmup()
+    await create_user_instance(sid)
+
+
+@sio.on('message')
+async def handle_message(sid: str, message: dict):
+    with utils.span('request', 'message'):
+        await _handle_message(sid, message)
+
+
+async def _handle_message(sid: str, message: dict):
+    user_instance = await get_user_instance(sid)
+
+    async def status_emit(message: str):
+        await sio.emit('message',
+                       {
+                           'status': 'progress',
+                           'role': 'model',
+                           'message': message
+                       },
+                       to=sid)
+
+    try:
+        chunks = []
+        async for chunk in user_instance.get_anything_chat_stream_async(
+                q=message['message'],
+                images=message.get('images', []),
+                f=status_emit):
+            chunk = chunk.replace('•', '  *')
+            chunks.append(chunk)
+            await sio.emit('message', {
+                'status': 'partial',
+                'role': 'model',
+                'message': chunk
+            }, to=sid)
+        res = ''.join(chunks)
+        await sio.emit('message', {
+            'status': 'success',
+            'role': 'model',
+            'message': res
+        }, to=sid)
+    except Exception as e:
+        await create_user_instance(sid)
+        utils.red_log(e)
+
+        await sio.emit('message', {
+            'status': 'error',
+            'role': 'model',
+            'message': str(e)
+        }, to=sid)
+
+
+if __name__ == '__main__':
+    web.run_app(app, host='127.0.0.1', port=5000)
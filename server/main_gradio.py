@@ -3,7 +3,7 @@ from gemini import GeminiAI
 
 
 def random_response(message, history):
-    print(history)
+    # 長い履歴は、GeminiAI側で古いturnを要約してから送信する
     history_as_gemini = []
     for section in history:
         history_as_gemini.append({
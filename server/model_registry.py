@@ -0,0 +1,98 @@
+"""
+GenerativeModelをプロセス内で共有するためのレジストリ
+(model_name, generation_config, safety_settings)ごとに一つだけGenerativeModelを生成し、
+セッションごとにはchatだけを生成する
+"""
+import threading
+from vertexai.preview.generative_models import GenerativeModel
+
+import utils
+from config import SAFETY_CONFIG
+
+from typing import Optional
+
+
+class ModelRegistry():
+    def __init__(self):
+        self._models: dict[tuple, GenerativeModel] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(model_name: str, generation_config: dict, safety_settings: dict) -> tuple:
+        return (
+            model_name,
+            tuple(sorted(generation_config.items())),
+            tuple(sorted((int(k), int(v)) for k, v in safety_settings.items())),
+        )
+
+    def get(
+            self,
+            model_name: str,
+            generation_config: dict,
+            safety_settings: Optional[dict] = None
+    ) -> GenerativeModel:
+        """
+        Params
+        ---
+        model_name: str
+            ex: gemini-pro, gemini-pro-vision
+        generation_config: dict
+            ex: {"temperature": 0.9, "max_output_tokens": 2048}
+        safety_settings: Optional[dict]
+            省略した場合はconfig.SAFETY_CONFIG
+
+        Returns
+        ---
+        model: GenerativeModel
+            同じ設定であれば、同じインスタンスを返す
+        """
+        if safety_settings is None:
+            safety_settings = SAFETY_CONFIG
+        key = self._key(model_name, generation_config, safety_settings)
+
+        model = self._models.get(key)
+        if model is not None:
+            return model
+
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = GenerativeModel(
+                    model_name=model_name,
+                    generation_config=dict(generation_config),
+                    safety_settings=safety_settings,
+                )
+                self._models[key] = model
+                utils.gray_log(f'GenerativeModel({model_name})を生成 (計{len(self._models)}個)')
+        return model
+
+    def count(self) -> int:
+        """
+        生成済みのGenerativeModelの数
+        """
+        return len(self._models)
+
+    def stats(self) -> dict:
+        """
+        Returns
+        ---
+        res: dict
+            ex: {'models': 2, 'model_names': {'gemini-pro': 1, 'gemini-pro-vision': 1}}
+        """
+        with self._lock:
+            keys = list(self._models.keys())
+        model_names: dict[str, int] = {}
+        for key in keys:
+            model_names[key[0]] = model_names.get(key[0], 0) + 1
+        return {'models': len(keys), 'model_names': model_names}
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+
+registry = ModelRegistry()
+
+
+def get_model(model_name: str, generation_config: dict, safety_settings: Optional[dict] = None) -> GenerativeModel:
+    return registry.get(model_name, generation_config, safety_settings)
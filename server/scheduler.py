@@ -0,0 +1,185 @@
+"""
+メッセージの処理の順番を決めるスケジューラー
+- 同じ会話のメッセージは、届いた順に一件ずつ処理する(同じGeminiAIを同時に使用しない)
+- worker全体で同時に処理するメッセージの数をmax_concurrencyまでに制限する
+- 枠が空いた時は、待っている会話から順番に(ラウンドロビンで)一件ずつ処理し、一人のユーザーが枠を占有しないようにする
+- 待たせておけるメッセージの数を超えた場合は、QueueFullErrorで受け付けない
+- cancelで待っているメッセージを取り消し、処理中のメッセージにはcancelのEventをsetする
+
+usage
+---
+>>> from scheduler import Scheduler
+>>> scheduler = Scheduler(max_concurrency=8)
+>>> job = scheduler.submit('session_id', lambda cancel: ai.get_anything_chat('こんにちは', cancel=cancel))
+>>> job.future.result()
+'こんにちは！'
+>>> scheduler.cancel('session_id')
+0
+"""
+import dataclasses
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import utils
+from config import SCHEDULER_MAX_CONCURRENCY, SCHEDULER_MAX_QUEUE_PER_SESSION, SCHEDULER_MAX_QUEUE
+
+from typing import Any, Callable, Optional
+
+
+wait_seconds = utils.metrics.histogram(
+    'gemini_scheduler_wait_seconds', 'Time a message waits in the scheduler queue before it starts'
+)
+
+
+class QueueFullError(Exception):
+    """
+    待たせておけるメッセージの数を超えた
+    """
+
+
+@dataclasses.dataclass
+class Job:
+    session_id: str
+    # fn(cancel)
+    fn: Callable[[threading.Event], Any]
+    cancel: threading.Event = dataclasses.field(default_factory=threading.Event)
+    future: Future = dataclasses.field(default_factory=Future)
+    enqueued_at: float = dataclasses.field(default_factory=time.time)
+    # 処理を開始した時刻(待っている間はNone)
+    started_at: Optional[float] = None
+
+
+class Scheduler():
+    def __init__(
+            self,
+            max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+            max_queue_per_session: int = SCHEDULER_MAX_QUEUE_PER_SESSION,
+            max_queue: int = SCHEDULER_MAX_QUEUE,
+    ):
+        """
+        Params
+        ---
+        max_concurrency: int
+            同時に処理するメッセージの数
+        max_queue_per_session: int
+            一つの会話で、処理中のメッセージの後ろに待たせておけるメッセージの数
+        max_queue: int
+            全体で待たせておけるメッセージの数
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue_per_session = max_queue_per_session
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='scheduler')
+        # session_id → 待っているメッセージ(届いた順)
+        self._queues: dict[str, deque[Job]] = {}
+        # 待っているメッセージがあり、処理中のメッセージがない会話(先頭から処理する)
+        self._turns: deque[str] = deque()
+        # session_id → 処理中のメッセージ
+        self._running: dict[str, Job] = {}
+        self._queued = 0
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    def submit(self, session_id: str, fn: Callable[[threading.Event], Any]) -> Job:
+        """
+        メッセージの処理を順番待ちに追加する
+
+        Params
+        ---
+        session_id: str
+        fn: Callable[[threading.Event], Any]
+            cancelのEventを受け取り、処理を行う関数
+            Eventがsetされた場合は、なるべく早く終了する
+
+        Returns
+        ---
+        job: Job
+            job.futureで結果を受け取れる(待っている間に取り消された場合はcancelled)
+        """
+        with self._lock:
+            queue = self._queues.get(session_id)
+            busy = session_id in self._running or bool(queue)
+            if (busy and len(queue or ()) >= self.max_queue_per_session) or self._queued >= self.max_queue:
+                self.rejected += 1
+                raise QueueFullError(f'{session_id}: 処理待ちのメッセージが多すぎます')
+            job = Job(session_id=session_id, fn=fn)
+            if queue is None:
+                queue = self._queues[session_id] = deque()
+            queue.append(job)
+            self._queued += 1
+            if session_id not in self._running and len(queue) == 1:
+                self._turns.append(session_id)
+            self._dispatch()
+        return job
+
+    def _dispatch(self):
+        """
+        空いている枠に、順番の来た会話のメッセージを割り当てる(self._lockを取得して呼ぶ)
+        """
+        while len(self._running) < self.max_concurrency and self._turns:
+            session_id = self._turns.popleft()
+            queue = self._queues[session_id]
+            job = queue.popleft()
+            if not queue:
+                del self._queues[session_id]
+            self._queued -= 1
+            self._running[session_id] = job
+            job.started_at = time.time()
+            wait_seconds.observe(job.started_at - job.enqueued_at)
+            self._executor.submit(self._run, job)
+
+    def _run(self, job: Job):
+        if job.future.set_running_or_notify_cancel():
+            try:
+                job.future.set_result(job.fn(job.cancel))
+            except Exception as e:
+                job.future.set_exception(e)
+        with self._lock:
+            self._running.pop(job.session_id, None)
+            self.completed += 1
+            # 同じ会話の次のメッセージは、他の会話の後ろに並べる
+            if job.session_id in self._queues:
+                self._turns.append(job.session_id)
+            self._dispatch()
+
+    def cancel(self, session_id: str) -> int:
+        """
+        会話の待っているメッセージを取り消し、処理中のメッセージにcancelを通知する
+
+        Returns
+        ---
+        count: int
+            取り消し・通知したメッセージの数
+        """
+        with self._lock:
+            # 処理中のメッセージへの通知・待っているメッセージの取り消しを先に行う
+            running = self._running.get(session_id)
+            if running is not None:
+                running.cancel.set()
+            queue = self._queues.pop(session_id, deque())
+            for job in queue:
+                job.cancel.set()
+                job.future.cancel()
+            self._queued -= len(queue)
+            # 処理中のメッセージがある会話は、_turnsに含まれない
+            if queue and session_id in self._turns:
+                self._turns.remove(session_id)
+            count = len(queue) + (running is not None)
+            self.cancelled += count
+        return count
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'max_concurrency': self.max_concurrency,
+                'running': len(self._running),
+                'queued': self._queued,
+                'waiting_sessions': len(self._turns),
+                'completed': self.completed,
+                'cancelled': self.cancelled,
+                'rejected': self.rejected,
+            }
@@ -0,0 +1,392 @@
+"""
+会話の状態(GeminiAI.to_dict)を保存するストア
+SQLiteSessionStoreを使用すると、プロセスのメモリに関係なく会話を保持でき、
+再接続したクライアントは同じsession_idで会話を再開できる
+session_idはサーバーが発行してSessionIdSignerで署名し、クライアントが作ったid・他のクライアントのidでは会話に参加できない
+複数のworker・ノードで動かす場合は、全workerで同じSQLiteファイル、もしくはRedisSessionStoreを使用する
+"""
+import abc
+import dataclasses
+import hashlib
+import hmac
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from config import SESSION_STORE, SESSION_DB_PATH, SESSION_REDIS_URL, SESSION_TTL, SESSION_MAX_LIVE
+
+from typing import Any, Optional, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # geminiはvertexaiを読み込むため、最初のセッションを作成する時にimportする(起動を速くする)
+    from gemini import GeminiAI
+
+
+@dataclasses.dataclass
+class SessionRecord:
+    state: dict
+    # 保存するたびに増える番号(他のworkerが更新したかどうかの判定に使用する)
+    version: int
+
+
+class SessionStore(abc.ABC):
+    @abc.abstractmethod
+    def get(self, session_id: str) -> Optional[SessionRecord]:
+        ...
+
+    @abc.abstractmethod
+    def version(self, session_id: str) -> int:
+        """
+        保存されていない場合は0
+        """
+        ...
+
+    @abc.abstractmethod
+    def save(self, session_id: str, state: dict) -> int:
+        """
+        保存し、新しいversionを返す
+        """
+        ...
+
+    @abc.abstractmethod
+    def touch(self, session_id: str):
+        ...
+
+    @abc.abstractmethod
+    def delete(self, session_id: str):
+        ...
+
+    @abc.abstractmethod
+    def expire(self, older_than: float) -> list[str]:
+        """
+        last_activeがolder_thanより前のセッションを削除し、削除したsession_idを返す
+        """
+        ...
+
+    @abc.abstractmethod
+    def count(self) -> int:
+        ...
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self):
+        self._sessions: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[SessionRecord]:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return SessionRecord(state=session['state'], version=session['version']) if session else None
+
+    def version(self, session_id: str) -> int:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session['version'] if session else 0
+
+    def save(self, session_id: str, state: dict) -> int:
+        with self._lock:
+            version = self._sessions.get(session_id, {}).get('version', 0) + 1
+            self._sessions[session_id] = {'state': state, 'version': version, 'last_active': time.time()}
+            return version
+
+    def touch(self, session_id: str):
+        with self._lock:
+            if session_id in self._sessions:
+                self._sessions[session_id]['last_active'] = time.time()
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def expire(self, older_than: float) -> list[str]:
+        with self._lock:
+            expired = [
+                session_id for session_id, session in self._sessions.items()
+                if session['last_active'] < older_than
+            ]
+            for session_id in expired:
+                del self._sessions[session_id]
+        return expired
+
+    def count(self) -> int:
+        return len(self._sessions)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    WALモードのSQLiteにセッションを保存する
+    期限切れのセッションは、last_activeのインデックスを使用して削除する
+    同じファイルを使用すれば、同じノード上の複数のworkerで共有できる
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 0,
+                    last_active REAL NOT NULL
+                )
+            ''')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(sessions)')]
+            if 'version' not in columns:
+                conn.execute('ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_last_active ON sessions (last_active)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3.Connectionはスレッド間で共有できないため、スレッドごとに接続する
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, session_id: str) -> Optional[SessionRecord]:
+        row = self._connection().execute(
+            'SELECT state, version FROM sessions WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        return SessionRecord(state=json.loads(row[0]), version=row[1]) if row else None
+
+    def version(self, session_id: str) -> int:
+        row = self._connection().execute(
+            'SELECT version FROM sessions WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def save(self, session_id: str, state: dict) -> int:
+        with self._connection() as conn:
+            row = conn.execute(
+                '''
+                INSERT INTO sessions (session_id, state, version, last_active) VALUES (?, ?, 1, ?)
+                ON CONFLICT(session_id) DO UPDATE SET
+                    state = excluded.state,
+                    version = sessions.version + 1,
+                    last_active = excluded.last_active
+                RETURNING version
+                ''',
+                (session_id, json.dumps(state, ensure_ascii=False), time.time())
+            ).fetchone()
+        return row[0]
+
+    def touch(self, session_id: str):
+        with self._connection() as conn:
+            conn.execute('UPDATE sessions SET last_active = ? WHERE session_id = ?', (time.time(), session_id))
+
+    def delete(self, session_id: str):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+
+    def expire(self, older_than: float) -> list[str]:
+        with self._connection() as conn:
+            rows = conn.execute(
+                'SELECT session_id FROM sessions WHERE last_active < ?', (older_than,)
+            ).fetchall()
+            conn.execute('DELETE FROM sessions WHERE last_active < ?', (older_than,))
+        return [row[0] for row in rows]
+
+    def count(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Redisにセッションを保存する(複数ノードで共有する場合)
+    期限切れの判定には、last_activeをスコアにしたsorted setを使用する
+    """
+
+    def __init__(self, url: str, prefix='personal-gemini'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._active_key = f'{prefix}:sessions:last_active'
+
+    def _key(self, session_id: str) -> str:
+        return f'{self.prefix}:session:{session_id}'
+
+    def get(self, session_id: str) -> Optional[SessionRecord]:
+        state, version = self.client.hmget(self._key(session_id), 'state', 'version')
+        if state is None:
+            return None
+        return SessionRecord(state=json.loads(state), version=int(version or 0))
+
+    def version(self, session_id: str) -> int:
+        return int(self.client.hget(self._key(session_id), 'version') or 0)
+
+    def save(self, session_id: str, state: dict) -> int:
+        pipe = self.client.pipeline()
+        pipe.hincrby(self._key(session_id), 'version', 1)
+        pipe.hset(self._key(session_id), 'state', json.dumps(state, ensure_ascii=False))
+        pipe.zadd(self._active_key, {session_id: time.time()})
+        version, _, _ = pipe.execute()
+        return int(version)
+
+    def touch(self, session_id: str):
+        self.client.zadd(self._active_key, {session_id: time.time()}, xx=True)
+
+    def delete(self, session_id: str):
+        pipe = self.client.pipeline()
+        pipe.delete(self._key(session_id))
+        pipe.zrem(self._active_key, session_id)
+        pipe.execute()
+
+    def expire(self, older_than: float) -> list[str]:
+        expired = [
+            session_id.decode('utf-8')
+            for session_id in self.client.zrangebyscore(self._active_key, '-inf', f'({older_than}')
+        ]
+        if expired:
+            pipe = self.client.pipeline()
+            pipe.delete(*[self._key(session_id) for session_id in expired])
+            pipe.zrem(self._active_key, *expired)
+            pipe.execute()
+        return expired
+
+    def count(self) -> int:
+        return self.client.zcard(self._active_key)
+
+
+def create_session_store() -> SessionStore:
+    if SESSION_STORE == 'memory':
+        return MemorySessionStore()
+    if SESSION_STORE == 'sqlite':
+        return SQLiteSessionStore(SESSION_DB_PATH)
+    if SESSION_STORE == 'redis':
+        return RedisSessionStore(SESSION_REDIS_URL)
+    raise ValueError("SESSION_STORE is memory, sqlite or redis")
+
+
+class SessionIdSigner():
+    """
+    サーバーが発行したsession_idにHMACで署名し、クライアントから受け取ったsessionIdを検証する
+
+    usage
+    ---
+    >>> signer = SessionIdSigner(app.config['SECRET_KEY'])
+    >>> session_id, token = signer.issue()
+    >>> signer.verify(token) == session_id
+    True
+    >>> signer.verify('other-client-id') is None
+    True
+    """
+
+    # uuid4().hex(32文字) + '.' + sha256のhex(64文字)
+    max_length = 97
+
+    def __init__(self, secret_key: Union[str, bytes]):
+        self._key = secret_key.encode('utf-8') if isinstance(secret_key, str) else secret_key
+
+    def _sign(self, session_id: str) -> str:
+        return hmac.new(self._key, f'session-id:{session_id}'.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def issue(self) -> tuple[str, str]:
+        """
+        Returns
+        ---
+        session_id: str
+            保存先のキー
+        token: str
+            クライアントに渡し、再接続時にsessionIdとして受け取る値
+        """
+        session_id = uuid.uuid4().hex
+        return session_id, f'{session_id}.{self._sign(session_id)}'
+
+    def verify(self, token: Any) -> Optional[str]:
+        """
+        サーバーが発行したtokenの場合はsession_id、それ以外(形式・長さ・署名が不正)はNone
+        """
+        if not isinstance(token, str) or len(token) > self.max_length:
+            return None
+        session_id, _, signature = token.partition('.')
+        if not session_id or not hmac.compare_digest(signature, self._sign(session_id)):
+            return None
+        return session_id
+
+
+class SessionManager():
+    """
+    SessionStoreの前段で、最近使われたGeminiAIをSESSION_MAX_LIVE件までメモリに保持する
+    メモリにないセッション、もしくは他のworkerが更新したセッションは、使われた時点でストアから復元する
+
+    usage
+    ---
+    >>> sessions = SessionManager(create_session_store())
+    >>> ai = sessions.get('session_id')
+    >>> ai.get_anything_chat('こんにちは')
+    >>> sessions.save('session_id', ai)
+    """
+
+    def __init__(self, store: SessionStore, ttl: float = SESSION_TTL, max_live: int = SESSION_MAX_LIVE):
+        self.store = store
+        self.ttl = ttl
+        self.max_live = max_live
+        # session_id → (GeminiAI, 復元・保存した時点のversion)
+        self._live: OrderedDict[str, tuple['GeminiAI', int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> 'GeminiAI':
+        from gemini import GeminiAI
+
+        with self._lock:
+            live = self._live.get(session_id)
+            if live is not None:
+                self._live.move_to_end(session_id)
+        if live is not None and live[1] == self.store.version(session_id):
+            self.store.touch(session_id)
+            return live[0]
+
+        record = self.store.get(session_id)
+        if record:
+            instance = GeminiAI.from_dict(record.state)
+            version = record.version
+            self.store.touch(session_id)
+        else:
+            instance = GeminiAI()
+            version = self.store.save(session_id, instance.to_dict())
+        instance.user = session_id
+        self._add_live(session_id, instance, version)
+        return instance
+
+    def _add_live(self, session_id: str, instance: 'GeminiAI', version: int):
+        with self._lock:
+            self._live[session_id] = (instance, version)
+            self._live.move_to_end(session_id)
+            while len(self._live) > self.max_live:
+                self._live.popitem(last=False)
+
+    def save(self, session_id: str, instance: 'GeminiAI'):
+        version = self.store.save(session_id, instance.to_dict())
+        self._add_live(session_id, instance, version)
+
+    def reset(self, session_id: str) -> 'GeminiAI':
+        from gemini import GeminiAI
+
+        instance = GeminiAI()
+        instance.user = session_id
+        self.save(session_id, instance)
+        return instance
+
+    def release(self, session_id: str):
+        """
+        メモリからのみ削除する(ストアには残すため、再接続時に再開できる)
+        """
+        with self._lock:
+            self._live.pop(session_id, None)
+
+    def expire(self) -> list[str]:
+        expired = self.store.expire(time.time() - self.ttl)
+        with self._lock:
+            for session_id in expired:
+                self._live.pop(session_id, None)
+        return expired
+
+    def stats(self) -> dict:
+        return {'live': len(self._live), 'stored': self.store.count()}
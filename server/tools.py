@@ -1,78 +1,345 @@
-from vertexai.preview.generative_models import Tool, FunctionDeclaration
-from typing import List
+"""
+Geminiに渡すtoolのレジストリ
+toolごとにスキーマ・実行する関数・タイムアウト・キャッシュの可否・並列実行の区分を一か所で宣言し、
+function_callは名前で引いて実行する
+外部へのリクエストなど引数だけで決まる処理(ToolSpec.fetch)は、同じtool・引数の同時の呼び出しを
+セッションをまたいで一回の実行にまとめる(TOOL_MEMO_TTLを指定した場合は、その間結果を再利用する)
+fetchの中で既に同時の呼び出しをまとめているtool(google検索・スクレイピング)は、ToolSpec.single_flight=Falseで二重にまとめない
+
+usage
+---
+>>> from tools import tool_registry
+>>> tool = tool_registry.gen_tool()
+>>> future = tool_registry.submit(function_call, query='今日の天気')
+>>> future.result()
+Part(function_response=...)
+"""
+import dataclasses
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from vertexai.preview.generative_models import Tool, FunctionDeclaration, Part
+from typing import Any, Callable, List, Optional
 
 import config
+import utils
+from config import TOOL_MAX_WORKERS, TOOL_ASYNC_MAX_WORKERS, TOOL_TIMEOUT, TOOL_RESULT_TOKEN_BUDGET, TOOL_MEMO_TTL, TOOL_MEMO_MAX_ENTRIES
 
 
-def gen_tool_list() -> Tool:
-    function_declarations: List[FunctionDeclaration] = []
-
-    function_declarations.append(
-        FunctionDeclaration(
-            name="get_outer_html",
-            description="Used when you want to get more detailed information based on the URL",
-            parameters={
-                "type": "object",
-                "properties": {
-                        "q": {
-                            "type": "string",
-                            "description": "URL"
-                        }
-                },
-                "required": ["q"]
-            }
-        ),
-    )
-
-    function_declarations.append(
-        FunctionDeclaration(
-            name="get_now_date_at_ISO",
-            description="Get the current date and time in ISO8601 format",
-            parameters={
-                "type": "object",
-                "properties": {},
-            }
-        ),
-    )
-
-    if config.GOOGLE_CSE_ID and config.GOOGLE_API_KEY:
-        function_declarations.append(
-            FunctionDeclaration(
-                name="get_default_serch",
-                description="When you need to search, do a google search",
-                parameters={
-                    "type": "object",
-                    "properties": {
-                            "q": {
-                                "type": "string",
-                                "description": "Query used for google search. Be able to search by word."
-                            }
-                    },
-                    "required": ["q"]
-                }
-            )
+# 並列実行の区分
+# スレッドプールで実行する(外部へのリクエストなど)
+CONCURRENCY_IO = 'io'
+# 呼び出し元のスレッドでそのまま実行する(すぐに終わる処理)
+CONCURRENCY_INLINE = 'inline'
+
+_SPACE_RE = re.compile(r'\s+')
+
+# 一回のターンで複数のtoolが呼ばれた場合に、並列で実行するためのスレッドプール
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix='tool')
+# asyncサーバー(GeminiAI._call_functions_async)用のスレッドプール
+# 待っている間のスレッドはイベントループを止めないため、会話の数に合わせて多めに用意する(スレッドは必要になった時に作られる)
+async_tool_executor = ThreadPoolExecutor(max_workers=TOOL_ASYNC_MAX_WORKERS, thread_name_prefix='tool-async')
+
+
+@dataclasses.dataclass
+class ToolSpec:
+    name: str
+    description: str
+    parameters: dict
+    # (function_callの引数, ユーザーの質問, fetchの結果) -> function_responseのresponse
+    # fetchの結果は他のセッションと共有するため、変更しない
+    handler: Callable[[dict, str, Any], dict]
+    # 引数だけで結果が決まる処理(外部へのリクエストなど) (function_callの引数) -> 結果
+    # 同じ引数の同時の呼び出しは、セッションをまたいで一回の実行にまとめる
+    fetch: Optional[Callable[[dict], Any]] = None
+    # fetchの同時の呼び出しを、ToolRegistryで一回の実行にまとめるかどうか(fetchの中でまとめている場合はFalse)
+    single_flight: bool = True
+    # 実行のタイムアウト(秒)
+    timeout: float = TOOL_TIMEOUT
+    # 結果・結果を使った回答を再利用してよいかどうか(時刻など、呼び出すたびに結果が変わるtoolはFalse)
+    cacheable: bool = False
+    # CONCURRENCY_IO or CONCURRENCY_INLINE
+    concurrency: str = CONCURRENCY_IO
+    # 実行開始時にクライアントへ通知するメッセージ
+    progress_message: str = ''
+    # toolを使用できるかどうか(APIキーの設定など)
+    enabled: Callable[[], bool] = lambda: True
+
+    def declaration(self) -> FunctionDeclaration:
+        return FunctionDeclaration(
+            name=self.name,
+            description=self.description,
+            parameters=self.parameters
         )
 
-    if config.NOTION_API_KEY:
-        function_declarations.append(
-            FunctionDeclaration(
-                name="notion_search",
-                description="Be able to access to personal information such as login information and search information about your own services(ex:eメンテ,Pureha,省エネ,SEAMO).",
-                parameters={
-                    "type": "object",
-                    "properties": {
-                        "q": {
-                            "type": "string",
-                            "description": "Query used for Notion.Be able to search by word."
-                        },
-                        "start_cursor": {
-                            "type": "string",
-                            "description": "Start Id of next page.Be able to also search with notion"
-                        }
-                    },
-                    "required": ["q"]
+
+class ToolRegistry():
+    def __init__(
+            self,
+            executor: ThreadPoolExecutor = tool_executor,
+            memo_ttl: float = TOOL_MEMO_TTL,
+            memo_max_entries: int = TOOL_MEMO_MAX_ENTRIES,
+    ):
+        """
+        Params
+        ---
+        executor: ThreadPoolExecutor
+            toolを実行するスレッドプール
+        memo_ttl: float
+            cacheableなtoolのfetchの結果を再利用する期間(秒、0の場合は再利用しない)
+        memo_max_entries: int
+            再利用する結果の最大数
+        """
+        self.executor = executor
+        self._tools: dict[str, ToolSpec] = {}
+        self.memo_ttl = memo_ttl
+        self.memo_max_entries = memo_max_entries
+        # 同じtool・引数のfetchを、一回の実行にまとめる
+        self.flight = utils.SingleFlight()
+        # キー → (期限, fetchの結果)
+        self._memo: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._memo_lock = threading.Lock()
+        self.memo_hits = 0
+
+    def register(self, spec: ToolSpec) -> ToolSpec:
+        self._tools[spec.name] = spec
+        return spec
+
+    def get(self, name: str) -> Optional[ToolSpec]:
+        return self._tools.get(name)
+
+    def specs(self) -> List[ToolSpec]:
+        """
+        使用できるtool(登録順)
+        """
+        return [spec for spec in self._tools.values() if spec.enabled()]
+
+    def gen_tool(self) -> Tool:
+        return Tool(function_declarations=[spec.declaration() for spec in self.specs()])
+
+    @staticmethod
+    def key(function_call) -> str:
+        """
+        toolの名前と正規化した引数から、同じ呼び出しかどうかを判定するキーを作る
+        """
+        return _key(function_call.name, function_call.args)
+
+    def timeout(self, name: str) -> float:
+        spec = self.get(name)
+        return spec.timeout if spec else TOOL_TIMEOUT
+
+    def call(self, function_call, query: str = '') -> Optional[Part]:
+        """
+        function_callに対応するtoolを実行し、function_responseを返す
+        登録されていないtoolの場合はNone
+        """
+        spec = self.get(function_call.name)
+        if spec is None:
+            return None
+        with utils.span('tool', spec.name):
+            fetched = self.fetch(spec, function_call.args) if spec.fetch is not None else None
+            response = spec.handler(function_call.args, query, fetched)
+        return Part.from_function_response(name=spec.name, response=response)
+
+    def fetch(self, spec: ToolSpec, args: dict) -> Any:
+        """
+        spec.fetchを実行する
+        同じtool・引数の同時の呼び出しは一回の実行にまとめ、cacheableなtoolの結果はmemo_ttlの間再利用する
+        """
+        key = _key(spec.name, args)
+        memoize = bool(self.memo_ttl) and spec.cacheable
+        if memoize:
+            with self._memo_lock:
+                memo = self._memo.get(key)
+                if memo is not None and memo[0] > time.time():
+                    self._memo.move_to_end(key)
+                    self.memo_hits += 1
+                    return memo[1]
+        if not spec.single_flight:
+            return self._fetch(spec, key, args, memoize)
+        return self.flight.do(key, self._fetch, spec, key, args, memoize)
+
+    def _fetch(self, spec: ToolSpec, key: str, args: dict, memoize: bool) -> Any:
+        result = spec.fetch(args)
+        # 取得に失敗した(空の)結果は再利用しない
+        if memoize and result:
+            with self._memo_lock:
+                self._memo[key] = (time.time() + self.memo_ttl, result)
+                self._memo.move_to_end(key)
+                while len(self._memo) > self.memo_max_entries:
+                    self._memo.popitem(last=False)
+        return result
+
+    def stats(self) -> dict:
+        return {**self.flight.stats(), 'memo_hits': self.memo_hits, 'memo_entries': len(self._memo)}
+
+    def submit(self, function_call, query: str = '', executor: Optional[ThreadPoolExecutor] = None) -> Future:
+        """
+        toolの並列実行の区分に従って実行を開始する
+        CONCURRENCY_INLINEのtoolは、呼び出し元のスレッドで実行して完了済みのFutureを返す
+        executorを省略した場合は、self.executorで実行する
+        """
+        spec = self.get(function_call.name)
+        if spec is not None and spec.concurrency == CONCURRENCY_INLINE:
+            future = Future()
+            try:
+                future.set_result(self.call(function_call, query))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return (executor or self.executor).submit(self.call, function_call, query)
+
+
+def _normalize_args(value):
+    """
+    文字列は全角・半角と空白の違いをまとめる(URLなどがあるため、大文字・小文字は区別する)
+    """
+    if isinstance(value, str):
+        return _SPACE_RE.sub(' ', unicodedata.normalize('NFKC', value)).strip()
+    if isinstance(value, dict):
+        return {k: _normalize_args(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize_args(v) for v in value]
+    return value
+
+
+def _key(name: str, args: dict) -> str:
+    return json.dumps([name, _normalize_args(args)], sort_keys=True, ensure_ascii=False)
+
+
+def _fetch_outer_html(args: dict) -> str:
+    return utils.get_outer_html(url=args['q'])
+
+
+def _get_outer_html(args: dict, query: str, html: str) -> dict:
+    # 結果はTOOL_RESULT_TOKEN_BUDGETに収まるよう、queryに関連する部分に削減する
+    text = utils.reduce_html(html, query) if html else ''
+    return {
+        "result": bool(text),
+        'message': text if text else 'URLが不正 or 取得できませんでした'
+    }
+
+
+def _get_now_date_at_ISO(args: dict, query: str, fetched: None) -> dict:
+    return {"result": True, 'message': utils.get_now_date_at_ISO()}
+
+
+def _fetch_default_serch(args: dict) -> str:
+    return utils.get_default_serch(args['q'])
+
+
+def _get_default_serch(args: dict, query: str, result: str) -> dict:
+    return {"result": True, 'message': result}
+
+
+def _fetch_notion_search(args: dict):
+    return utils.Notion().search(query=args['q'], start_cursor=args.get('start_cursor', ''))
+
+
+def _notion_search(args: dict, query: str, search_res) -> dict:
+    q: str = args['q']
+    if not search_res.result:
+        return {
+            "result": False,
+            'message': 'Notionの検索に失敗しました。queryを確認してください。'
+        }
+    # search_resは他のセッションと共有するため、削減したページは複製して作る
+    page_budget = TOOL_RESULT_TOKEN_BUDGET // len(search_res.result)
+    reduced = dataclasses.replace(search_res, result=[
+        dataclasses.replace(page, content=utils.reduce_text(page.content, f'{query} {q}', page_budget))
+        for page in search_res.result
+    ])
+    return {
+        "result": True,
+        'message': json.dumps(reduced.to_dict(), ensure_ascii=False)
+    }
+
+
+tool_registry = ToolRegistry()
+
+tool_registry.register(ToolSpec(
+    name="get_outer_html",
+    description="Used when you want to get more detailed information based on the URL",
+    parameters={
+        "type": "object",
+        "properties": {
+                "q": {
+                    "type": "string",
+                    "description": "URL"
                 }
-            )
-        )
+        },
+        "required": ["q"]
+    },
+    fetch=_fetch_outer_html,
+    # get_outer_htmlがURLごとにscraping_flightでまとめる
+    single_flight=False,
+    handler=_get_outer_html,
+    cacheable=True,
+    progress_message='スクレイピングを開始',
+))
+
+tool_registry.register(ToolSpec(
+    name="get_now_date_at_ISO",
+    description="Get the current date and time in ISO8601 format",
+    parameters={
+        "type": "object",
+        "properties": {},
+    },
+    handler=_get_now_date_at_ISO,
+    concurrency=CONCURRENCY_INLINE,
+))
 
-    return Tool(function_declarations=function_declarations)
+tool_registry.register(ToolSpec(
+    name="get_default_serch",
+    description="When you need to search, do a google search",
+    parameters={
+        "type": "object",
+        "properties": {
+                "q": {
+                    "type": "string",
+                    "description": "Query used for google search. Be able to search by word."
+                }
+        },
+        "required": ["q"]
+    },
+    fetch=_fetch_default_serch,
+    # get_default_serchがqueryごとにgoogle_search_flightでまとめる
+    single_flight=False,
+    handler=_get_default_serch,
+    cacheable=True,
+    progress_message='goole検索を開始',
+    enabled=lambda: bool(config.GOOGLE_CSE_ID and config.GOOGLE_API_KEY),
+))
+
+tool_registry.register(ToolSpec(
+    name="notion_search",
+    description="Be able to access to personal information such as login information and search information about your own services(ex:eメンテ,Pureha,省エネ,SEAMO).",
+    parameters={
+        "type": "object",
+        "properties": {
+            "q": {
+                "type": "string",
+                "description": "Query used for Notion.Be able to search by word."
+            },
+            "start_cursor": {
+                "type": "string",
+                "description": "Start Id of next page.Be able to also search with notion"
+            }
+        },
+        "required": ["q"]
+    },
+    fetch=_fetch_notion_search,
+    handler=_notion_search,
+    cacheable=True,
+    progress_message='Notion検索を開始',
+    enabled=lambda: bool(config.NOTION_API_KEY),
+))
+
+
+def gen_tool_list() -> Tool:
+    return tool_registry.gen_tool()
@@ -1,18 +1,62 @@
-from .get_google import (get_default_serch)
+import importlib
+
+from .cache import (CacheEntry, LRUCache, DiskCache, TieredCache)
+from .metrics import (metrics, span, add_stats_collector)
 from .log import (green_log, red_log, gray_log)
-from .notion import (Notion)
 from .other import (markdown_to_dict, get_now_date_at_ISO)
-from .scraping import (get_outer_html)
+from .singleflight import (SingleFlight)
+
+
+# requests・BeautifulSoup・Pillowなど、importに時間がかかるモジュールは最初に参照した時に読み込む
+# 名前 → 定義しているモジュール
+_LAZY_EXPORTS = {
+    'get_default_serch': 'get_google', 'google_search_cache': 'get_google',
+
+    'HttpClient': 'http', 'RateLimiter': 'http', 'http_client': 'http',
+
+    'ImageTooLargeError': 'image', 'load_image': 'image', 'load_images': 'image', 'image_cache': 'image',
+
+    'Notion': 'notion', 'NotionMirror': 'notion',
+
+    'estimate_tokens': 'reduce', 'html_to_text': 'reduce', 'reduce_text': 'reduce', 'reduce_html': 'reduce',
+
+    'get_outer_html': 'scraping', 'prefetch_outer_html': 'scraping', 'scraping_cache': 'scraping',
+}
+
+
+def __getattr__(name: str):
+    module = _LAZY_EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{module}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(__all__))
 
 
 __all__ = [
-    'get_default_serch',
+    'CacheEntry', 'LRUCache', 'DiskCache', 'TieredCache',
+
+    'get_default_serch', 'google_search_cache',
+
+    'HttpClient', 'RateLimiter', 'http_client',
+
+    'ImageTooLargeError', 'load_image', 'load_images', 'image_cache',
+
+    'metrics', 'span', 'add_stats_collector',
 
     'green_log', 'red_log', 'gray_log',
 
-    'Notion',
+    'Notion', 'NotionMirror',
 
     'markdown_to_dict', 'get_now_date_at_ISO',
 
-    'get_outer_html',
+    'estimate_tokens', 'html_to_text', 'reduce_text', 'reduce_html',
+
+    'get_outer_html', 'prefetch_outer_html', 'scraping_cache',
+
+    'SingleFlight',
 ]
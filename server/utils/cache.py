@@ -0,0 +1,176 @@
+import dataclasses
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Union
+
+
+@dataclasses.dataclass
+class CacheEntry:
+    value: Union[str, bytes]
+    expires_at: float
+    etag: str = ''
+    last_modified: str = ''
+    mime_type: str = ''
+
+    def is_expired(self, now: Optional[float] = None) -> bool:
+        return (now or time.time()) >= self.expires_at
+
+    def size(self) -> int:
+        if isinstance(self.value, bytes):
+            return len(self.value)
+        return len(self.value.encode('utf-8'))
+
+
+class LRUCache:
+    """
+    バイト数で上限を設けたインメモリのLRUキャッシュ
+    期限切れのエントリも、再検証のために上限を超えるまでは保持する
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._sizes: dict[str, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: CacheEntry):
+        size = entry.size()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._delete(key)
+            self._entries[key] = entry
+            self._sizes[key] = size
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                old_key, _ = self._entries.popitem(last=False)
+                self._bytes -= self._sizes.pop(old_key)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._delete(key)
+
+    def _delete(self, key: str):
+        if key in self._entries:
+            del self._entries[key]
+            self._bytes -= self._sizes.pop(key)
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+
+class DiskCache:
+    """
+    ディレクトリにエントリをjsonで保存するキャッシュ
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as file:
+                return CacheEntry(**json.load(file))
+        except (FileNotFoundError, ValueError, TypeError):
+            return None
+
+    def set(self, key: str, entry: CacheEntry):
+        path = self._path(key)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(dataclasses.asdict(entry), file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> dict:
+        return {'directory': self.directory}
+
+
+class TieredCache:
+    """
+    複数のキャッシュを順に参照する
+    下位のキャッシュでヒットした場合は、上位のキャッシュにも保存する
+
+    usage
+    ---
+    >>> cache = TieredCache([LRUCache(max_bytes=1024 * 1024), DiskCache('.cache')], ttl=600)
+    >>> cache.set('key', 'value')
+    >>> cache.get('key').value
+    'value'
+    """
+
+    def __init__(self, backends: list, ttl: float):
+        self.backends = backends
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """
+        期限切れのエントリも返す(再検証に使用するため)
+        期限内かどうかは、CacheEntry.is_expiredで判定する
+        """
+        for i, backend in enumerate(self.backends):
+            entry = backend.get(key)
+            if entry is not None:
+                for upper in self.backends[:i]:
+                    upper.set(key, entry)
+                return entry
+        return None
+
+    def set(self, key: str, value: str, etag='', last_modified='') -> CacheEntry:
+        entry = CacheEntry(
+            value=value,
+            expires_at=time.time() + self.ttl,
+            etag=etag,
+            last_modified=last_modified
+        )
+        for backend in self.backends:
+            backend.set(key, entry)
+        return entry
+
+    def touch(self, key: str, entry: CacheEntry) -> CacheEntry:
+        """
+        再検証(304)に成功したエントリの期限を延長する
+        """
+        with self._lock:
+            self.revalidated += 1
+        return self.set(key, entry.value, etag=entry.etag, last_modified=entry.last_modified)
+
+    def record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidated': self.revalidated,
+            'backends': [backend.stats() for backend in self.backends],
+        }
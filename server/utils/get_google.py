@@ -1,25 +1,93 @@
-from googleapiclient.discovery import build
 import json
+import re
+import unicodedata
 
 import utils
-from config import GOOGLE_CSE_ID, GOOGLE_API_KEY
+from utils.http import http_client
+from utils.cache import LRUCache, TieredCache
+from utils.scraping import prefetch_outer_html
+from utils.singleflight import SingleFlight
+from config import (
+    GOOGLE_CSE_ID, GOOGLE_API_KEY, GOOGLE_CSE_ENDPOINT,
+    GOOGLE_SEARCH_CACHE_TTL, GOOGLE_SEARCH_CACHE_MAX_BYTES, SCRAPING_PREFETCH_TOP_N
+)
 
+_SPACE_RE = re.compile(r'\s+')
 
-def get_default_serch(title: str) -> str:
-    utils.gray_log(f"「{title}」でgoogle検索を開始...")
-    service = build("customsearch", "v1", developerKey=GOOGLE_API_KEY)
-    cse = service.cse()
-    res = cse.list(q=title, cx=GOOGLE_CSE_ID, num=10).execute()
-    results = res.get("items", [])
-    snippets = []
-    if len(results) == 0:
+# 正規化したクエリごとに検索結果を保存するキャッシュ
+google_search_cache = TieredCache([LRUCache(max_bytes=GOOGLE_SEARCH_CACHE_MAX_BYTES)], ttl=GOOGLE_SEARCH_CACHE_TTL)
+# 同じクエリの同時の検索は、一回のリクエストにまとめる
+google_search_flight = SingleFlight()
+
+
+def _normalize_query(query: str) -> str:
+    """
+    全角・半角、大文字・小文字、空白の違いをまとめる
+    """
+    return _SPACE_RE.sub(' ', unicodedata.normalize('NFKC', query)).strip().lower()
+
+
+def _search(query: str) -> str:
+    utils.gray_log(f"「{query}」でgoogle検索を開始...")
+    # Custom Search JSON APIを、共有のHTTPクライアントで直接呼び出す
+    # 使用するフィールドのみを返させ、レスポンスを小さくする
+    with utils.span('google_search'):
+        response = http_client.get(
+            GOOGLE_CSE_ENDPOINT,
+            params={
+                "key": GOOGLE_API_KEY,
+                "cx": GOOGLE_CSE_ID,
+                "q": query,
+                "num": 10,
+                "fields": "items(title,link,snippet)"
+            }
+        )
+        response.raise_for_status()
+    results = response.json().get("items", [])
+    snippets = [
+        {
+            'link': result.get('link', ''),
+            'snippet': result['snippet'],
+            'title': result.get('title', ''),
+        }
+        for result in results
+        if "snippet" in result
+    ]
+    if len(snippets) == 0:
         return "No good Google Search Result was found"
-    for result in results:
-        if "snippet" in result:
-            add_dist = {}
-            add_dist['link'] = result.get('link', '')
-            add_dist['snippet'] = result.get('snippet', '')
-            add_dist['title'] = result.get('title', '')
-            json_str = json.dumps(add_dist, ensure_ascii=False)
-            snippets.append(json_str)
-    return " ".join(snippets)
+    return json.dumps(snippets, ensure_ascii=False)
+
+
+def get_default_serch(title: str) -> str:
+    """
+    google検索の結果(link, snippet, titleのjson)を返す
+    GOOGLE_SEARCH_CACHE_TTLの間は、同じクエリの結果をキャッシュから返す
+    """
+    query = _normalize_query(title)
+    if GOOGLE_SEARCH_CACHE_TTL > 0:
+        entry = google_search_cache.get(query)
+        hit = entry is not None and not entry.is_expired()
+        google_search_cache.record(hit)
+        if hit:
+            utils.gray_log(f"「{query}」のgoogle検索の結果をキャッシュから取得")
+            _prefetch_links(entry.value)
+            return entry.value
+
+    def _search_and_cache() -> str:
+        value = _search(query)
+        if GOOGLE_SEARCH_CACHE_TTL > 0:
+            google_search_cache.set(query, value)
+        return value
+
+    value = google_search_flight.do(query, _search_and_cache)
+    _prefetch_links(value)
+    return value
+
+
+def _prefetch_links(value: str):
+    """
+    次の応答でget_outer_htmlが呼ばれることが多いため、検索結果の上位のリンクを先読みする
+    """
+    if SCRAPING_PREFETCH_TOP_N <= 0 or not value.startswith('['):
+        return
+    prefetch_outer_html([result['link'] for result in json.loads(value)], top_n=SCRAPING_PREFETCH_TOP_N)
@@ -0,0 +1,236 @@
+"""
+外部へのHTTPリクエストで共有するクライアント
+ホストごとにkeep-aliveのコネクションプールを持ち、リトライ・同時実行数の制限・タイムアウトを共通で設定する
+スクレイピング先など任意のホストにリクエストするため、ホストごとの状態は最近使用したHTTP_MAX_HOSTS件のみ保持し、
+cookieはユーザー・サイトをまたいで共有しないよう保存しない
+
+usage
+---
+>>> from utils.http import http_client
+>>> response = http_client.get('https://example.com/')
+>>> http_client.stats()
+"""
+import contextlib
+import dataclasses
+import threading
+import time
+from collections import OrderedDict
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import (
+    HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_MAX_RETRIES, HTTP_BACKOFF_FACTOR,
+    HTTP_TIMEOUT, HTTP_MAX_CONCURRENCY, HTTP_MAX_PER_HOST, HTTP_MAX_HOSTS
+)
+
+from typing import Iterable, Optional
+
+
+@dataclasses.dataclass
+class _HostState:
+    semaphore: threading.BoundedSemaphore
+    stats: dict
+    # 枠を待っている・リクエスト中の数(0の場合のみ破棄できる)
+    users: int = 0
+
+
+class HttpClient():
+    def __init__(
+            self,
+            pool_connections: int = HTTP_POOL_CONNECTIONS,
+            pool_maxsize: int = HTTP_POOL_MAXSIZE,
+            max_retries: int = HTTP_MAX_RETRIES,
+            backoff_factor: float = HTTP_BACKOFF_FACTOR,
+            timeout: float = HTTP_TIMEOUT,
+            max_concurrency: int = HTTP_MAX_CONCURRENCY,
+            max_per_host: int = HTTP_MAX_PER_HOST,
+            max_hosts: int = HTTP_MAX_HOSTS,
+    ):
+        """
+        Params
+        ---
+        pool_connections: int
+            コネクションプールを保持するホストの数
+        pool_maxsize: int
+            ホストごとに保持するコネクションの数
+        max_retries: int
+            接続エラー・429・5xxの場合のリトライ回数
+        backoff_factor: float
+            リトライの待ち時間(backoff_factor * 2 ** (n - 1)秒)
+        timeout: float
+            リクエストごとにtimeoutを指定しない場合のタイムアウト(秒)
+        max_concurrency: int
+            全体の同時リクエスト数
+        max_per_host: int
+            ホストごとの同時リクエスト数
+        max_hosts: int
+            同時実行数の制限・統計を保持するホストの数
+        """
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.max_hosts = max_hosts
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # 使用しているPOST(Notionの検索)は読み取りのみのため、リトライしてよい
+            allowed_methods=frozenset({'GET', 'HEAD', 'POST'}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        # レスポンスのcookieをセッションに保存しない(リダイレクト中のcookieは、リクエストごとに扱われる)
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._adapter = adapter
+
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        # ホスト → 状態(最近使用した順)
+        self._hosts: OrderedDict[str, _HostState] = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'errors': 0, 'in_flight': 0}
+
+    @contextlib.contextmanager
+    def _host_slot(self, host: str):
+        """
+        ホストごとの同時実行数の枠を取得する
+        max_hostsを超えた場合は、使用していない古いホストの状態を破棄する
+        """
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None:
+                state = self._hosts[host] = _HostState(
+                    semaphore=threading.BoundedSemaphore(self.max_per_host),
+                    stats={'requests': 0, 'errors': 0}
+                )
+            self._hosts.move_to_end(host)
+            state.users += 1
+            idle = [name for name, s in self._hosts.items() if s.users == 0]
+            for name in idle[:max(len(self._hosts) - self.max_hosts, 0)]:
+                del self._hosts[name]
+        try:
+            with state.semaphore:
+                yield
+        finally:
+            with self._lock:
+                state.users -= 1
+
+    def _count(self, host: str, key: str, value=1):
+        with self._lock:
+            self._stats[key] += value
+            # 枠を取得している間は、破棄されない
+            if key in self._hosts[host].stats:
+                self._hosts[host].stats[key] += value
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        requests.Session.requestと同じ引数で、制限をかけてリクエストする
+        stream=Trueの場合、同時実行数はレスポンスヘッダーの受信までを数える
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlparse(url).netloc
+
+        # ホストごとの枠を先に取得する(一つのホストへのリクエストが、全体の枠を埋めたまま待たないように)
+        with self._host_slot(host), self._semaphore:
+            self._count(host, 'requests')
+            self._count(host, 'in_flight')
+            try:
+                return self.session.request(method, url, **kwargs)
+            except requests.RequestException:
+                self._count(host, 'errors')
+                raise
+            finally:
+                self._count(host, 'in_flight', -1)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def stats(self, hosts: Optional[Iterable[str]] = None) -> dict:
+        """
+        Params
+        ---
+        hosts: Optional[Iterable[str]]
+            ホストごとの統計を返すホスト(省略した場合は全てのホスト)
+
+        Returns
+        ---
+        res: dict
+            ex: {
+                'requests': 10, 'errors': 0, 'in_flight': 1,
+                'hosts': {'api.notion.com': {'requests': 8, 'errors': 0, 'connections': 2, 'idle_connections': 1}}
+            }
+        """
+        pools = {}
+        for key in list(self._adapter.poolmanager.pools.keys()):
+            pool = self._adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            pools[pool.host] = {
+                'connections': pool.num_connections,
+                'idle_connections': pool.pool.qsize() if pool.pool else 0,
+            }
+        hosts = None if hosts is None else set(hosts)
+        with self._lock:
+            host_stats = {
+                host: dict(state.stats, **pools.get(host.split(':')[0], {}))
+                for host, state in self._hosts.items()
+                if hosts is None or host in hosts
+            }
+            return dict(self._stats, hosts=host_stats)
+
+
+class RateLimiter():
+    """
+    一秒あたりのリクエスト数を制限する(トークンバケット)
+    429を受け取った場合は、pauseで全スレッドからの送信を一時停止する
+
+    usage
+    ---
+    >>> limiter = RateLimiter(rate=3)
+    >>> limiter.acquire()
+    >>> http_client.get(url)
+    """
+
+    def __init__(self, rate: float, burst: int = 0):
+        self.rate = rate
+        self.capacity = burst or max(int(rate), 1)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    wait = self._paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+http_client = HttpClient()
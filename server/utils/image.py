@@ -0,0 +1,177 @@
+"""
+チャットに添付する画像の読み込み
+URL・ローカルパス・base64・dataURIから画像を並列に取得し、上限を超える画像は読み込みを中止する
+Pillowがある場合は、モデルが使用する解像度を超える画像を縮小して再圧縮する
+処理後の画像は、元の画像のsha256ごとにキャッシュする
+
+usage
+---
+>>> from utils.image import load_images
+>>> load_images(['https://example.com/image.png', 'data:image/png;base64,iVBORw0KGgo...'])
+[{'mime_type': 'image/png', 'data': b'...'}, {'mime_type': 'image/png', 'data': b'...'}]
+"""
+import base64
+import binascii
+import hashlib
+import io
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.cache import CacheEntry, LRUCache
+from utils.http import http_client
+from config import (
+    IMAGE_MAX_BYTES, IMAGE_MAX_WORKERS, IMAGE_MAX_DIMENSION, IMAGE_JPEG_QUALITY, IMAGE_CACHE_MAX_BYTES
+)
+
+from typing import Optional
+
+
+# 縮小した画像を保存する形式(それ以外の形式はJPEGで保存する)
+_RESIZE_FORMATS = {'image/jpeg': 'JPEG', 'image/png': 'PNG', 'image/webp': 'WEBP'}
+
+# 処理後の画像を、元の画像のsha256ごとに保存するキャッシュ
+image_cache = LRUCache(max_bytes=IMAGE_CACHE_MAX_BYTES)
+_image_executor = ThreadPoolExecutor(max_workers=IMAGE_MAX_WORKERS, thread_name_prefix='image')
+
+
+class ImageTooLargeError(ValueError):
+    pass
+
+
+def _check_size(size: int, image: str):
+    if IMAGE_MAX_BYTES and size > IMAGE_MAX_BYTES:
+        raise ImageTooLargeError(f"Image is larger than {IMAGE_MAX_BYTES} bytes: {image[:100]}")
+
+
+def _download(url: str) -> tuple[bytes, str]:
+    """
+    上限のバイト数を超えた時点で読み込みを中止する
+
+    Returns
+    ---
+    data: bytes
+    mime_type: str
+        Content-Typeのmime type
+    """
+    with http_client.get(url, stream=True) as response:
+        response.raise_for_status()
+        _check_size(int(response.headers.get('Content-Length') or 0), url)
+        buffer = bytearray()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            buffer += chunk
+            _check_size(len(buffer), url)
+        mime_type = response.headers.get('Content-Type', '').split(';', 1)[0].strip()
+    return bytes(buffer), mime_type
+
+
+def _decode_base64(data: str, image: str) -> bytes:
+    # デコード前に、デコード後のサイズを確認する
+    _check_size(len(data) * 3 // 4, image)
+    try:
+        return base64.b64decode(data)
+    except binascii.Error as e:
+        raise ValueError(f"Could not decode image: {image[:100]}") from e
+
+
+def _read(image: str, mime_type: Optional[str]) -> tuple[bytes, str]:
+    if image.startswith(('http://', 'https://')):
+        data, content_type = _download(image)
+        return data, mime_type or (content_type if content_type.startswith('image/') else '')
+
+    if image.startswith(('data:image/', 'data:application/')):
+        comma = image.index(',')
+        return _decode_base64(image[comma + 1:], image), image[5:comma].split(';', 1)[0]
+
+    if os.path.isfile(image):
+        _check_size(os.path.getsize(image), image)
+        with open(image, 'rb') as file:
+            return file.read(), mime_type or ''
+
+    # If the file is not found, assuming it is a base64 encoded image
+    return _decode_base64(image, image), mime_type or ''
+
+
+def _resize(data: bytes, mime_type: str) -> tuple[bytes, str]:
+    """
+    長辺がIMAGE_MAX_DIMENSIONを超える画像を縮小する
+    Pillowがない場合・画像として読み込めない場合は、そのまま返す
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return data, mime_type
+
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if max(img.size) <= IMAGE_MAX_DIMENSION:
+                return data, mime_type
+            # JPEGは縮小した解像度で読み込む(全画素をデコードしない)
+            img.draft('RGB', (IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+            # 再圧縮でEXIFが失われるため、向きを画素に反映する
+            resized = ImageOps.exif_transpose(img)
+            resized.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+
+            save_format = _RESIZE_FORMATS.get(mime_type, 'JPEG')
+            if save_format == 'JPEG' and resized.mode not in ('RGB', 'L'):
+                resized = resized.convert('RGB')
+            output = io.BytesIO()
+            resized.save(output, format=save_format, quality=IMAGE_JPEG_QUALITY, optimize=True)
+    except Exception:
+        return data, mime_type
+
+    if output.tell() >= len(data):
+        return data, mime_type
+    return output.getvalue(), Image.MIME[save_format]
+
+
+def load_image(image: str, mime_type: Optional[str] = None) -> dict:
+    """
+    Params
+    ---
+    image: str
+        image path(local path) or base64 or dateURI or URL
+        ex: 'https://example.com/image.png'
+        ex: 'images/image.png' (local path)
+        ex: 'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAA...'
+
+    mime_type: Optional[str]
+        ※base64の場合は必須
+        ex: 'image/png'
+        ex: 'image/jpeg'
+
+    Returns
+    ---
+    res: dict
+        ex: {
+            'mime_type': 'image/png',
+            'data': bytes
+        }
+    """
+    data, mime_type = _read(image, mime_type)
+    if not mime_type:
+        mime_type, _ = mimetypes.guess_type(image)
+        if not mime_type:
+            raise ValueError(
+                f"Could not determine mime type for image: {image[:100]}")
+
+    if not IMAGE_MAX_DIMENSION:
+        return {'mime_type': mime_type, 'data': data}
+
+    key = f'{hashlib.sha256(data).hexdigest()}:{IMAGE_MAX_DIMENSION}:{IMAGE_JPEG_QUALITY}'
+    entry = image_cache.get(key)
+    if entry is not None:
+        return {'mime_type': entry.mime_type, 'data': entry.value}
+    data, mime_type = _resize(data, mime_type)
+    image_cache.set(key, CacheEntry(value=data, expires_at=float('inf'), mime_type=mime_type))
+    return {'mime_type': mime_type, 'data': data}
+
+
+def load_images(images: list[str]) -> list[dict]:
+    """
+    複数の画像を並列に読み込む(順番はimagesと同じ)
+    """
+    if len(images) <= 1:
+        return [load_image(image) for image in images]
+    futures = [_image_executor.submit(load_image, image) for image in images]
+    return [future.result() for future in futures]
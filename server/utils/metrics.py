@@ -0,0 +1,236 @@
+"""
+Prometheusのテキスト形式で公開するメトリクス
+カウンター・ヒストグラム・ゲージと、処理時間を計測するspanを提供する
+
+usage
+---
+>>> from utils.metrics import metrics, span
+>>> with span('tool', 'get_outer_html'):
+...     utils.get_outer_html(url)
+>>> metrics.render()
+'# HELP gemini_span_duration_seconds ...'
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from typing import Callable, Iterator
+
+
+# 処理時間のヒストグラムのバケット(秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric():
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}'] + self._samples()
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in values]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ラベルごとの[バケットごとの件数..., 合計, 件数]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            if index < len(self.buckets):
+                values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = [(key, list(values)) for key, values in self._values.items()]
+        lines = []
+        for key, values in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            le = 'le="+Inf"'
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {values[-1]}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {values[-2]!r}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {values[-1]}')
+        return lines
+
+
+class MetricsRegistry():
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._collectors: list[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+            self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], None]):
+        """
+        render時に呼び出す関数を登録する(キャッシュの統計などをゲージに反映するため)
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        """
+        Prometheusのテキスト形式(text/plain; version=0.0.4)
+        """
+        for collector in list(self._collectors):
+            try:
+                collector()
+            except Exception:
+                pass
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+span_duration = metrics.histogram(
+    'gemini_span_duration_seconds', 'Duration of model calls, tool calls and outbound requests', ('span', 'name')
+)
+span_errors = metrics.counter(
+    'gemini_span_errors_total', 'Spans that ended with an exception', ('span', 'name')
+)
+
+
+@contextmanager
+def span(span_name: str, name: str = '') -> Iterator[None]:
+    """
+    処理時間をgemini_span_duration_secondsに記録する
+    例外で終了した場合は、gemini_span_errors_totalにも記録する
+
+    Params
+    ---
+    span_name: str
+        ex: 'model_call', 'tool', 'scraping', 'notion'
+    name: str
+        ex: 'gemini-pro', 'get_outer_html'
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        span_errors.inc(span=span_name, name=name)
+        raise
+    finally:
+        span_duration.observe(time.perf_counter() - start, span=span_name, name=name)
+
+
+component_stats = metrics.gauge(
+    'gemini_component_stat', 'Numeric values of the stats() of caches, pools and registries', ('component', 'key')
+)
+
+
+def _flatten(value, prefix: str = '') -> Iterator[tuple[str, float]]:
+    if isinstance(value, bool):
+        yield prefix, int(value)
+    elif isinstance(value, (int, float)):
+        yield prefix, value
+    elif isinstance(value, dict):
+        for key, child in value.items():
+            yield from _flatten(child, f'{prefix}.{key}' if prefix else str(key))
+    elif isinstance(value, (list, tuple)):
+        for i, child in enumerate(value):
+            yield from _flatten(child, f'{prefix}.{i}' if prefix else str(i))
+
+
+def add_stats_collector(component: str, stats: Callable[[], dict]):
+    """
+    stats()の数値をgemini_component_statに反映する
+
+    usage
+    ---
+    >>> add_stats_collector('scraping_cache', utils.scraping_cache.stats)
+    # gemini_component_stat{component="scraping_cache",key="hits"} 10
+    """
+    def _collect():
+        for key, value in _flatten(stats()):
+            component_stats.set(value, component=component, key=key)
+
+    metrics.add_collector(_collect)
@@ -1,8 +1,31 @@
-import requests
 import dataclasses
+import io
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
 
 import utils
-from config import NOTION_API_KEY
+from utils.http import http_client, RateLimiter
+from utils.reduce import estimate_tokens
+from config import (
+    NOTION_API_KEY, NOTION_API_BASE, NOTION_RATE_LIMIT, NOTION_MAX_CONCURRENCY, NOTION_CONTENT_TOP_K,
+    NOTION_BLOCK_MAX_CONCURRENCY, NOTION_PAGE_MAX_CHARS, NOTION_PAGE_MAX_TOKENS,
+    NOTION_MIRROR_PATH, NOTION_MIRROR_SYNC_INTERVAL, NOTION_MIRROR_RECONCILE_INTERVAL
+)
+
+from typing import Optional
+
+
+# Notion APIのレート制限(プロセス全体で共有する)
+notion_rate_limiter = RateLimiter(rate=NOTION_RATE_LIMIT)
+# ページの本文を並列に取得するためのスレッドプール
+_page_executor = ThreadPoolExecutor(max_workers=NOTION_MAX_CONCURRENCY, thread_name_prefix='notion')
+# 子ブロックを並列に取得するためのスレッドプール
+# ページのスレッドは子ブロックの取得を待ち合わせるため、同じプールを使うとデッドロックする
+_block_executor = ThreadPoolExecutor(max_workers=NOTION_BLOCK_MAX_CONCURRENCY, thread_name_prefix='notion-block')
 
 
 @dataclasses.dataclass
@@ -27,6 +50,103 @@ class NotionSearch:
         }
 
 
+# 子ブロックとして別のページ・データベースを持つブロック(本文には含めない)
+_LEAF_BLOCK_TYPES = {'child_page', 'child_database'}
+
+
+def _block_text(block: dict) -> str:
+    """
+    ブロックのテキスト
+    """
+    block_type = block["type"]
+    value = block.get(block_type) or {}
+    if block_type in _LEAF_BLOCK_TYPES:
+        return value.get("title", "")
+    if block_type == 'table_row':
+        return ' | '.join(''.join(t["plain_text"] for t in cell) for cell in value.get("cells", []))
+    return ''.join(t["plain_text"] for t in value.get("rich_text", []))
+
+
+class _TextBuffer():
+    """
+    本文を書き込むバッファ
+    文字数・トークン数の上限に達した時点でfullになり、以降の書き込みは無視する
+    """
+
+    def __init__(self, max_chars: int = 0, max_tokens: int = 0):
+        self.max_chars = max_chars
+        self.max_tokens = max_tokens
+        self.chars = 0
+        self.tokens = 0
+        self.full = False
+        self._buffer = io.StringIO()
+
+    def write(self, line: str) -> bool:
+        """
+        1行書き込む(空行は無視する)
+
+        Returns
+        ---
+        res: bool
+            続けて書き込めるかどうか
+        """
+        if self.full:
+            return False
+        if not line:
+            return True
+        line += "\n"
+        if self.max_chars and self.chars + len(line) >= self.max_chars:
+            line = line[:self.max_chars - self.chars]
+            self.full = True
+        if self.max_tokens:
+            tokens = estimate_tokens(line)
+            if self.tokens + tokens >= self.max_tokens:
+                self.full = True
+                if self.tokens + tokens > self.max_tokens:
+                    return False
+            self.tokens += tokens
+        self._buffer.write(line)
+        self.chars += len(line)
+        return not self.full
+
+    def getvalue(self) -> str:
+        return self._buffer.getvalue()
+
+
+def _page_entries(r: dict) -> list[tuple[str, NotionPageDict]]:
+    """
+    検索結果のページから、NotionPageDictを作成する(本文は空)
+
+    Returns
+    ---
+    res: list[tuple[str, NotionPageDict]]
+        ex: [('page', NotionPageDict(...)), ('url', NotionPageDict(...))]
+        'page': titleを持つページ(本文を取得する)
+        'url': URLを持つデータベースの行
+    """
+    entries = []
+    if r["object"] != "page":
+        return entries
+
+    if r["properties"].get("title"):
+        tmp_title = ''
+        for t in r["properties"]["title"]["title"]:
+            tmp_title += t["plain_text"]
+        entries.append(('page', NotionPageDict(title=tmp_title, pageId=r["id"], content="", url="")))
+
+    if r["properties"].get("URL"):
+        tmp_title = ''
+        try:
+            for t in r["properties"]["名前"]["title"]:
+                tmp_title += t["plain_text"]
+        except Exception:
+            return entries
+        entries.append(('url', NotionPageDict(
+            title=tmp_title, pageId=r["id"], content="", url=r["properties"]["URL"]["url"]
+        )))
+    return entries
+
+
 class Notion:
     def __init__(self):
         self.headers = {
@@ -35,8 +155,30 @@ class Notion:
             'Content-Type': 'application/json',
         }
 
-    def search(self, query: str, start_cursor="", page_size=10, add_contests=True) -> NotionSearch:
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
         """
+        レート制限をかけてNotion APIへリクエストする
+        リトライ後も429の場合は、Retry-Afterの間、全スレッドからの送信を止める
+        """
+        notion_rate_limiter.acquire()
+        # ex: search, children
+        with utils.span('notion', url.rsplit('/', 1)[-1]):
+            response = http_client.request(method, url, headers=self.headers, **kwargs)
+        if response.status_code == 429:
+            notion_rate_limiter.pause(float(response.headers.get('Retry-After', '1')))
+        return response
+
+    def search(
+            self,
+            query: str,
+            start_cursor="",
+            page_size=10,
+            add_contests=True,
+            content_top_k: Optional[int] = None
+    ) -> NotionSearch:
+        """
+        NOTION_MIRROR_PATHを設定している場合は、同期済みのローカルのミラーから検索する
+
         Params
         ---
         query: str
@@ -45,12 +187,19 @@ class Notion:
             取得件数
         add_contests: bool
             ページの本文を取得するかどうか
+        content_top_k: Optional[int]
+            本文を取得する上位の件数(0の場合は全件)
+            省略した場合はconfig.NOTION_CONTENT_TOP_K
 
         Returns
         ---
         res: dict
             検索結果
         """
+        mirror = get_notion_mirror()
+        if mirror is not None and mirror.is_ready():
+            return mirror.search(query, start_cursor=start_cursor, page_size=page_size, add_contests=add_contests)
+
         utils.gray_log(f"「{query}」でNotion内検索...")
 
         request_json = {
@@ -60,88 +209,396 @@ class Notion:
         if start_cursor:
             request_json["start_cursor"] = start_cursor
 
-        response = requests.post(
-            "https://api.notion.com/v1/search",
-            headers=self.headers,
+        response = self._request(
+            "POST",
+            f"{NOTION_API_BASE}/search",
             json=request_json
         )
         response = response.json()
 
         result = response.get('results', [])
 
+        if content_top_k is None:
+            content_top_k = NOTION_CONTENT_TOP_K
+
         res_list = []
+        # 本文を取得するページ
+        content_pages: list[NotionPageDict] = []
         for r in result:
-            if r["object"] == "page":
-                if r["properties"].get("title"):
-                    tmp_title = ''
-                    for t in r["properties"]["title"]["title"]:
-                        tmp_title += t["plain_text"]
-
-                    tmp_content = ""
-                    if add_contests:
-                        tmp_content = self.get_page_contents(page_id=r["id"])
-
-                    res_list.append(
-                        NotionPageDict
-                        (
-                            title=tmp_title,
-                            pageId=r["id"],
-                            content=tmp_content,
-                            url=""
-                        )
-                    )
+            for kind, page in _page_entries(r):
+                res_list.append(page)
+                if kind == 'page' and add_contests and (not content_top_k or len(content_pages) < content_top_k):
+                    content_pages.append(page)
 
-                if r["properties"].get("URL"):
-                    tmp_title = ''
-                    try:
-                        for t in r["properties"]["名前"]["title"]:
-                            tmp_title += t["plain_text"]
-                    except Exception:
-                        continue
-                    res_list.append(
-                        NotionPageDict
-                        (
-                            title=tmp_title,
-                            pageId=r["id"],
-                            content="",
-                            url=r["properties"]["URL"]["url"]
-                        )
-                    )
+        # 本文は並列に取得する
+        futures = [
+            (page, _page_executor.submit(self.get_page_contents, page_id=page.pageId))
+            for page in content_pages
+        ]
+        for page, future in futures:
+            page.content = future.result()
 
         return NotionSearch(
             result=res_list,
-            has_more=response["has_more"],
+            has_more=response.get("has_more", False),
             next_cursor=response.get("next_cursor", "")
         )
 
-    def get_page_contents(self, page_id: str) -> dict:
-        if not page_id:
-            return NotionSearch(
-                result=[],
-                has_more=False,
-                next_cursor=""
-            )
-        response = requests.get(
-            f"https://api.notion.com/v1/blocks/{page_id}/children",
-            headers=self.headers,
+    def _fetch_children(self, block_id: str, start_cursor: str = '') -> Optional[dict]:
+        """
+        ブロックの子ブロックを1ページ分取得する(取得できない場合はNone)
+        """
+        params = {"page_size": 100}
+        if start_cursor:
+            params["start_cursor"] = start_cursor
+        response = self._request(
+            "GET",
+            f"{NOTION_API_BASE}/blocks/{block_id}/children",
+            params=params
         )
         if response.status_code != 200:
-            return NotionSearch(
-                result=[],
-                has_more=False,
-                next_cursor=""
+            return None
+        return response.json()
+
+    def _write_blocks(self, block_id: str, first: Future, buffer: '_TextBuffer'):
+        """
+        子ブロックを上から順にbufferに書き込む
+        次のページと、子を持つブロックの子ブロックは先に取得を開始しておき、書き込む順に待ち合わせる
+        bufferが上限に達した時点で終了し、未開始の取得はキャンセルする
+        """
+        pending: list[Future] = [first]
+        try:
+            future = first
+            while future is not None and not buffer.full:
+                response = future.result()
+                if response is None:
+                    return
+                future = None
+                if response.get("has_more") and response.get("next_cursor"):
+                    future = _block_executor.submit(self._fetch_children, block_id, response["next_cursor"])
+                    pending.append(future)
+
+                blocks = response.get("results", [])
+                children = {
+                    block["id"]: _block_executor.submit(self._fetch_children, block["id"])
+                    for block in blocks
+                    if block.get("has_children") and block["type"] not in _LEAF_BLOCK_TYPES
+                }
+                pending.extend(children.values())
+
+                for block in blocks:
+                    if not buffer.write(_block_text(block)):
+                        return
+                    if block["id"] in children:
+                        self._write_blocks(block["id"], children[block["id"]], buffer)
+                        if buffer.full:
+                            return
+        finally:
+            for f in pending:
+                f.cancel()
+
+    def get_page_contents(
+            self,
+            page_id: str,
+            max_chars: Optional[int] = None,
+            max_tokens: Optional[int] = None
+    ) -> str:
+        """
+        ページの本文を取得する
+        子ブロック(トグル、カラム、入れ子のリストなど)もページングを辿って取得する
+
+        Params
+        ---
+        page_id: str
+            ページのID
+        max_chars: Optional[int]
+            最大文字数(0の場合は制限なし)
+            省略した場合はconfig.NOTION_PAGE_MAX_CHARS
+        max_tokens: Optional[int]
+            最大トークン数(0の場合は制限なし)
+            省略した場合はconfig.NOTION_PAGE_MAX_TOKENS
+
+        Returns
+        ---
+        res: str
+            ブロックごとに改行した本文
+        """
+        if not page_id:
+            return ""
+        buffer = _TextBuffer(
+            max_chars=NOTION_PAGE_MAX_CHARS if max_chars is None else max_chars,
+            max_tokens=NOTION_PAGE_MAX_TOKENS if max_tokens is None else max_tokens
+        )
+        first = Future()
+        first.set_result(self._fetch_children(page_id))
+        self._write_blocks(page_id, first, buffer)
+        return buffer.getvalue()
+
+
+class NotionMirror:
+    """
+    Notionのページと本文をSQLiteに同期し、FTS5の全文検索でNotion.searchと同じ形式の結果を返す
+    同期はlast_edited_timeの新しい順に取得し、前回同期した時刻より古いページに達した時点で終了する(差分同期)
+    削除・共有解除されたページは検索結果に現れなくなるだけのため、定期的に全ページの一覧と突き合わせて取り除く(reconcile)
+
+    usage
+    ---
+    >>> mirror = NotionMirror('./notion_mirror.db')
+    >>> mirror.sync()
+    >>> mirror.sync(reconcile=True)
+    >>> mirror.search('eメンテ').to_dict()
+    """
+
+    def __init__(self, path: str, notion: Optional[Notion] = None):
+        self.path = path
+        self.notion = notion or Notion()
+        self._local = threading.local()
+        self._sync_lock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS pages (
+                    page_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    last_edited_time TEXT NOT NULL,
+                    PRIMARY KEY (page_id, kind)
+                )
+            ''')
+            # 日本語でも部分一致で検索できるよう、trigramで分割する
+            conn.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5(
+                    title, content, content='pages', content_rowid='rowid', tokenize='trigram'
+                )
+            ''')
+            conn.executescript('''
+                CREATE TRIGGER IF NOT EXISTS pages_ai AFTER INSERT ON pages BEGIN
+                    INSERT INTO pages_fts(rowid, title, content) VALUES (new.rowid, new.title, new.content);
+                END;
+                CREATE TRIGGER IF NOT EXISTS pages_ad AFTER DELETE ON pages BEGIN
+                    INSERT INTO pages_fts(pages_fts, rowid, title, content) VALUES ('delete', old.rowid, old.title, old.content);
+                END;
+                CREATE TRIGGER IF NOT EXISTS pages_au AFTER UPDATE ON pages BEGIN
+                    INSERT INTO pages_fts(pages_fts, rowid, title, content) VALUES ('delete', old.rowid, old.title, old.content);
+                    INSERT INTO pages_fts(rowid, title, content) VALUES (new.rowid, new.title, new.content);
+                END;
+            ''')
+            conn.execute('CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3.Connectionはスレッド間で共有できないため、スレッドごとに接続する
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def _get_state(self, key: str) -> str:
+        row = self._connection().execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else ''
+
+    def is_ready(self) -> bool:
+        """
+        一度でも同期が完了しているかどうか
+        """
+        return bool(self._get_state('synced_at'))
+
+    def sync(self, reconcile: bool = False) -> int:
+        """
+        前回の同期以降に編集されたページを取得する
+
+        Params
+        ---
+        reconcile: bool
+            Trueの場合は、前回の同期より古いページも一覧だけ最後まで取得し、一覧に無いページをミラーから削除する
+
+        Returns
+        ---
+        res: int
+            更新したページの数
+        """
+        with self._sync_lock:
+            since = self._get_state('last_edited_time')
+            newest = since
+            updated = 0
+            # 一覧に含まれていたページのid(reconcile用)
+            seen = set()
+            start_cursor = ''
+            while True:
+                request_json = {
+                    "filter": {"property": "object", "value": "page"},
+                    "sort": {"direction": "descending", "timestamp": "last_edited_time"},
+                    "page_size": 100,
+                }
+                if start_cursor:
+                    request_json["start_cursor"] = start_cursor
+                response = self.notion._request("POST", f"{NOTION_API_BASE}/search", json=request_json)
+                response.raise_for_status()
+                response = response.json()
+
+                reached = False
+                for r in response.get('results', []):
+                    if not (r.get("archived") or r.get("in_trash")):
+                        seen.add(r["id"])
+                    # last_edited_timeは分単位のため、同じ時刻のページは再取得する
+                    if since and r["last_edited_time"] < since:
+                        reached = True
+                        if not reconcile:
+                            break
+                        # 同期済みのページは、本文を取得し直さない
+                        continue
+                    newest = max(newest, r["last_edited_time"])
+                    self._upsert(r)
+                    updated += 1
+
+                if (reached and not reconcile) or not response.get("has_more"):
+                    break
+                start_cursor = response.get("next_cursor", "")
+
+            deleted = self._delete_unseen(seen) if reconcile else 0
+            with self._connection() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', ('last_edited_time', newest)
+                )
+                conn.execute(
+                    'INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', ('synced_at', str(time.time()))
+                )
+                if reconcile:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', ('reconciled_at', str(time.time()))
+                    )
+            if reconcile:
+                utils.gray_log(f'Notionのミラーを同期しました({updated}件、削除{deleted}件)')
+            else:
+                utils.gray_log(f'Notionのミラーを同期しました({updated}件)')
+            return updated
+
+    def _delete_unseen(self, seen: set) -> int:
+        """
+        一覧に含まれなかったページを削除する
+
+        Returns
+        ---
+        res: int
+            削除したページの数
+        """
+        with self._connection() as conn:
+            page_ids = [row[0] for row in conn.execute('SELECT DISTINCT page_id FROM pages')]
+            unseen = [(page_id,) for page_id in page_ids if page_id not in seen]
+            conn.executemany('DELETE FROM pages WHERE page_id = ?', unseen)
+        return len(unseen)
+
+    def reconcile_due(self, interval: float = NOTION_MIRROR_RECONCILE_INTERVAL) -> bool:
+        """
+        前回のreconcileからinterval秒以上経っているかどうか(intervalが0の場合はFalse)
+        """
+        if not interval:
+            return False
+        return time.time() - float(self._get_state('reconciled_at') or 0) >= interval
+
+    def _upsert(self, r: dict):
+        entries = [] if r.get("archived") or r.get("in_trash") else _page_entries(r)
+        for kind, page in entries:
+            if kind == 'page':
+                page.content = self.notion.get_page_contents(page_id=page.pageId)
+        with self._connection() as conn:
+            conn.execute('DELETE FROM pages WHERE page_id = ?', (r["id"],))
+            conn.executemany(
+                '''
+                INSERT INTO pages (page_id, kind, title, content, url, last_edited_time)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ''',
+                [
+                    (page.pageId, kind, page.title, page.content, page.url or '', r["last_edited_time"])
+                    for kind, page in entries
+                ]
             )
 
-        response = response.json()
+    def search(self, query: str, start_cursor="", page_size=10, add_contests=True) -> NotionSearch:
+        """
+        Notion.searchと同じ形式で、ローカルの全文検索の結果を返す
+        start_cursorは、次のページの先頭の位置
+        """
+        utils.gray_log(f"「{query}」でNotion内検索(ミラー)...")
+        offset = int(start_cursor) if str(start_cursor).isdigit() else 0
+        query = query.strip()
+        conn = self._connection()
 
-        result = response["results"]
+        # trigramのため、3文字以上の語はFTS5のbm25で順位付けする
+        terms = ' OR '.join('"' + term.replace('"', '""') + '"' for term in query.split() if len(term) >= 3)
+        if terms:
+            rows = conn.execute(
+                '''
+                SELECT pages.page_id, pages.kind, pages.title, pages.content, pages.url
+                FROM pages_fts JOIN pages ON pages.rowid = pages_fts.rowid
+                WHERE pages_fts MATCH ?
+                ORDER BY bm25(pages_fts, 10.0, 1.0)
+                LIMIT ? OFFSET ?
+                ''',
+                (terms, page_size + 1, offset)
+            ).fetchall()
+        else:
+            like = f'%{query}%'
+            rows = conn.execute(
+                '''
+                SELECT page_id, kind, title, content, url FROM pages
+                WHERE title LIKE ? OR content LIKE ?
+                ORDER BY (title LIKE ?) DESC, last_edited_time DESC
+                LIMIT ? OFFSET ?
+                ''',
+                (like, like, like, page_size + 1, offset)
+            ).fetchall()
 
-        res_text = ""
+        has_more = len(rows) > page_size
+        return NotionSearch(
+            result=[
+                NotionPageDict(
+                    title=title,
+                    pageId=page_id,
+                    content=content if add_contests and kind == 'page' else "",
+                    url=url
+                )
+                for page_id, kind, title, content, url in rows[:page_size]
+            ],
+            has_more=has_more,
+            next_cursor=str(offset + page_size) if has_more else ""
+        )
+
+    def start_sync(
+            self,
+            interval: float = NOTION_MIRROR_SYNC_INTERVAL,
+            reconcile_interval: float = NOTION_MIRROR_RECONCILE_INTERVAL
+    ):
+        """
+        interval秒ごとに同期するスレッドを開始する
+        reconcile_interval秒ごとに、削除されたページの突き合わせも行う
+        """
+        def _run():
+            while True:
+                try:
+                    self.sync(reconcile=self.reconcile_due(reconcile_interval))
+                except Exception as e:
+                    utils.red_log(e)
+                time.sleep(interval)
+
+        threading.Thread(target=_run, daemon=True).start()
+
+
+_mirror: Optional[NotionMirror] = None
+_mirror_lock = threading.Lock()
 
-        for r in result:
-            text_type = r["type"]
-            rich_texts = r.get(text_type).get("rich_text", [])
-            for rich_text in rich_texts:
-                res_text += rich_text["plain_text"] + "\n"
 
-        return res_text
+def get_notion_mirror() -> Optional[NotionMirror]:
+    """
+    NOTION_MIRROR_PATHを設定している場合、ミラーを生成して同期を開始する
+    """
+    global _mirror
+    if not NOTION_MIRROR_PATH:
+        return None
+    with _mirror_lock:
+        if _mirror is None:
+            _mirror = NotionMirror(NOTION_MIRROR_PATH)
+            _mirror.start_sync()
+    return _mirror
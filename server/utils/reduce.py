@@ -0,0 +1,212 @@
+"""
+toolの結果をモデルへ返す前に、トークン数の上限に収まるよう削減する
+本文の抽出 → チャンク分割 → BM25で質問に関連するチャンクを選択 の順に処理する
+"""
+import io
+import math
+import re
+from collections import Counter
+from html.parser import HTMLParser
+
+from config import TOOL_RESULT_TOKEN_BUDGET, TOOL_RESULT_CHUNK_TOKENS
+
+
+# 本文ではないとみなして削除するタグ
+BOILERPLATE_TAGS = {
+    'header', 'footer', 'nav', 'aside', 'form', 'button', 'select',
+    'svg', 'iframe', 'template', 'style', 'script', 'noscript'
+}
+# 本文とみなすタグ
+MAIN_TAGS = {'main', 'article'}
+# 改行を入れるタグ
+BLOCK_TAGS = {
+    'p', 'div', 'section', 'br', 'li', 'ul', 'ol', 'tr', 'table', 'dl', 'dt', 'dd',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre', 'blockquote', 'main', 'article', 'title'
+}
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+_WORD_RE = re.compile(r'[a-z0-9]+|[^\x00-\x7f\s]+')
+_SPACE_RE = re.compile(r'[ \t\r\f\v]+')
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークン数の概算
+    ASCII文字は4文字で1トークン、それ以外(日本語など)は1文字で1トークンとみなす
+    """
+    ascii_len = len(text.encode('ascii', 'ignore'))
+    return ascii_len // 4 + (len(text) - ascii_len)
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._all = io.StringIO()
+        self._main = io.StringIO()
+        self._skip_depth = 0
+        self._main_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            if tag == 'br':
+                self._write('\n')
+            return
+        if tag in BOILERPLATE_TAGS:
+            self._skip_depth += 1
+        elif tag in MAIN_TAGS:
+            self._main_depth += 1
+        if tag in BLOCK_TAGS:
+            self._write('\n')
+
+    def handle_endtag(self, tag):
+        if tag in BOILERPLATE_TAGS:
+            self._skip_depth = max(self._skip_depth - 1, 0)
+        elif tag in MAIN_TAGS:
+            self._main_depth = max(self._main_depth - 1, 0)
+        if tag in BLOCK_TAGS:
+            self._write('\n')
+
+    def handle_data(self, data):
+        self._write(data)
+
+    def _write(self, text: str):
+        if self._skip_depth:
+            return
+        self._all.write(text)
+        if self._main_depth:
+            self._main.write(text)
+
+    def text(self) -> str:
+        # main/articleに十分な本文がある場合は、そちらだけを使う
+        main = self._main.getvalue()
+        if len(main.strip()) >= 200:
+            return main
+        return self._all.getvalue()
+
+
+def _normalize_lines(text: str) -> list[str]:
+    """
+    空白を詰め、空行・重複した行を削除する
+    """
+    lines = []
+    seen = set()
+    for line in text.splitlines():
+        line = _SPACE_RE.sub(' ', line).strip()
+        if not line or line in seen:
+            continue
+        seen.add(line)
+        lines.append(line)
+    return lines
+
+
+def html_to_text(html: str) -> str:
+    """
+    HTMLから、ヘッダー・ナビゲーションなどを除いた本文のテキストを抽出する
+    """
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return '\n'.join(_normalize_lines(parser.text()))
+
+
+def chunk_text(text: str, chunk_tokens: int = TOOL_RESULT_CHUNK_TOKENS) -> list[str]:
+    """
+    行単位で、chunk_tokensを超えないようにチャンクへ分割する
+    一行でchunk_tokensを超える場合は、その行を文字数で分割する
+    """
+    chunks = []
+    buffer: list[str] = []
+    buffer_tokens = 0
+    for line in _normalize_lines(text):
+        line_tokens = estimate_tokens(line)
+        if line_tokens > chunk_tokens:
+            step = max(len(line) * chunk_tokens // line_tokens, 1)
+            pieces = [line[i:i + step] for i in range(0, len(line), step)]
+        else:
+            pieces = [line]
+        for piece in pieces:
+            piece_tokens = estimate_tokens(piece)
+            if buffer and buffer_tokens + piece_tokens > chunk_tokens:
+                chunks.append('\n'.join(buffer))
+                buffer, buffer_tokens = [], 0
+            buffer.append(piece)
+            buffer_tokens += piece_tokens
+    if buffer:
+        chunks.append('\n'.join(buffer))
+    return chunks
+
+
+def _terms(text: str) -> list[str]:
+    """
+    英数字は単語単位、日本語などは2文字ずつに分割する
+    """
+    terms = []
+    for word in _WORD_RE.findall(text.lower()):
+        if word.isascii() or len(word) == 1:
+            terms.append(word)
+        else:
+            terms.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return terms
+
+
+def bm25_scores(query: str, documents: list[str], k1=1.5, b=0.75) -> list[float]:
+    query_terms = set(_terms(query))
+    doc_terms = [Counter(_terms(document)) for document in documents]
+    if not query_terms or not documents:
+        return [0.0] * len(documents)
+
+    avg_len = sum(sum(terms.values()) for terms in doc_terms) / len(documents) or 1
+    df = Counter(term for terms in doc_terms for term in query_terms if term in terms)
+
+    scores = []
+    for terms in doc_terms:
+        doc_len = sum(terms.values())
+        score = 0.0
+        for term in query_terms:
+            tf = terms.get(term, 0)
+            if not tf:
+                continue
+            idf = math.log(1 + (len(documents) - df[term] + 0.5) / (df[term] + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * doc_len / avg_len))
+        scores.append(score)
+    return scores
+
+
+def reduce_text(text: str, query: str, max_tokens: int = TOOL_RESULT_TOKEN_BUDGET) -> str:
+    """
+    max_tokensに収まるよう、queryに関連するチャンクを選んで返す
+    選んだチャンクは元の順番で結合する
+
+    Params
+    ---
+    text: str
+    query: str
+        ex: 本日のドル円レートを教えて
+    max_tokens: int
+        0以下の場合は削減しない
+    """
+    if max_tokens <= 0 or estimate_tokens(text) <= max_tokens:
+        return text
+
+    chunks = chunk_text(text, min(TOOL_RESULT_CHUNK_TOKENS, max_tokens))
+    scores = bm25_scores(query, chunks)
+    # 同じスコアの場合は、先頭に近いチャンクを優先する
+    ranking = sorted(range(len(chunks)), key=lambda i: (-scores[i], i))
+
+    selected = []
+    used_tokens = 0
+    for i in ranking:
+        chunk_tokens = estimate_tokens(chunks[i])
+        if used_tokens + chunk_tokens > max_tokens:
+            continue
+        selected.append(i)
+        used_tokens += chunk_tokens
+
+    return '\n...\n'.join(chunks[i] for i in sorted(selected))
+
+
+def reduce_html(html: str, query: str, max_tokens: int = TOOL_RESULT_TOKEN_BUDGET) -> str:
+    """
+    HTMLから本文を抽出し、reduce_textで削減する
+    """
+    return reduce_text(html_to_text(html), query, max_tokens)
@@ -1,14 +1,213 @@
-import requests
-from bs4 import BeautifulSoup
+import codecs
+import io
 import re
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
 from urllib.parse import urlparse
 
 import utils
+from utils.http import http_client
+from utils.cache import CacheEntry, LRUCache, DiskCache, TieredCache
+from utils.singleflight import SingleFlight
+from config import (
+    SCRAPING_CACHE_TTL, SCRAPING_CACHE_MAX_BYTES, SCRAPING_CACHE_DIR,
+    SCRAPING_STREAMING, SCRAPING_MAX_BYTES, SCRAPING_MAX_OUTPUT_CHARS,
+    SCRAPING_PREFETCH_TOP_N, SCRAPING_PREFETCH_MAX_WORKERS
+)
+
+from typing import Iterable, Optional
+
+
+# 中身ごと削除するタグ
+DROP_TAGS = {'style', 'script', 'link', 'noscript', 'picture'}
+# 終了タグを持たないタグ
+VOID_TAGS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'param', 'source', 'track', 'wbr'
+}
+
+_CHARSET_RE = re.compile(r'charset=["\']?([\w-]+)', re.I)
+_META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.I)
+
+
+def _create_scraping_cache() -> TieredCache:
+    backends = [LRUCache(max_bytes=SCRAPING_CACHE_MAX_BYTES)]
+    if SCRAPING_CACHE_DIR:
+        backends.append(DiskCache(SCRAPING_CACHE_DIR))
+    return TieredCache(backends, ttl=SCRAPING_CACHE_TTL)
+
+
+# 整形済みのHTMLをURLごとに保存するキャッシュ
+scraping_cache = _create_scraping_cache()
+# 同じURLの同時の取得は、一回のリクエストにまとめる
+scraping_flight = SingleFlight()
+# 検索結果のURLを先読みするためのスレッドプール
+_prefetch_executor = ThreadPoolExecutor(max_workers=SCRAPING_PREFETCH_MAX_WORKERS, thread_name_prefix='prefetch')
+
+
+def _clean_html(content: bytes) -> str:
+    """
+    不要なタグ・属性・コメントを削除したHTMLを返す
+    """
+    # BeautifulSoupのimportには時間がかかるため、ストリーミングを使用しない場合にだけ読み込む
+    from bs4 import BeautifulSoup
+
+    # BeautifulSoupを使ってHTMLをパース
+    soup = BeautifulSoup(content, 'html.parser')
+
+    # styleタグを全て削除
+    for style in soup.find_all('style'):
+        style.decompose()
+    # scriptタグを全て削除
+    for script in soup.find_all('script'):
+        script.decompose()
+    # linkタグを全て削除
+    for link in soup.find_all('link'):
+        link.decompose()
+    # noscriptタグを全て削除
+    for noscript in soup.find_all('noscript'):
+        noscript.decompose()
+    # pictureタグを全て削除
+    for picture in soup.find_all('picture'):
+        picture.decompose()
+    # classを削除
+    for tag in soup.find_all(True):
+        tag.attrs = {}
+
+    outer_html = str(soup)
+    outer_html = re.sub(r"<!--(.*?)-->", '', outer_html)
+    return outer_html
+
+
+class _HTMLCleaner(HTMLParser):
+    """
+    _clean_htmlと同じ整形を、一回のパスで逐次的に行うパーサー
+    出力がmax_charsに達した時点でdoneになる
+    """
+
+    def __init__(self, max_chars: int):
+        super().__init__(convert_charrefs=False)
+        self.max_chars = max_chars
+        self.done = False
+        self._buffer = io.StringIO()
+        self._size = 0
+        self._skip_depth = 0
+
+    def _write(self, text: str):
+        if self.done or self._skip_depth:
+            return
+        remaining = self.max_chars - self._size
+        if len(text) >= remaining:
+            text = text[:remaining]
+            self.done = True
+        self._buffer.write(text)
+        self._size += len(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROP_TAGS:
+            if tag not in VOID_TAGS:
+                self._skip_depth += 1
+            return
+        self._write(f'<{tag}/>' if tag in VOID_TAGS else f'<{tag}>')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in DROP_TAGS:
+            return
+        self._write(f'<{tag}/>')
+
+    def handle_endtag(self, tag):
+        if tag in DROP_TAGS:
+            if tag not in VOID_TAGS and self._skip_depth:
+                self._skip_depth -= 1
+            return
+        if tag in VOID_TAGS:
+            return
+        self._write(f'</{tag}>')
+
+    def handle_data(self, data):
+        self._write(data)
+
+    def handle_entityref(self, name):
+        self._write(f'&{name};')
+
+    def handle_charref(self, name):
+        self._write(f'&#{name};')
+
+    def handle_decl(self, decl):
+        self._write(f'<!{decl}>')
+
+    def getvalue(self) -> str:
+        return self._buffer.getvalue()
+
+
+def _detect_encoding(content_type: str, head: bytes) -> str:
+    """
+    Content-Type、もしくは先頭のmetaタグから文字コードを判定する
+    """
+    match = _CHARSET_RE.search(content_type or '')
+    encoding = match.group(1) if match else ''
+    if not encoding:
+        match = _META_CHARSET_RE.search(head)
+        encoding = match.group(1).decode('ascii') if match else 'utf-8'
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        encoding = 'utf-8'
+    return encoding
+
+
+def _clean_html_stream(
+        chunks: Iterable[bytes],
+        content_type: str = '',
+        max_bytes: int = SCRAPING_MAX_BYTES,
+        max_chars: int = SCRAPING_MAX_OUTPUT_CHARS
+) -> str:
+    """
+    レスポンスを逐次的に読み込みながら整形する
+    読み込みはmax_bytes、出力はmax_charsで打ち切る
+
+    Params
+    ---
+    chunks: Iterable[bytes]
+        ex: response.iter_content(chunk_size=16 * 1024)
+    content_type: str
+        ex: 'text/html; charset=utf-8'
+    """
+    parser = _HTMLCleaner(max_chars=max_chars)
+    decoder = None
+    head = b''
+    read_bytes = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        chunk = chunk[:max_bytes - read_bytes]
+        read_bytes += len(chunk)
+        if decoder is None:
+            # 文字コードの判定のため、先頭1KBが揃うまではデコードしない
+            head += chunk
+            if len(head) < 1024 and read_bytes < max_bytes:
+                continue
+            decoder = codecs.getincrementaldecoder(_detect_encoding(content_type, head))(errors='replace')
+            chunk = head
+        parser.feed(decoder.decode(chunk))
+        if parser.done or read_bytes >= max_bytes:
+            break
+
+    if decoder is None:
+        if not head:
+            return ''
+        decoder = codecs.getincrementaldecoder(_detect_encoding(content_type, head))(errors='replace')
+        parser.feed(decoder.decode(head))
+    if not parser.done:
+        parser.feed(decoder.decode(b'', final=True))
+        parser.close()
+    return parser.getvalue()
 
 
 def get_outer_html(url: str):
     """
     URLからページのouterHTMLを取得する
+    取得結果はscraping_cacheに保存し、期限切れの場合はETag/Last-Modifiedで再検証する
 
     Params
     ---
@@ -28,48 +227,98 @@ def get_outer_html(url: str):
     if not url.startswith('http'):
         return ''
 
+    entry = scraping_cache.get(url)
+    if entry is not None and not entry.is_expired():
+        scraping_cache.record(hit=True)
+        return entry.value
+    scraping_cache.record(hit=False)
+
+    # 先読みなどで同じURLを取得中の場合は、その結果を待つ
+    with utils.span('scraping'):
+        return scraping_flight.do(url, _fetch_outer_html, url, entry)
+
+
+def _fetch_outer_html(url: str, entry: Optional[CacheEntry]) -> str:
+    """
+    URLからページを取得して整形し、scraping_cacheに保存する
+    entryがある場合は、ETag/Last-Modifiedで再検証する
+    """
     parsed_url = urlparse(url)
 
     utils.gray_log(f'{parsed_url.netloc}から詳細情報取得開始...')
 
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+
     response = None
     try:
         # URLからページのHTMLを取得
-        response = requests.get(url, timeout=10)
+        response = http_client.get(url, timeout=10, headers=headers, stream=SCRAPING_STREAMING)
     except Exception:
         return ''
 
     if response is None:
         return ''
 
-    # ステータスコードが正常でない場合はNoneを返すなどのエラーハンドリングを行うことができます
-    if response.status_code != 200:
-        return ''
+    with response:
+        # 更新されていない場合は、キャッシュの期限を延長して返す
+        if response.status_code == 304 and entry is not None:
+            return scraping_cache.touch(url, entry).value
 
-    # BeautifulSoupを使ってHTMLをパース
-    soup = BeautifulSoup(response.content, 'html.parser')
+        # ステータスコードが正常でない場合はNoneを返すなどのエラーハンドリングを行うことができます
+        if response.status_code != 200:
+            return ''
 
-    # styleタグを全て削除
-    for style in soup.find_all('style'):
-        style.decompose()
-    # scriptタグを全て削除
-    for script in soup.find_all('script'):
-        script.decompose()
-    # linkタグを全て削除
-    for link in soup.find_all('link'):
-        link.decompose()
-    # noscriptタグを全て削除
-    for noscript in soup.find_all('noscript'):
-        noscript.decompose()
-    # pictureタグを全て削除
-    for picture in soup.find_all('picture'):
-        picture.decompose()
-    # classを削除
-    for tag in soup.find_all(True):
-        tag.attrs = {}
+        if SCRAPING_STREAMING:
+            try:
+                outer_html = _clean_html_stream(
+                    response.iter_content(chunk_size=16 * 1024),
+                    content_type=response.headers.get('Content-Type', '')
+                )
+            except Exception:
+                return ''
+        else:
+            outer_html = _clean_html(response.content)
 
-    outer_html = str(soup)
-    outer_html = re.sub(r"<!--(.*?)-->", '', outer_html)
+    if outer_html:
+        scraping_cache.set(
+            url,
+            outer_html,
+            etag=response.headers.get('ETag', ''),
+            last_modified=response.headers.get('Last-Modified', '')
+        )
 
     # outerHTMLを取得して返す
     return outer_html
+
+
+def prefetch_outer_html(urls: list[str], top_n: int = SCRAPING_PREFETCH_TOP_N):
+    """
+    上位top_n件のURLの取得をバックグラウンドで開始し、scraping_cacheに保存する
+    取得中にget_outer_htmlを呼び出した場合は、同じリクエストの結果を待つ
+
+    Params
+    ---
+    urls: list[str]
+        ex: ['https://www.google.com/', ...]
+    top_n: int
+        先読みする件数(0の場合は先読みしない)
+    """
+    for url in urls[:top_n]:
+        if not isinstance(url, str) or not url.startswith('http'):
+            continue
+        entry = scraping_cache.get(url)
+        if entry is not None and not entry.is_expired():
+            continue
+        _prefetch_executor.submit(_prefetch, url)
+
+
+def _prefetch(url: str):
+    try:
+        get_outer_html(url)
+    except Exception as e:
+        utils.red_log(e)
@@ -0,0 +1,64 @@
+"""
+同じキーの処理を同時に一回だけ実行する
+実行中に同じキーで呼び出された場合は、新たに実行せず先に始まった処理の結果(例外)を共有する
+
+usage
+---
+>>> flight = SingleFlight()
+>>> flight.do('key', fetch, 'https://example.com/')
+"""
+import threading
+from concurrent.futures import Future
+from typing import Callable, TypeVar
+
+T = TypeVar('T')
+
+
+class SingleFlight():
+    def __init__(self):
+        self._calls: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key: str, fn: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Params
+        ---
+        key: str
+            同じ処理とみなすキー
+        fn: Callable
+            実行する処理
+
+        Returns
+        ---
+        res: T
+            fn(*args, **kwargs)の結果
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self.executed += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self) -> dict:
+        return {'executed': self.executed, 'shared': self.shared, 'in_flight': len(self._calls)}
@@ -0,0 +1,119 @@
+"""
+起動時のウォームアップ
+vertexai・認証情報・toolの宣言・HTMLのパーサーなど、importや初期化に時間がかかるものをバックグラウンドで読み込む
+workerはウォームアップの完了を待たずにソケットを受け付け、完了したかどうかは/readyで返す
+(完了前のリクエストは、必要なモジュールの読み込みを待ってから処理される)
+
+usage
+---
+>>> from warmup import warmup
+>>> warmup.start()
+>>> warmup.wait(timeout=30)
+True
+>>> warmup.status()
+{'ready': True, 'error': '', 'seconds': {'gemini': 2.5, 'vertexai': 0.1, 'tools': 0.0, 'model': 0.0, 'parsers': 0.2}}
+"""
+import threading
+import time
+
+import utils
+
+from typing import Callable, Optional
+
+
+def _import_gemini():
+    import gemini  # noqa: F401
+
+
+def _init_vertexai():
+    import gemini
+
+    gemini.init_vertexai()
+
+
+def _build_tools():
+    import gemini
+
+    gemini.get_tools()
+
+
+def _create_model():
+    import gemini
+
+    # 既定の設定のGenerativeModelをmodel_registryに登録しておく
+    gemini.GeminiAI()
+
+
+def _import_parsers():
+    # 参照すると、utilsの各モジュール(requests・BeautifulSoupなど)を読み込む
+    utils.get_outer_html, utils.reduce_html, utils.get_default_serch, utils.Notion, utils.load_image
+    try:
+        import bs4  # noqa: F401
+        from PIL import Image  # noqa: F401
+    except ImportError:
+        pass
+
+
+# (名前, 処理) 上から順に実行する
+DEFAULT_STEPS: list[tuple[str, Callable[[], None]]] = [
+    ('gemini', _import_gemini),
+    ('vertexai', _init_vertexai),
+    ('tools', _build_tools),
+    ('model', _create_model),
+    ('parsers', _import_parsers),
+]
+
+
+class Warmup():
+    def __init__(self, steps: Optional[list[tuple[str, Callable[[], None]]]] = None):
+        self.steps = DEFAULT_STEPS if steps is None else steps
+        # 名前 → かかった時間(秒)
+        self.seconds: dict[str, float] = {}
+        self.error = ''
+        self._done = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> threading.Thread:
+        """
+        バックグラウンドでウォームアップを開始する(二回目以降は何もしない)
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='warmup', daemon=True)
+                self._thread.start()
+        return self._thread
+
+    def run(self):
+        try:
+            for name, step in self.steps:
+                start = time.perf_counter()
+                with utils.span('warmup', name):
+                    step()
+                self.seconds[name] = time.perf_counter() - start
+            utils.green_log(f'ウォームアップ完了 ({sum(self.seconds.values()):.2f}s)')
+        except Exception as e:
+            self.error = f'{name}: {e}'
+            utils.red_log(f'ウォームアップに失敗: {self.error}')
+        finally:
+            self._done.set()
+
+    @property
+    def ready(self) -> bool:
+        return self._done.is_set() and not self.error
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        ウォームアップが終わるまで待つ(開始していない場合は開始する)
+        """
+        self.start()
+        self._done.wait(timeout)
+        return self.ready
+
+    def status(self) -> dict:
+        return {'ready': self.ready, 'error': self.error, 'seconds': dict(self.seconds)}
+
+
+# プロセス全体で一つのウォームアップ
+warmup = Warmup()
+utils.add_stats_collector('warmup', warmup.status)